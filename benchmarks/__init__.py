@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""Benchmarks of the FITS read and write helpers of pypher"""
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from pypher import fitsutils
+from pypher.pypher import load_psf
+
+from .common import SIZES, gaussian
+
+
+class FitsIO(object):
+    params = [SIZES]
+    param_names = ['size']
+
+    def setup(self, size):
+        self.tmpdir = tempfile.mkdtemp()
+        self.psf_file = os.path.join(self.tmpdir, 'psf.fits')
+        self.kernel_file = os.path.join(self.tmpdir, 'kernel.fits')
+        self.kernel = gaussian(size, size / 16)
+        fitsutils.write_kernel(self.psf_file, self.kernel, 0.1)
+
+    def teardown(self, size):
+        shutil.rmtree(self.tmpdir)
+
+    def time_read_psf(self, size):
+        fitsutils.read_psf(self.psf_file, cache=False)
+
+    def time_load_psf(self, size):
+        fitsutils.clear_psf_cache()
+        load_psf(self.psf_file)
+
+    def peakmem_load_psf(self, size):
+        fitsutils.clear_psf_cache()
+        load_psf(self.psf_file)
+
+    def time_get_pixscale(self, size):
+        fitsutils.get_pixscale(self.psf_file)
+
+    def time_write_kernel(self, size):
+        fitsutils.write_kernel(self.kernel_file, self.kernel, 0.1,
+                               overwrite=True)
+
+    def time_write_kernel_compressed(self, size):
+        fitsutils.write_kernel(self.kernel_file, self.kernel, 0.1,
+                               quantize=1e-9, overwrite=True)
+
+    def time_read_kernel(self, size):
+        np.array(fitsutils.read_kernel(self.psf_file))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""Benchmarks of the Fourier and deconvolution methods of pypher"""
+from __future__ import division
+
+from pypher.pypher import psf2otf, deconv_wiener, homogenization_kernel
+
+from .common import SIZES, psf_pair
+
+
+class Fourier(object):
+    params = [SIZES]
+    param_names = ['size']
+
+    def setup(self, size):
+        self.target, self.source = psf_pair(size)
+        self.shape = self.target.shape
+
+    def time_psf2otf(self, size):
+        psf2otf(self.source, self.shape)
+
+    def time_psf2otf_real(self, size):
+        psf2otf(self.source, self.shape, real=True)
+
+    def peakmem_psf2otf(self, size):
+        psf2otf(self.source, self.shape)
+
+    def time_deconv_wiener(self, size):
+        deconv_wiener(self.source, 1e-4, real=True)
+
+    def peakmem_deconv_wiener(self, size):
+        deconv_wiener(self.source, 1e-4, real=True)
+
+
+class Kernel(object):
+    params = [SIZES, [False, True]]
+    param_names = ['size', 'fast']
+
+    def setup(self, size, fast):
+        self.target, self.source = psf_pair(size)
+
+    def time_homogenization_kernel(self, size, fast):
+        homogenization_kernel(self.target, self.source, real=True,
+                              fast=fast)
+
+    def peakmem_homogenization_kernel(self, size, fast):
+        homogenization_kernel(self.target, self.source, real=True,
+                              fast=fast)
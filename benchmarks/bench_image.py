@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""Benchmarks of the image methods of pypher"""
+from __future__ import division
+
+from pypher.pypher import imrotate, imresample, trim, zero_pad
+
+from .common import SIZES, gaussian
+
+
+class ImageMethods(object):
+    params = [SIZES]
+    param_names = ['size']
+
+    def setup(self, size):
+        self.psf = gaussian(size, size / 16)
+
+    def time_imrotate(self, size):
+        imrotate(self.psf, 30.0)
+
+    def peakmem_imrotate(self, size):
+        imrotate(self.psf, 30.0)
+
+    def time_imresample(self, size):
+        imresample(self.psf, 0.1, 0.13)
+
+    def peakmem_imresample(self, size):
+        imresample(self.psf, 0.1, 0.13)
+
+    def time_imresample_fourier(self, size):
+        imresample(self.psf, 0.1, 0.13, method='fourier')
+
+    def time_trim(self, size):
+        trim(self.psf, (size - 10, size - 10))
+
+    def time_zero_pad(self, size):
+        zero_pad(self.psf, (size + 10, size + 10), position='center')
+
+    def peakmem_zero_pad(self, size):
+        zero_pad(self.psf, (size + 10, size + 10), position='center')
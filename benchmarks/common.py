@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+Shared inputs of the benchmarks
+
+The image sizes go from small PSF stamps to large PSF models, with
+prime sizes next to the powers of two, on which the FFTs are slowest.
+"""
+from __future__ import division
+
+import numpy as np
+
+SIZES = [64, 127, 256, 509, 1024, 2053, 4096]
+
+
+def gaussian(size, sigma):
+    """Normalized Gaussian PSF centered at ``size // 2``"""
+    grid = np.arange(size) - size // 2
+    xx, yy = np.meshgrid(grid, grid)
+    array = np.exp(-(xx**2 + yy**2) / (2 * sigma**2))
+    return array / array.sum()
+
+
+def psf_pair(size):
+    """Target and source PSFs of a given size, source twice as sharp"""
+    return gaussian(size, size / 16), gaussian(size, size / 32)
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2016 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+Run the benchmarks without asv and compare them with a baseline
+
+The benchmark classes follow the asv conventions (``params``,
+``setup``, ``time_*`` and ``peakmem_*`` methods). The timings are the
+best of a few repeats and the peak memory is the largest allocation
+traced by `tracemalloc` during one call, numpy arrays included.
+
+Usage:
+  python -m benchmarks.run [-k PATTERN] [--max-size N]
+                           [--output FILE] [--compare BASELINE]
+                           [--factor FACTOR]
+
+Example:
+  python -m benchmarks.run --max-size 1024 --compare benchmarks/baseline.json
+"""
+from __future__ import absolute_import, print_function, division
+
+import sys
+import json
+import timeit
+import argparse
+import platform
+import importlib
+import itertools
+import tracemalloc
+
+import numpy as np
+
+MODULES = ['bench_image', 'bench_fourier', 'bench_fits']
+
+
+def parse_args():
+    """Argument parser of the benchmark runner"""
+    parser = argparse.ArgumentParser(
+        prog='benchmarks.run',
+        description="Run the pypher benchmarks and compare them with "
+                    "a baseline")
+
+    parser.add_argument('-k', '--pattern', type=str, default='',
+                        help="Only run the benchmarks whose name contains "
+                             "this string")
+
+    parser.add_argument('--max-size', type=int, default=None,
+                        help="Skip the image sizes above this value")
+
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Number of timings of each benchmark")
+
+    parser.add_argument('--output', type=str, default=None,
+                        help="JSON file of the results")
+
+    parser.add_argument('--compare', type=str, default=None,
+                        help="JSON file of baseline results")
+
+    parser.add_argument('--factor', type=float, default=1.5,
+                        help="Ratio to the baseline flagged as a "
+                             "regression")
+
+    return parser.parse_args()
+
+
+def benchmarks(pattern='', max_size=None):
+    """
+    Benchmarks of the suite
+
+    Yields
+    ------
+    name: str
+        ``module.Class.method(param, ...)``
+    cls: type
+        Benchmark class
+    method: str
+        Benchmark method name
+    params: tuple
+        Parameters of the benchmark
+    """
+    for module_name in MODULES:
+        module = importlib.import_module('benchmarks.' + module_name)
+        classes = [obj for obj in vars(module).values()
+                   if isinstance(obj, type) and
+                   obj.__module__ == module.__name__]
+        for cls in classes:
+            names = list(getattr(cls, 'param_names', []))
+            grid = list(itertools.product(*getattr(cls, 'params', [[]])))
+            if max_size is not None and 'size' in names:
+                grid = [params for params in grid
+                        if params[names.index('size')] <= max_size]
+            for method in sorted(vars(cls)):
+                if not method.startswith(('time_', 'peakmem_')):
+                    continue
+                for params in grid:
+                    name = '{0}.{1}.{2}({3})'.format(
+                        module_name, cls.__name__, method,
+                        ', '.join(repr(param) for param in params))
+                    if pattern in name:
+                        yield name, cls, method, params
+
+
+def measure(cls, method, params, repeat=3):
+    """Best time in seconds or peak memory in bytes of a benchmark"""
+    bench = cls()
+    if hasattr(bench, 'setup'):
+        bench.setup(*params)
+    func = getattr(bench, method)
+
+    try:
+        if method.startswith('peakmem_'):
+            tracemalloc.start()
+            func(*params)
+            return tracemalloc.get_traced_memory()[1]
+
+        timer = timeit.Timer(lambda: func(*params))
+        number, _ = timer.autorange()
+        return min(timer.repeat(repeat, number)) / number
+    finally:
+        tracemalloc.stop()
+        if hasattr(bench, 'teardown'):
+            bench.teardown(*params)
+
+
+def format_value(name, value):
+    """Human readable time or memory"""
+    if '.peakmem_' in name:
+        return '{0:.1f} MB'.format(value / 2**20)
+    if value < 1e-3:
+        return '{0:.1f} us'.format(value * 1e6)
+    if value < 1:
+        return '{0:.2f} ms'.format(value * 1e3)
+    return '{0:.2f} s'.format(value)
+
+
+def compare(results, baseline, factor):
+    """
+    Ratios of the results to a baseline
+
+    Returns
+    -------
+    regressions: list of str
+        Benchmarks slower or larger than ``factor`` times the baseline
+    """
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        ratio = value / max(baseline[name], 1e-12)
+        flag = ''
+        if ratio > factor:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / factor:
+            flag = '  improved'
+        print('{0:70s} {1:>10s} {2:>10s} {3:6.2f}{4}'.format(
+            name, format_value(name, baseline[name]),
+            format_value(name, value), ratio, flag))
+    return regressions
+
+
+def main():
+    """Main script of the benchmark runner"""
+    args = parse_args()
+
+    results = {}
+    for name, cls, method, params in benchmarks(args.pattern,
+                                                args.max_size):
+        results[name] = measure(cls, method, params, args.repeat)
+        print('{0:70s} {1:>10s}'.format(name, format_value(name,
+                                                           results[name])))
+        sys.stdout.flush()
+
+    if args.output is not None:
+        machine = {'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'machine': platform.machine(),
+                   'processor': platform.processor()}
+        with open(args.output, 'w') as output:
+            json.dump({'machine': machine, 'results': results}, output,
+                      indent=1, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        print('\n{0:70s} {1:>10s} {2:>10s} {3:>6s}'.format(
+            'benchmark', 'baseline', 'current', 'ratio'))
+        if compare(results, baseline, args.factor):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,7 @@ addpixscl
 Write the pixel scale in FITS file headers
 
 Usage:
-  addpixscl fits_files pixel_scale [--ext EXT]
+  addpixscl fits_files pixel_scale [--ext EXT] [--jobs N]
   addpixscl (-h | --help)
 
 Example:
@@ -20,9 +20,10 @@ Example:
 from __future__ import absolute_import, print_function, division
 
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 from pypher.parser import ThrowingArgumentParser, ArgumentParserError
-from pypher.fitsutils import has_pixelscale, write_pixelscale
+from pypher.fitsutils import update_pixelscale
 
 
 def parse_args():
@@ -39,9 +40,47 @@ def parse_args():
     parser.add_argument('-e', '--ext', type=int, default=0,
                         help='FITS extension number')
 
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of files processed in parallel')
+
     return parser.parse_args()
 
 
+def add_pixscale(fits_files, pixel_scale, ext=0, jobs=1):
+    """
+    Write the pixel scale in the header of FITS files lacking it
+
+    Each file is opened once in update mode, and the files are spread
+    over ``jobs`` threads since the work is bound by the file I/O.
+
+    Parameters
+    ----------
+    fits_files: list of str
+        Paths to FITS image files
+    pixel_scale: float
+        Pixel scale value in arcseconds
+    ext: int, optional
+        Extension number in the FITS files
+    jobs: int, optional
+        Number of threads (default 1)
+
+    Returns
+    -------
+    written: list of bool
+        For each file, `False` if its header already held pixel scale
+        keywords
+
+    """
+    def update(fits_file):
+        return update_pixelscale(fits_file, pixel_scale, ext)
+
+    if jobs <= 1:
+        return [update(fits_file) for fits_file in fits_files]
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(update, fits_files))
+
+
 def main():  # pragma: no cover
     """Main script for addpixscl"""
     try:
@@ -50,10 +89,10 @@ def main():  # pragma: no cover
         print(__doc__)
         sys.exit()
 
-    for fits_file in args.fits_files:
-        if has_pixelscale(fits_file):
+    written = add_pixscale(args.fits_files, args.pixel_scale, args.ext,
+                           args.jobs)
+
+    for fits_file, done in zip(args.fits_files, written):
+        if not done:
             print("Found keywords refering to the pixel scale "
                   "in {0} header.".format(fits_file))
-            continue
-
-        write_pixelscale(fits_file, args.pixel_scale, args.ext)
@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+pypher-apply
+------------
+Convolve a large image with a homogenization kernel, tile by tile
+
+Usage:
+  pypher-apply image kernel output [--ext EXT] [--tile-size N] [--jobs N]
+               [--fft-backend BACKEND] [--fft-workers N] [--float32]
+  pypher-apply (-h | --help)
+
+Example:
+  pypher-apply mosaic.fits kernel_a_to_b.fits mosaic_b.fits --jobs 8
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import astropy.io.fits as pyfits
+
+from scipy.ndimage import convolve1d
+
+from pypher import fftutils
+from pypher import fitsutils as fits
+from pypher.parser import ThrowingArgumentParser, ArgumentParserError
+from pypher.pypher import add_fft_arguments, psf2otf, _extension
+
+
+def parse_args():
+    """Argument parser for the command line interface of `pypher-apply`"""
+    parser = ThrowingArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog='pypher-apply',
+        description="Convolve a large image with a homogenization kernel")
+
+    parser.add_argument('image', type=str,
+                        help="FITS file of the image to convolve")
+
+    parser.add_argument('kernel', type=str,
+                        help="FITS file of the kernel")
+
+    parser.add_argument('output', type=str,
+                        help="File name for the convolved image")
+
+    parser.add_argument('--ext', type=_extension, default=None,
+                        help="FITS extension of the image (default: first "
+                             "extension with data)")
+
+    parser.add_argument('--tile-size', type=int, default=2048,
+                        help="Size of the output tiles in pixels")
+
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of processes convolving the tiles")
+
+    add_fft_arguments(parser, product='convolved image')
+
+    return parser.parse_args()
+
+
+def tiles(shape, tile_size):
+    """
+    Split a 2D shape into tiles
+
+    Parameters
+    ----------
+    shape: tuple of int
+        Shape of the image
+    tile_size: int
+        Size of the tiles, the last tiles along each axis being smaller
+
+    Returns
+    -------
+    tiles: list of tuple of slice
+        Row and column slices of every tile
+
+    """
+    return [(slice(row, min(row + tile_size, shape[0])),
+             slice(col, min(col + tile_size, shape[1])))
+            for row in range(0, shape[0], tile_size)
+            for col in range(0, shape[1], tile_size)]
+
+
+def _block_shape(kernel_shape, tile_size):
+    """Shape of the input blocks, a tile plus the kernel support"""
+    return tuple(tile_size + size - 1 for size in kernel_shape)
+
+
+def _convolve_tile(image, tile, kernel_shape, otf, block_shape):
+    """
+    Overlap-save convolution of one tile of a 2D image
+
+    The block of the image seen by the tile through the kernel is read
+    with zeros outside the image and NaN values set to 0, convolved
+    circularly with the kernel OTF, and the part free of wrap-around
+    is returned.
+    """
+    rows, cols = tile
+    # Kernel support before and after the center, following psf2otf
+    before = [size - 1 - size // 2 for size in kernel_shape]
+
+    src, dst = [], []
+    for axis in range(2):
+        start = tile[axis].start - before[axis]
+        stop = start + block_shape[axis]
+        src.append(slice(max(start, 0), min(stop, image.shape[axis])))
+        dst.append(slice(src[axis].start - start, src[axis].stop - start))
+
+    block = np.zeros(block_shape, dtype=otf.real.dtype)
+    block[tuple(dst)] = image[tuple(src)]
+    np.nan_to_num(block, copy=False)
+
+    output = fftutils.irfft2(fftutils.rfft2(block) * otf, block_shape)
+
+    return output[before[0]:before[0] + rows.stop - rows.start,
+                  before[1]:before[1] + cols.stop - cols.start]
+
+
+def convolve_tiled(image, kernel, output=None, tile_size=2048):
+    """
+    Convolve an image with a kernel by overlap-save tiled FFTs
+
+    The output is the same size as the image, with zeros assumed
+    outside the image, and the kernel centered at ``kernel.shape // 2``
+    as in `pypher.pypher.psf2otf`. Only one block of about
+    ``tile_size + kernel size`` pixels squared is in memory at a time,
+    so that ``image`` and ``output`` can be memory maps of arbitrary
+    size.
+
+    Parameters
+    ----------
+    image: `numpy.ndarray`
+        2D image, possibly a memory map. NaN values are taken as 0.
+    kernel: `numpy.ndarray`
+        2D convolution kernel
+    output: `numpy.ndarray`, optional
+        Array receiving the convolved image, tile by tile
+        (default `None`: a new array)
+    tile_size: int, optional
+        Size of the output tiles in pixels (default 2048)
+
+    Returns
+    -------
+    output: `numpy.ndarray`
+        Convolved image
+
+    """
+    if output is None:
+        output = np.empty(image.shape, dtype=np.promote_types(image.dtype,
+                                                              np.float32))
+
+    tile_size = min(tile_size, max(image.shape))
+    block_shape = _block_shape(kernel.shape, tile_size)
+    otf = psf2otf(kernel, block_shape, real=True, dtype=output.dtype)
+
+    for tile in tiles(image.shape, tile_size):
+        output[tile] = _convolve_tile(image, tile, kernel.shape, otf,
+                                      block_shape)
+
+    return output
+
+
+def convolve_stamps(stamps, kernel, output=None, max_bytes=2**28):
+    """
+    Convolve a stack of postage stamps with a kernel
+
+    The kernel OTF is computed once and the stamps go through stacked
+    real FFTs along the leading axis, by chunks whose working arrays fit
+    in ``max_bytes``. As in `convolve_tiled`, the output stamps have the
+    size of the input ones, with zeros assumed outside each stamp.
+
+    Parameters
+    ----------
+    stamps: `numpy.ndarray`
+        3D array of shape (n, ny, nx), possibly a memory map. NaN values
+        are taken as 0.
+    kernel: `numpy.ndarray`
+        2D convolution kernel
+    output: `numpy.ndarray`, optional
+        Array of shape (n, ny, nx) receiving the convolved stamps,
+        chunk by chunk (default `None`: a new array)
+    max_bytes: int, optional
+        Memory budget of the working arrays of a chunk (default 256 MB)
+
+    Returns
+    -------
+    output: `numpy.ndarray`
+        Convolved stamps
+
+    """
+    if stamps.ndim != 3:
+        raise ValueError("CONVOLVE_STAMPS: expected a 3D stack of stamps")
+
+    if output is None:
+        output = np.empty(stamps.shape, dtype=np.promote_types(stamps.dtype,
+                                                               np.float32))
+
+    stamp_shape = stamps.shape[1:]
+    block_shape = tuple(size + kernel_size - 1
+                        for size, kernel_size in zip(stamp_shape,
+                                                     kernel.shape))
+    before = [size - 1 - size // 2 for size in kernel.shape]
+    inner = (slice(None),
+             slice(before[0], before[0] + stamp_shape[0]),
+             slice(before[1], before[1] + stamp_shape[1]))
+
+    otf = psf2otf(kernel, block_shape, real=True, dtype=output.dtype)
+
+    # The FFTs of a padded stamp take up to about four complex double
+    # precision arrays of its size, numpy.fft working in double precision
+    stamp_bytes = 4 * np.prod(block_shape) * np.dtype(complex).itemsize
+    chunk = max(1, int(max_bytes // stamp_bytes))
+
+    for start in range(0, len(stamps), chunk):
+        stop = min(start + chunk, len(stamps))
+        block = np.zeros((stop - start,) + block_shape, dtype=otf.real.dtype)
+        block[inner] = stamps[start:stop]
+        np.nan_to_num(block, copy=False)
+
+        spectrum = fftutils.rfft2(block)
+        del block
+        spectrum *= otf
+        output[start:stop] = fftutils.irfft2(spectrum, block_shape)[inner]
+
+    return output
+
+
+def convolve_separable(image, vertical, horizontal, output=None):
+    """
+    Convolve an image with a kernel given as a sum of separable components
+
+    Each component is applied as a 1D convolution along y followed by a
+    1D convolution along x, which costs ``r * (ny + nx)`` operations per
+    pixel instead of ``ny * nx`` for the dense kernel. As in
+    `convolve_tiled`, the output is the same size as the image, with
+    zeros assumed outside the image and the kernel centered at
+    ``kernel.shape // 2``.
+
+    Parameters
+    ----------
+    image: `numpy.ndarray`
+        2D image. NaN values are taken as 0.
+    vertical: `numpy.ndarray`
+        2D array of shape (r, ny) of the filters along y
+    horizontal: `numpy.ndarray`
+        2D array of shape (r, nx) of the filters along x
+    output: `numpy.ndarray`, optional
+        Array receiving the convolved image (default `None`: a new array)
+
+    Returns
+    -------
+    output: `numpy.ndarray`
+        Convolved image
+
+    See Also
+    --------
+    pypher.pypher.separable_kernel
+
+    """
+    vertical = np.atleast_2d(vertical)
+    horizontal = np.atleast_2d(horizontal)
+    if len(vertical) != len(horizontal):
+        raise ValueError("CONVOLVE_SEPARABLE: different numbers of "
+                         "vertical and horizontal filters")
+
+    dtype = np.promote_types(image.dtype, np.float32)
+    if output is None:
+        output = np.empty(image.shape, dtype=dtype)
+
+    image = np.nan_to_num(np.asarray(image, dtype=dtype))
+    buffer = np.empty(image.shape, dtype=dtype)
+    component = np.empty(image.shape, dtype=dtype)
+
+    output[...] = 0
+    for column, row in zip(vertical, horizontal):
+        convolve1d(image, column, axis=0, output=buffer, mode='constant')
+        convolve1d(buffer, row, axis=1, output=component, mode='constant')
+        output += component
+
+    return output
+
+
+_state = {}
+
+
+def _init_worker(image_file, ext, kernel, output_file, offset, dtype,
+                 tile_size, backend=None, workers=None):
+    """Open the image and output memory maps once per process"""
+    fftutils.set_backend(backend, workers)
+
+    hdulist = fits._open_image(image_file, ext)
+    hdu = hdulist[ext]
+    # Scaled images cannot be memory-mapped, so their blocks are read
+    # and scaled one at a time through the section interface
+    image = hdu.section if fits._is_scaled(hdu.header) else hdu.data
+    output = np.memmap(output_file, dtype=dtype, mode='r+', offset=offset,
+                       shape=image.shape)
+    block_shape = _block_shape(kernel.shape, tile_size)
+
+    _state.clear()
+    _state.update(hdulist=hdulist, image=image, output=output,
+                  kernel_shape=kernel.shape, block_shape=block_shape,
+                  otf=psf2otf(kernel, block_shape, real=True,
+                              dtype=dtype.newbyteorder('=')))
+
+
+def _apply_tile(tile):
+    """Convolve one tile and write it to the output memory map"""
+    _state['output'][tile] = _convolve_tile(_state['image'], tile,
+                                            _state['kernel_shape'],
+                                            _state['otf'],
+                                            _state['block_shape'])
+
+
+def _create_output(output_file, header, shape, dtype, overwrite=False):
+    """
+    Create a FITS file with an empty data block of given shape
+
+    Only the header is written, the file being then extended to its
+    full size without allocating the data in memory.
+
+    Returns
+    -------
+    offset: int
+        Position of the data block in the file
+    """
+    hdu = pyfits.PrimaryHDU(data=np.zeros((1, 1), dtype=dtype))
+    hdu.header['NAXIS1'] = shape[1]
+    hdu.header['NAXIS2'] = shape[0]
+    hdu.header.extend(header, strip=True)
+    for key in ['BZERO', 'BSCALE', 'BLANK', 'CHECKSUM', 'DATASUM',
+                'EXTNAME']:
+        hdu.header.remove(key, ignore_missing=True, remove_all=True)
+    hdu.header.tofile(output_file, overwrite=overwrite)
+
+    offset = len(hdu.header.tostring())
+    data_size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    # FITS files are made of 2880 byte blocks
+    file_size = offset + -(-data_size // 2880) * 2880
+    with open(output_file, 'rb+') as fits_file:
+        fits_file.seek(file_size - 1)
+        fits_file.write(b'\0')
+
+    return offset
+
+
+def apply_kernel(image_file, kernel_file, output_file, ext=None,
+                 tile_size=2048, jobs=1, dtype=None, overwrite=False):
+    """
+    Convolve a FITS image with a FITS kernel, tile by tile
+
+    The image is memory-mapped, or read block by block if it is scaled
+    by BSCALE / BZERO, and the output FITS file is created empty on disk
+    and filled tile by tile, so that the memory stays bounded by a few
+    tiles per process whatever the image size. The output keeps the
+    header of the image (WCS included) and by default its floating
+    point precision, at least float32.
+
+    Parameters
+    ----------
+    image_file: str
+        Path to the FITS image
+    kernel_file: str
+        Path to the kernel, with the pixel scale of the image, in any
+        format read by `pypher.fitsutils.read_kernel`
+    output_file: str
+        Path to the output FITS image
+    ext: int or str, optional
+        Extension of the image (default: first HDU holding data)
+    tile_size: int, optional
+        Size of the output tiles in pixels (default 2048)
+    jobs: int, optional
+        Number of processes convolving the tiles (default 1), the FFT
+        threads being shared between them
+    dtype: data-type, optional
+        Floating point type of the output and of the computation
+        (default: that of the image, at least float32)
+    overwrite: bool, optional
+        If `True`, overwrite an existing output file (default `False`)
+
+    """
+    kernel = np.array(fits.read_kernel(kernel_file), dtype=float)
+    if kernel.ndim != 2:
+        raise ValueError("APPLY_KERNEL: {0} is not a 2D "
+                         "kernel".format(kernel_file))
+
+    # Only the header is read here, the shape and type of the image
+    # coming from its cards
+    with pyfits.open(image_file, memmap=True) as hdulist:
+        hdu = fits._data_hdu(hdulist, ext)
+        ext = hdulist.index(hdu)
+        header = hdu.header
+
+    if header.get('NAXIS') != 2:
+        raise ValueError("APPLY_KERNEL: extension {0} of {1} is not a 2D "
+                         "image".format(ext, image_file))
+
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    if dtype is None:
+        # Scaled integer images are read as floats of the same size
+        dtype = np.promote_types(fits._bitpix_dtype(header['BITPIX']),
+                                 np.float32)
+
+    # FITS data is big-endian
+    dtype = np.dtype(dtype).newbyteorder('>')
+    offset = _create_output(output_file, header, shape, dtype, overwrite)
+
+    tile_size = min(tile_size, max(shape))
+    workers = max(1, fftutils.get_workers() // max(jobs, 1))
+    initargs = (image_file, ext, kernel, output_file, offset, dtype,
+                tile_size, fftutils.get_backend(), workers)
+    tile_list = tiles(shape, tile_size)
+
+    if jobs <= 1:
+        _init_worker(*initargs)
+        for tile in tile_list:
+            _apply_tile(tile)
+        _state['output'].flush()
+        _state['hdulist'].close()
+        _state.clear()
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=initargs) as executor:
+        list(executor.map(_apply_tile, tile_list))
+
+    # The workers share the output pages through the file mapping, so a
+    # single sync once all the tiles are written is enough
+    with open(output_file, 'rb+') as output:
+        os.fsync(output.fileno())
+
+
+def main():  # pragma: no cover
+    """Main script for pypher-apply"""
+    try:
+        args = parse_args()
+    except ArgumentParserError:
+        print(__doc__)
+        sys.exit()
+
+    fftutils.set_backend(args.fft_backend, args.fft_workers)
+
+    apply_kernel(args.image, args.kernel, args.output, ext=args.ext,
+                 tile_size=args.tile_size, jobs=args.jobs,
+                 dtype=np.float32 if args.float32 else None)
+
+    print("pypher-apply: Convolved image saved to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
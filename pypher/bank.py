@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+bank.py
+-------
+Kernel bank, a single FITS file holding many kernels
+
+The kernels are stored as image extensions, each with the header that
+`pypher.fitsutils.write_kernel` would write for it, followed by an
+``INDEX`` binary table giving the byte offsets of every kernel. The
+offset of the index itself is stored in the ``IDXOFF`` card of the
+primary header, so that any kernel is fetched with two seeks, without
+reading the other ones.
+
+New kernels are written over the index, which is written again after
+them when the bank is flushed, the file being truncated at its end.
+Once flushed, the bank is thus a valid FITS file holding a single
+index, readable with `astropy.io.fits.open`.
+
+A bank opened for appending holds an exclusive advisory lock on the
+file (``fcntl.flock``) until it is closed, so that concurrent writers,
+such as several ``pypher-batch --bank`` runs, wait for each other.
+Where ``fcntl`` is not available, or on file systems ignoring the
+lock, a bank must have a single writer at a time.
+
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+from collections import OrderedDict, namedtuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+import numpy as np
+import astropy.io.fits as pyfits
+
+from pypher import fitsutils as fits
+
+BLOCK_SIZE = 2880
+
+INDEX_FIELDS = [('REGFACT', '>f8'), ('HDRLOC', '>i8'), ('DATLOC', '>i8'),
+                ('BITPIX', '>i4'), ('NAXIS1', '>i8'), ('NAXIS2', '>i8')]
+
+_TFORMS = {'D': '>f8', 'E': '>f4', 'K': '>i8', 'J': '>i4', 'I': '>i2'}
+
+BankEntry = namedtuple('BankEntry', ['hdr_loc', 'dat_loc', 'dtype', 'shape'])
+BankEntry.__doc__ = """\
+Location of a kernel in a `KernelBank`
+
+Attributes
+----------
+hdr_loc: int
+    Byte offset of the kernel header
+dat_loc: int
+    Byte offset of the kernel data
+dtype: `numpy.dtype`
+    Big-endian data type of the kernel
+shape: tuple of int
+    Shape of the kernel
+"""
+
+
+def _padded(data):
+    """Bytes padded with zeros to a multiple of the FITS block size"""
+    return data + b'\0' * (-len(data) % BLOCK_SIZE)
+
+
+def _table_dtype(header):
+    """Record data type of a binary table with scalar columns"""
+    fields = []
+    for idx in range(1, header['TFIELDS'] + 1):
+        tform = header['TFORM{0}'.format(idx)].strip()
+        if tform.endswith('A'):
+            dtype = 'S' + (tform[:-1] or '1')
+        else:
+            dtype = _TFORMS[tform]
+        fields.append((header['TTYPE{0}'.format(idx)], dtype))
+    return np.dtype(fields)
+
+
+class KernelBank(object):
+    """
+    Kernels stored in a single indexed FITS file
+
+    The kernels are keyed by the (source, target, reg_fact) triple of
+    their PSF names and regularisation parameter.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to the bank file
+    mode: str, optional
+        'r' to read an existing bank (default) or 'a' to append kernels,
+        creating the bank if needed. In 'a' mode, the bank is locked
+        against other writers until it is closed.
+
+    Examples
+    --------
+    >>> with KernelBank('kernels.fits', 'a') as bank:
+    ...     bank.append(kernel, 'psf_a.fits', 'psf_b.fits', 1e-4, 0.1)
+    >>> kernel = KernelBank('kernels.fits')['psf_a.fits', 'psf_b.fits', 1e-4]
+
+    """
+    def __init__(self, fits_file, mode='r'):
+        if mode not in ['r', 'a']:
+            raise ValueError("KERNELBANK: mode must be 'r' or 'a'")
+
+        self.fits_file = fits_file
+        self.mode = mode
+        self._modified = False
+
+        if mode == 'r':
+            self._file = open(fits_file, 'rb')
+        else:
+            flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+            self._file = os.fdopen(os.open(fits_file, flags), 'r+b')
+            if fcntl is not None:
+                # Released when the file is closed
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            # Still empty if just created, here or by another writer
+            if os.fstat(self._file.fileno()).st_size == 0:
+                self._file.write(_empty_bank())
+                self._file.flush()
+                self._file.seek(0)
+
+        primary = pyfits.Header.fromfile(self._file)
+        if 'IDXOFF' not in primary:
+            self._file.close()
+            raise IOError("{0} is not a kernel bank.".format(fits_file))
+        self._index = self._read_index(primary['IDXOFF'])
+        # The kernels end where the index starts
+        self._end = primary['IDXOFF']
+
+    def _read_index(self, offset):
+        """Read the index table at a given byte offset"""
+        self._file.seek(offset)
+        header = pyfits.Header.fromfile(self._file)
+        dtype = _table_dtype(header)
+        records = np.frombuffer(self._file.read(dtype.itemsize *
+                                                header['NAXIS2']),
+                                dtype=dtype)
+
+        index = OrderedDict()
+        for record in records:
+            key = (record['SOURCE'].decode(), record['TARGET'].decode(),
+                   float(record['REGFACT']))
+            index[key] = BankEntry(int(record['HDRLOC']),
+                                   int(record['DATLOC']),
+                                   fits._bitpix_dtype(
+                                       int(record['BITPIX'])),
+                                   (int(record['NAXIS2']),
+                                    int(record['NAXIS1'])))
+        return index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return self._key(*key) in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def keys(self):
+        """(source, target, reg_fact) keys of the kernels"""
+        return list(self._index)
+
+    @staticmethod
+    def _key(source, target, reg_fact):
+        return (str(source), str(target), float(reg_fact))
+
+    def __getitem__(self, key):
+        """
+        Read one kernel
+
+        Parameters
+        ----------
+        key: tuple
+            (source, target, reg_fact) key of the kernel
+
+        Returns
+        -------
+        kernel: `numpy.ndarray`
+            2D kernel in native byte order
+
+        """
+        entry = self._index[self._key(*key)]
+        self._file.seek(entry.dat_loc)
+        data = np.fromfile(self._file, dtype=entry.dtype,
+                           count=int(np.prod(entry.shape)))
+
+        return data.reshape(entry.shape).astype(entry.dtype.newbyteorder('='))
+
+    def header(self, key):
+        """
+        Read the header of one kernel, with its provenance comments
+
+        Parameters
+        ----------
+        key: tuple
+            (source, target, reg_fact) key of the kernel
+
+        Returns
+        -------
+        header: `astropy.io.fits.Header`
+
+        """
+        self._file.seek(self._index[self._key(*key)].hdr_loc)
+        return pyfits.Header.fromfile(self._file)
+
+    def append(self, kernel, source, target, reg_fact, pixel_scale,
+               comments=(), cards=()):
+        """
+        Append a kernel at the end of the bank
+
+        The kernel is written over the index, which is only written
+        again by `flush`, or when the bank is closed. A kernel appended with an existing key replaces the
+        previous one in the index, whose data is left in the file.
+
+        Parameters
+        ----------
+        kernel: `numpy.ndarray`
+            2D kernel
+        source, target: str
+            Names of the source and target PSFs
+        reg_fact: float
+            Regularisation parameter of the kernel
+        pixel_scale: float
+            Pixel scale of the kernel in arcseconds
+        comments: str list, optional
+            Comments to add to the header, see
+            `pypher.pypher.kernel_comments`
+        cards: list of tuple, optional
+            Additional (key, value, comment) header cards
+
+        """
+        if self.mode != 'a':
+            raise IOError("KERNELBANK: bank opened read-only")
+
+        kernel = np.asarray(kernel)
+        if kernel.ndim != 2:
+            raise ValueError("KERNELBANK: only 2D kernels can be stored")
+
+        dtype = kernel.dtype.newbyteorder('>')
+        header = pyfits.ImageHDU(data=kernel).header
+        for value in comments:
+            header.add_comment(value)
+        fits._set_pixelscale(header, pixel_scale)
+        header.set('REGFACT', float(reg_fact), 'Regularisation parameter')
+        for card_key, value, comment in cards:
+            header.set(card_key, value, comment)
+
+        hdr_loc = self._end
+        header_bytes = header.tostring().encode('ascii')
+        data_bytes = _padded(np.ascontiguousarray(kernel,
+                                                  dtype=dtype).tobytes())
+        self._file.seek(hdr_loc)
+        self._file.write(header_bytes)
+        self._file.write(data_bytes)
+        self._end = hdr_loc + len(header_bytes) + len(data_bytes)
+
+        key = self._key(source, target, reg_fact)
+        self._index.pop(key, None)
+        self._index[key] = BankEntry(hdr_loc, hdr_loc + len(header_bytes),
+                                     dtype, kernel.shape)
+        self._modified = True
+
+    def flush(self):
+        """Write the index after the kernels and point IDXOFF to it"""
+        if not self._modified:
+            return
+
+        offset = self._end
+        self._file.seek(offset)
+        self._file.write(_index_bytes(self._index))
+        # Drop what is left of a longer previous index
+        self._file.truncate()
+        self._file.flush()
+
+        # The card keeps its 80 characters, so it is updated in place
+        self._file.seek(0)
+        primary = pyfits.Header.fromfile(self._file)
+        position = list(primary.keys()).index('IDXOFF') * 80
+        primary['IDXOFF'] = offset
+        self._file.seek(position)
+        self._file.write(primary.cards['IDXOFF'].image.encode('ascii'))
+        self._file.flush()
+
+        self._modified = False
+
+    def close(self):
+        """Write the index if needed and close the file"""
+        if self._file.closed:
+            return
+        if self.mode == 'a':
+            self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _empty_bank():
+    """Primary header and empty index of a new bank, as bytes"""
+    header = pyfits.PrimaryHDU().header
+    header['EXTEND'] = True
+    header['IDXOFF'] = (0, 'Byte offset of the kernel index')
+    primary = header.tostring().encode('ascii')
+    header['IDXOFF'] = len(primary)
+
+    return header.tostring().encode('ascii') + _index_bytes(OrderedDict())
+
+
+def _index_bytes(index):
+    """INDEX binary table HDU of a bank index, as bytes"""
+    # The names are stored UTF-8 encoded
+    width = max([1] + [len(name.encode()) for key in index
+                       for name in key[:2]])
+    dtype = np.dtype([('SOURCE', 'S{0}'.format(width)),
+                      ('TARGET', 'S{0}'.format(width))] + INDEX_FIELDS)
+
+    records = np.zeros(len(index), dtype=dtype)
+    for record, (key, entry) in zip(records, index.items()):
+        record['SOURCE'] = key[0].encode()
+        record['TARGET'] = key[1].encode()
+        record['REGFACT'] = key[2]
+        record['HDRLOC'] = entry.hdr_loc
+        record['DATLOC'] = entry.dat_loc
+        record['BITPIX'] = (-8 if entry.dtype.kind == 'f' else 8) * \
+            entry.dtype.itemsize
+        record['NAXIS2'], record['NAXIS1'] = entry.shape
+
+    header = pyfits.BinTableHDU(data=records, name='INDEX').header
+
+    return (header.tostring().encode('ascii') +
+            _padded(records.tobytes()))
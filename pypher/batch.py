@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+pypher-batch
+------------
+Compute the homogenization kernels between every pair of source
+and target PSFs
+
+Usage:
+  pypher-batch -s PSF_SOURCE [PSF_SOURCE ...] -t PSF_TARGET [PSF_TARGET ...]
+               [-o OUTDIR] [-r REG_FACT]
+               [--angle_source ANGLE] [--angle_target ANGLE]
+               [--ext_source EXT] [--ext_target EXT]
+               [--plane_source N] [--plane_target N]
+               [--resample {spline,fourier}]
+               [--fft-backend BACKEND] [--fft-workers N] [--float32]
+               [--cache-dir DIR] [--cache-size MB]
+               [--compress {gzip,rice,hcompress}] [--quantize STEP] [--npy]
+               [--bank FILE] [--profile REPORT]
+  pypher-batch (-h | --help)
+
+Example:
+  pypher-batch -s psf_a.fits psf_b.fits -t psf_c.fits psf_d.fits -o kernels
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import argparse
+
+import numpy as np
+
+from pypher import fftutils
+from pypher.bank import KernelBank
+from pypher.parser import ThrowingArgumentParser, ArgumentParserError
+from pypher.pypher import (add_selection_arguments, add_fft_arguments,
+                           add_cache_arguments, add_output_arguments,
+                           check_output_arguments,
+                           add_profile_arguments, start_profiler,
+                           stop_profiler,
+                           make_cache, write_kernel, append_kernel,
+                           imrotate, load_psf, match_psf,
+                           homogenization_kernels, RESAMPLE_METHODS)
+
+
+def parse_args():
+    """Argument parser for the command line interface of `pypher-batch`"""
+    parser = ThrowingArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog='pypher-batch',
+        description="Compute the homogenization kernels between every "
+                    "pair of source and target PSFs")
+
+    parser.add_argument('-s', '--psf_source', nargs='+', type=str,
+                        required=True,
+                        help="FITS files of PSF images with highest "
+                             "resolution")
+
+    parser.add_argument('-t', '--psf_target', nargs='+', type=str,
+                        required=True,
+                        help="FITS files of PSF images with lowest "
+                             "resolution")
+
+    parser.add_argument('-o', '--outdir', type=str, default='.',
+                        help="Output directory for the kernels")
+
+    parser.add_argument('-r', '--reg_fact', type=float, default=1.e-4,
+                        help="Regularisation parameter for the Wiener filter")
+
+    parser.add_argument('--angle_source', type=float, default=0.0,
+                        help="Rotation angle to apply to every source PSF "
+                             "(deg)")
+
+    parser.add_argument('--angle_target', type=float, default=0.0,
+                        help="Rotation angle to apply to every target PSF "
+                             "(deg)")
+
+    parser.add_argument('--resample', type=str, default='spline',
+                        choices=RESAMPLE_METHODS,
+                        help="Resampling method of the source PSFs")
+
+    add_selection_arguments(parser)
+    add_fft_arguments(parser)
+    add_cache_arguments(parser)
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
+
+    return check_output_arguments(parser, parser.parse_args())
+
+
+def kernel_filename(psf_source, psf_target, outdir='.', suffix='.fits'):
+    """
+    Name of the kernel file between two PSF files
+
+    Parameters
+    ----------
+    psf_source: str
+        Path to the source PSF file
+    psf_target: str
+        Path to the target PSF file
+    outdir: str, optional
+        Output directory
+    suffix: str, optional
+        File extension (default '.fits')
+
+    Returns
+    -------
+    filename: str
+        Path to the kernel file ``kernel_<source>_to_<target>.fits``
+
+    """
+    source, _ = os.path.splitext(os.path.basename(psf_source))
+    target, _ = os.path.splitext(os.path.basename(psf_target))
+
+    return os.path.join(outdir, 'kernel_{0}_to_{1}{2}'.format(source, target,
+                                                             suffix))
+
+
+def load_psfs(fits_files, angle=0.0, dtype=np.float64, ext=None,
+              plane=None):
+    """
+    Load, rotate and normalize a list of PSF files
+
+    Parameters
+    ----------
+    fits_files: list of str
+        Paths to the FITS PSF images
+    angle: float, optional
+        Rotation angle in degrees applied to every PSF
+    dtype: data-type, optional
+        Data type of the PSF arrays (default `numpy.float64`)
+    ext: int, optional
+        Extension of the PSF in every file (default: first HDU with data)
+    plane: int, optional
+        Plane of the PSF in every file holding a 3D cube
+
+    Returns
+    -------
+    psfs: list of `numpy.ndarray`
+        Normalized PSF arrays
+    pixel_scales: list of float
+        Pixel scales in arcseconds
+
+    """
+    psfs = []
+    pixel_scales = []
+    for fits_file in fits_files:
+        psf, pixel_scale = load_psf(fits_file, ext=ext, plane=plane,
+                                    dtype=dtype)
+        if angle != 0.0:
+            psf = imrotate(psf, angle)
+        psfs.append(psf / psf.sum())
+        pixel_scales.append(pixel_scale)
+
+    return psfs, pixel_scales
+
+
+def main():  # pragma: no cover
+    """Main script for pypher-batch"""
+    try:
+        args = parse_args()
+    except ArgumentParserError:
+        print(__doc__)
+        sys.exit()
+
+    fftutils.set_backend(args.fft_backend, args.fft_workers)
+    profiler = start_profiler(args)
+
+    dtype = np.float32 if args.float32 else np.float64
+
+    psfs_target, pixscales_target = load_psfs(args.psf_target,
+                                              args.angle_target, dtype,
+                                              args.ext_target,
+                                              args.plane_target)
+
+    # All the kernels share the grid of the target PSFs
+    pixscale_target = pixscales_target[0]
+    shape = psfs_target[0].shape
+    for psf, pixscale in zip(psfs_target, pixscales_target):
+        if psf.shape != shape or pixscale != pixscale_target:
+            print("pypher-batch: target PSFs must share the same shape "
+                  "and pixel scale")
+            sys.exit()
+
+    # Sources are rotated and resampled with a single interpolation
+    psfs_source, pixscales_source = load_psfs(args.psf_source, dtype=dtype,
+                                              ext=args.ext_source,
+                                              plane=args.plane_source)
+    psfs_source = [match_psf(psf, pixscale, pixscale_target, shape,
+                             angle=args.angle_source, method=args.resample)
+                   for psf, pixscale in zip(psfs_source, pixscales_source)]
+
+    kernels = homogenization_kernels(np.array(psfs_target),
+                                     np.array(psfs_source),
+                                     reg_fact=args.reg_fact,
+                                     cache=make_cache(args), dtype=dtype)
+
+    if args.bank is not None:
+        with KernelBank(args.bank, 'a') as bank:
+            for idx, psf_source in enumerate(args.psf_source):
+                for jdx, psf_target in enumerate(args.psf_target):
+                    pair = argparse.Namespace(psf_source=psf_source,
+                                              psf_target=psf_target,
+                                              reg_fact=args.reg_fact)
+                    append_kernel(bank, kernels[idx, jdx], pair,
+                                  pixscale_target)
+        print("pypher-batch: %d kernels saved to %s" % (kernels.shape[0] *
+                                                        kernels.shape[1],
+                                                        args.bank))
+        stop_profiler(profiler, args)
+        fftutils.save_wisdom()
+        return
+
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    for idx, psf_source in enumerate(args.psf_source):
+        for jdx, psf_target in enumerate(args.psf_target):
+            kernel_fits = kernel_filename(psf_source, psf_target,
+                                          args.outdir,
+                                          '.npy' if args.npy else '.fits')
+            pair = argparse.Namespace(psf_source=psf_source,
+                                      psf_target=psf_target,
+                                      reg_fact=args.reg_fact)
+            write_kernel(kernel_fits, kernels[idx, jdx], pair,
+                         pixscale_target, compression=args.compress,
+                         quantize=args.quantize, overwrite=True)
+
+            print("pypher-batch: Output kernel saved to %s" % kernel_fits)
+
+    stop_profiler(profiler, args)
+    fftutils.save_wisdom()
+
+
+if __name__ == '__main__':
+    main()
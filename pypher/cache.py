@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+cache.py
+--------
+Content-addressed cache for the OTFs and Wiener filters
+
+Entries are keyed by a hash of the input arrays and parameters, so that
+the same PSF deconvolved against many targets, possibly in separate
+processes sharing a cache directory, only goes through the forward
+transforms once.
+
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+def array_digest(array):
+    """
+    Hash of an array content, shape and data type
+
+    Parameters
+    ----------
+    array: `numpy.ndarray`
+        Input array
+
+    Returns
+    -------
+    digest: str
+        SHA-1 hexadecimal digest
+
+    """
+    array = np.ascontiguousarray(array)
+    sha = hashlib.sha1()
+    sha.update(str((array.shape, array.dtype.str)).encode())
+    sha.update(array.view(np.uint8).data if array.size else b'')
+    return sha.hexdigest()
+
+
+def cache_key(*parts):
+    """
+    Build a cache key from arrays and hashable parameters
+
+    Parameters
+    ----------
+    parts: str or array_like
+        Strings are hashed as is, anything else is converted to an
+        array and hashed with `array_digest`
+
+    Returns
+    -------
+    key: str
+        SHA-1 hexadecimal digest
+
+    """
+    sha = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, str):
+            part = array_digest(np.asarray(part))
+        sha.update(part.encode())
+    return sha.hexdigest()
+
+
+class OTFCache(object):
+    """
+    Two-tier LRU cache of Fourier arrays
+
+    The in-memory tier holds up to ``maxsize`` arrays. The optional
+    on-disk tier stores every entry as a ``.npy`` file in ``cache_dir``,
+    read back as a read-only memory map, and evicts the least recently
+    used files once their total size exceeds ``max_bytes``.
+
+    Parameters
+    ----------
+    maxsize: int, optional
+        Number of arrays kept in memory (default 32)
+    cache_dir: str, optional
+        Directory of the on-disk tier (default `None`: memory only)
+    max_bytes: int, optional
+        Size cap of the on-disk tier in bytes (default `None`: no cap)
+
+    Notes
+    -----
+    Cached arrays are returned read-only since they are shared between
+    calls.
+
+    """
+    def __init__(self, maxsize=32, cache_dir=None, max_bytes=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __contains__(self, key):
+        path = self._path(key)
+        return key in self._memory or (path is not None and
+                                       os.path.exists(path))
+
+    def __len__(self):
+        return len(self._memory)
+
+    def _path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """Cached array for ``key``, `None` if missing"""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+
+        path = self._path(key)
+        if path is not None:
+            try:
+                value = np.load(path, mmap_mode='r')
+            except (IOError, OSError, ValueError):
+                pass
+            else:
+                # Refresh the access time used by the eviction
+                os.utime(path, None)
+                self.hits += 1
+                self._remember(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Store ``value`` under ``key`` in both tiers"""
+        value = np.asarray(value)
+        value.flags.writeable = False
+        self._remember(key, value)
+
+        path = self._path(key)
+        if path is not None:
+            # Atomic write so that concurrent processes never read
+            # a partial file
+            handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                                suffix='.tmp')
+            with os.fdopen(handle, 'wb') as tmp_file:
+                np.save(tmp_file, value)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+
+    def fetch(self, key, compute):
+        """
+        Cached array for ``key``, computed and stored if missing
+
+        Parameters
+        ----------
+        key: str
+            Cache key, see `cache_key`
+        compute: callable
+            Function without argument returning the array
+
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """Empty both tiers"""
+        self._memory.clear()
+        for path in self._disk_entries():
+            os.remove(path)
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def _disk_entries(self):
+        if self.cache_dir is None:
+            return []
+        return [os.path.join(self.cache_dir, name)
+                for name in os.listdir(self.cache_dir)
+                if name.endswith('.npy')]
+
+    def _evict_disk(self):
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for path in self._disk_entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
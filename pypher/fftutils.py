@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+fftutils.py
+-----------
+Pluggable FFT backends for the Fourier methods of pypher
+
+All the transforms act on the last two axes of the input arrays.
+The backend is chosen with `set_backend` or, by default, with the
+environment variables
+
+    PYPHER_FFT_BACKEND   'numpy' (default), 'scipy' or 'pyfftw'
+    PYPHER_FFT_WORKERS   number of threads (default: all CPUs)
+    PYPHER_FFTW_WISDOM   pickle file holding the pyFFTW wisdom
+
+When the requested backend is not installed, `numpy.fft` is used.
+
+Whatever the backend, single precision inputs (float32 / complex64)
+give single precision outputs.
+
+"""
+from __future__ import absolute_import, print_function, division
+
+import os
+import pickle
+import warnings
+
+import numpy as np
+
+
+BACKENDS = ['numpy', 'scipy', 'pyfftw']
+
+_AXES = (-2, -1)
+
+_state = {}
+
+
+def set_backend(name=None, workers=None, wisdom=None):
+    """
+    Select the FFT backend
+
+    Parameters
+    ----------
+    name: str, optional
+        One of 'numpy', 'scipy' or 'pyfftw'
+        (default: ``PYPHER_FFT_BACKEND`` or 'numpy')
+    workers: int, optional
+        Number of threads used by the 'scipy' and 'pyfftw' backends
+        (default: ``PYPHER_FFT_WORKERS`` or the number of CPUs)
+    wisdom: str, optional
+        Path to a pickled pyFFTW wisdom file, loaded if it exists
+        (default: ``PYPHER_FFTW_WISDOM``)
+
+    Returns
+    -------
+    name: str
+        Name of the backend actually in use
+
+    """
+    if name is None:
+        name = os.environ.get('PYPHER_FFT_BACKEND', 'numpy')
+    name = name.lower()
+    if name not in BACKENDS:
+        raise ValueError("Unknown FFT backend '{0}', choose among "
+                         "{1}".format(name, BACKENDS))
+
+    if workers is None:
+        workers = int(os.environ.get('PYPHER_FFT_WORKERS',
+                                     os.cpu_count() or 1))
+    if wisdom is None:
+        wisdom = os.environ.get('PYPHER_FFTW_WISDOM')
+
+    module = None
+    if name == 'scipy':
+        try:
+            import scipy.fft as module
+        except ImportError:
+            pass
+    elif name == 'pyfftw':
+        try:
+            import pyfftw
+            import pyfftw.interfaces.numpy_fft as module
+        except ImportError:
+            pass
+        else:
+            pyfftw.interfaces.cache.enable()
+            if wisdom and os.path.exists(wisdom):
+                with open(wisdom, 'rb') as wisdom_file:
+                    pyfftw.import_wisdom(pickle.load(wisdom_file))
+
+    if name != 'numpy' and module is None:
+        warnings.warn("FFT backend '{0}' is not installed, "
+                      "falling back to numpy".format(name))
+        name = 'numpy'
+
+    if name == 'scipy':
+        kwargs = {'workers': workers}
+    elif name == 'pyfftw':
+        kwargs = {'threads': workers, 'planner_effort': 'FFTW_MEASURE'}
+    else:
+        module = np.fft
+        kwargs = {}
+
+    _state.clear()
+    _state.update(name=name, module=module, kwargs=kwargs,
+                  workers=workers, wisdom=wisdom)
+
+    return name
+
+
+def get_backend():
+    """Name of the FFT backend in use"""
+    return _backend()['name']
+
+
+def get_workers():
+    """Number of threads of the FFT backend in use"""
+    return _backend()['workers']
+
+
+def save_wisdom(filename=None):
+    """
+    Save the accumulated pyFFTW wisdom to a pickle file
+
+    Parameters
+    ----------
+    filename: str, optional
+        Output file (default: the wisdom file given to `set_backend`)
+
+    """
+    state = _backend()
+    filename = filename or state['wisdom']
+    if state['name'] != 'pyfftw' or not filename:
+        return
+
+    import pyfftw
+    with open(filename, 'wb') as wisdom_file:
+        pickle.dump(pyfftw.export_wisdom(), wisdom_file)
+
+
+def _backend():
+    """Backend state, initialized from the environment on first use"""
+    if not _state:
+        set_backend()
+    return _state
+
+
+_SINGLE = (np.dtype(np.float32), np.dtype(np.complex64))
+
+
+def _precision(output, image, real=False):
+    """Cast ``output`` to single precision if ``image`` is"""
+    if image.dtype in _SINGLE:
+        return output.astype(np.float32 if real else np.complex64,
+                             copy=False)
+    return output
+
+
+def fft2(image):
+    """2D FFT over the last two axes"""
+    state = _backend()
+    output = state['module'].fft2(image, axes=_AXES, **state['kwargs'])
+    return _precision(output, image)
+
+
+def ifft2(image):
+    """2D inverse FFT over the last two axes"""
+    state = _backend()
+    output = state['module'].ifft2(image, axes=_AXES, **state['kwargs'])
+    return _precision(output, image)
+
+
+def rfft2(image):
+    """2D real-to-complex FFT over the last two axes"""
+    state = _backend()
+    output = state['module'].rfft2(image, axes=_AXES, **state['kwargs'])
+    return _precision(output, image)
+
+
+def irfft2(image, shape):
+    """2D complex-to-real inverse FFT over the last two axes"""
+    state = _backend()
+    output = state['module'].irfft2(image, s=shape, axes=_AXES,
+                                    **state['kwargs'])
+    return _precision(output, image, real=True)
@@ -13,9 +13,15 @@ A set of convenience methods to deal with FITS files
 """
 from __future__ import absolute_import, print_function, division
 
+import os
+from collections import OrderedDict, namedtuple
+
+import numpy as np
 import astropy.io.fits as pyfits
 from astropy.io.fits import getdata, writeto
 
+from pypher.cache import array_digest
+
 
 PIXSCL_KEY_DEG = ['CD1_1', 'CD2_2', 'CDELT1', 'CDELT2']
 PIXSCL_KEY_ARCSEC = ['PIXSCALE', 'SECPIX', 'PIXSCALX', 'PIXSCALY']
@@ -56,23 +62,352 @@ def write_pixelscale(fits_file, value, ext=0):
         Extension number in the FITS file
 
     """
+    with pyfits.open(fits_file, mode='update') as hdulist:
+        _set_pixelscale(hdulist[ext].header, value)
+
+
+def update_pixelscale(fits_file, value, ext=0):
+    """
+    Write pixel scale information to a FITS file header lacking it
+
+    The file is opened once in update mode and the four CD keys are
+    flushed together. When the header padding has room for them, only
+    the header block is rewritten and the data is left untouched.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to a FITS image file
+    value: float
+        Pixel scale value in arcseconds
+    ext: int, optional
+        Extension number in the FITS file
+
+    Returns
+    -------
+    written: bool
+        `False` if the header already held pixel scale keywords
+
+    """
+    with pyfits.open(fits_file, mode='update') as hdulist:
+        header = hdulist[ext].header
+        if any(key in header for key in PIXSCL_KEYS):
+            return False
+        _set_pixelscale(header, value)
+
+    return True
+
+
+def _set_pixelscale(header, value):
+    """Set the CD matrix of a header from a pixel scale in arcseconds"""
     pixscl = value / 3600
     comment = 'Linear transformation matrix'
+    for key, key_value in [('CD1_1', pixscl), ('CD1_2', 0.0),
+                           ('CD2_1', 0.0), ('CD2_2', pixscl)]:
+        header.set(key, key_value, comment)
+
+
+def write_reg_facts(fits_file, values, ext=0):
+    """
+    Write the regularisation parameter of each kernel plane to a FITS
+    file header
+
+    The values are stored under the keys REGF1, REGF2, ... following
+    the order of the planes in the data cube.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to a FITS image file
+    values: list of float
+        Regularisation parameters of the kernel planes
+    ext: int, optional
+        Extension number in the FITS file
+
+    """
+    comment = 'Regularisation parameter of plane {0}'
+    for idx, value in enumerate(values, 1):
+        pyfits.setval(fits_file, 'REGF{0}'.format(idx), value=float(value),
+                      ext=ext, comment=comment.format(idx))
 
-    pyfits.setval(fits_file, 'CD1_1', value=pixscl, ext=ext, comment=comment)
-    pyfits.setval(fits_file, 'CD1_2', value=0.0, ext=ext, comment=comment)
-    pyfits.setval(fits_file, 'CD2_1', value=0.0, ext=ext, comment=comment)
-    pyfits.setval(fits_file, 'CD2_2', value=pixscl, ext=ext, comment=comment)
+
+COMPRESSION_TYPES = OrderedDict([('gzip', 'GZIP_2'),
+                                 ('rice', 'RICE_1'),
+                                 ('hcompress', 'HCOMPRESS_1')])
+
+
+def write_kernel(fits_file, data, pixel_scale, comments=(), reg_facts=(),
+                 cards=(), extensions=(), dtype=None, compression=None,
+                 quantize=None, overwrite=False):
+    """
+    Write a kernel image and its header to a FITS file in a single pass
+
+    The header is built in memory with the same cards as `writeto`
+    followed by `add_comments`, `write_pixelscale` and `write_reg_facts`,
+    so that the file is only opened and written once.
+
+    With ``compression``, the kernel is written in a tile-compressed
+    image extension after an empty primary HDU. Floating point kernels
+    are compressed losslessly with 'gzip', or quantized with a step of
+    ``quantize`` before the compression. A path ending in ``.npy`` gets
+    the bare array in NumPy format, and its header is written as text
+    next to it (see `npy_header_file`), read back by `get_pixscale`.
+    Extensions and compression cannot be stored in that format.
+    `read_kernel` reads back any of these formats.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to the output FITS file, or ``.npy`` file
+    data: `numpy.ndarray`
+        Kernel image or cube
+    pixel_scale: float
+        Pixel scale value in arcseconds
+    comments: str list, optional
+        Comments to add to the header
+    reg_facts: list of float, optional
+        Regularisation parameters of the kernel planes
+    cards: list of tuple, optional
+        Additional (key, value, comment) header cards
+    extensions: list of HDU, optional
+        Extensions written after the kernel
+    dtype: data-type, optional
+        Data type of the written kernel, e.g. `numpy.float32`
+        (default `None`: that of ``data``)
+    compression: str, optional
+        Tile compression algorithm, one of `COMPRESSION_TYPES`
+        (default `None`: no compression, or 'rice' with ``quantize``)
+    quantize: float, optional
+        Quantization step of the compressed kernel, the error on each
+        pixel being at most half of it (default `None`: lossless)
+    overwrite: bool, optional
+        If `True`, overwrite an existing file (default `False`)
+
+    """
+    if dtype is not None:
+        data = np.asarray(data, dtype=dtype)
+
+    if str(fits_file).endswith('.npy'):
+        if extensions or compression is not None or quantize is not None:
+            raise ValueError("WRITE_KERNEL: extensions and compression "
+                             "cannot be stored in a .npy file")
+        header_file = npy_header_file(fits_file)
+        for path in [fits_file, header_file]:
+            if os.path.exists(path) and not overwrite:
+                raise IOError("File {0} already exists.".format(path))
+        header = pyfits.Header()
+        _set_kernel_cards(header, pixel_scale, comments, reg_facts, cards)
+        np.save(fits_file, data)
+        header.totextfile(header_file, overwrite=overwrite)
+        return
+
+    if quantize is not None and compression is None:
+        compression = 'rice'
+
+    if compression is None:
+        hdu = pyfits.PrimaryHDU(data=data)
+        hdus = [hdu]
+    else:
+        hdu = _compressed_hdu(data, compression, quantize)
+        hdus = [pyfits.PrimaryHDU(), hdu]
+    _set_kernel_cards(hdu.header, pixel_scale, comments, reg_facts, cards)
+
+    if len(hdus) > 1 or extensions:
+        hdu = pyfits.HDUList(hdus + list(extensions))
+    hdu.writeto(fits_file, overwrite=overwrite)
+
+
+def _set_kernel_cards(header, pixel_scale, comments=(), reg_facts=(),
+                      cards=()):
+    """Add the comments, pixel scale and cards of a kernel to a header"""
+    for value in comments:
+        header.add_comment(value)
+
+    _set_pixelscale(header, pixel_scale)
+
+    comment = 'Regularisation parameter of plane {0}'
+    for idx, value in enumerate(reg_facts, 1):
+        header.set('REGF{0}'.format(idx), float(value), comment.format(idx))
+
+    for key, value, card_comment in cards:
+        header.set(key, value, card_comment)
+
+
+def npy_header_file(npy_file):
+    """Path of the text header written next to a ``.npy`` kernel"""
+    return os.path.splitext(npy_file)[0] + '.hdr'
+
+
+def _compressed_hdu(data, compression, quantize=None):
+    """Tile-compressed image HDU, lossless unless ``quantize`` is given"""
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError("Unknown compression {0}, expected one of "
+                         "{1}.".format(compression,
+                                       list(COMPRESSION_TYPES)))
+
+    floating = np.issubdtype(np.asarray(data).dtype, np.floating)
+    if quantize is None:
+        if floating and compression != 'gzip':
+            raise ValueError("Lossless compression of floating point "
+                             "kernels requires 'gzip'.")
+        # A null level disables the quantization of floating point data
+        quantize_level = 0.0
+    else:
+        # A negative level is an absolute quantization step
+        quantize_level = -abs(quantize)
+
+    return pyfits.CompImageHDU(data=data,
+                               compression_type=COMPRESSION_TYPES[compression],
+                               quantize_level=quantize_level)
+
+
+def read_kernel(fits_file, ext=None):
+    """
+    Read a kernel written by `write_kernel` in any of its formats
+
+    Plain and tile-compressed FITS files are told apart by the HDU
+    holding the data, and ``.npy`` files by their extension. Plain FITS
+    and ``.npy`` kernels are memory-mapped.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to the kernel file
+    ext: int or str, optional
+        FITS extension of the kernel (default `None`: first HDU holding
+        data)
+
+    Returns
+    -------
+    kernel: `numpy.ndarray`
+        Kernel image or cube
+
+    """
+    if str(fits_file).endswith('.npy'):
+        return np.load(fits_file, mmap_mode='r')
+
+    with _open_image(fits_file, ext) as hdulist:
+        data = _data_hdu(hdulist, ext).data
+
+    if data is None:
+        raise IOError("No image data found in {0}.".format(fits_file))
+
+    return data
+
+
+def _data_hdu(hdulist, ext=None):
+    """HDU ``ext``, or by default the first HDU holding data"""
+    if ext is None:
+        ext = 0
+        # Tested on the header, which does not load the data
+        if not hdulist[0].header.get('NAXIS') and len(hdulist) > 1:
+            ext = 1
+    return hdulist[ext]
+
+
+def _bitpix_dtype(bitpix):
+    """Big-endian data type of a FITS image BITPIX"""
+    kind = 'f' if bitpix < 0 else ('u' if bitpix == 8 else 'i')
+    return np.dtype('>{0}{1}'.format(kind, abs(bitpix) // 8))
+
+
+def _is_scaled(header):
+    """`True` if the image of a header is scaled by BSCALE / BZERO or has
+    BLANK values, which astropy cannot memory-map"""
+    return (header.get('BSCALE', 1) != 1 or header.get('BZERO', 0) != 0 or
+            'BLANK' in header)
+
+
+def _open_image(fits_file, ext=None):
+    """
+    Open a FITS file memory-mapped, unless the image of the data HDU
+    ``ext`` is scaled, in which case it is opened without memory map
+    and the image only read when accessed
+
+    """
+    hdulist = pyfits.open(fits_file, memmap=True)
+    if _is_scaled(_data_hdu(hdulist, ext).header):
+        hdulist.close()
+        hdulist = pyfits.open(fits_file, memmap=False)
+    return hdulist
+
+
+SEPARABLE_EXTNAMES = ('SEP_Y', 'SEP_X')
+
+
+def separable_hdus(vertical, horizontal, residual):
+    """
+    FITS extensions holding the separable components of a kernel
+
+    Parameters
+    ----------
+    vertical: `numpy.ndarray`
+        Filters along y, of shape (..., r, ny)
+    horizontal: `numpy.ndarray`
+        Filters along x, of shape (..., r, nx)
+    residual: float or `numpy.ndarray`
+        Relative residual of the decomposition, the largest one being
+        stored under the SEPRESID key
+
+    Returns
+    -------
+    hdus: list of `astropy.io.fits.ImageHDU`
+        ``SEP_Y`` and ``SEP_X`` extensions, see `read_separable`
+
+    """
+    hdus = [pyfits.ImageHDU(data=filters, name=name)
+            for filters, name in zip([vertical, horizontal],
+                                     SEPARABLE_EXTNAMES)]
+    for hdu in hdus:
+        hdu.header['SEPRANK'] = (vertical.shape[-2],
+                                 'Number of separable components')
+        hdu.header['SEPRESID'] = (float(np.max(residual)),
+                                  'Relative residual of the components')
+    return hdus
+
+
+def read_separable(fits_file):
+    """
+    Read the separable components of a kernel
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to a kernel written with separable components
+
+    Returns
+    -------
+    vertical: `numpy.ndarray`
+        Filters along y, of shape (..., r, ny)
+    horizontal: `numpy.ndarray`
+        Filters along x, of shape (..., r, nx)
+    residual: float
+        Largest relative residual of the decomposition
+
+    """
+    with pyfits.open(fits_file) as hdulist:
+        if SEPARABLE_EXTNAMES[0] not in hdulist:
+            raise IOError("No separable components found in "
+                          "{0}.".format(fits_file))
+        vertical, horizontal = [hdulist[name].data.copy()
+                                for name in SEPARABLE_EXTNAMES]
+        residual = hdulist[SEPARABLE_EXTNAMES[0]].header['SEPRESID']
+
+    return vertical, horizontal, residual
 
 
 def get_pixscale(fits_file):
     """
     Retreive the image pixel scale from its FITS header
 
+    The header of the first HDU holding data is searched first, so that
+    tile-compressed images are handled, then the primary header. For a
+    ``.npy`` kernel, the text header written next to it is read.
+
     Parameters
     ----------
     fits_file: str
-        Path to a FITS image file
+        Path to a FITS image file, or ``.npy`` kernel
 
     Returns
     -------
@@ -80,13 +415,35 @@ def get_pixscale(fits_file):
         The pixel scale of the image in arcseconds
 
     """
-    pixel_keys = has_pixelscale(fits_file)
+    if str(fits_file).endswith('.npy'):
+        header_file = npy_header_file(fits_file)
+        if not os.path.exists(header_file):
+            raise IOError("Pixel scale not found in {0}.".format(fits_file))
+        return _header_pixscale(pyfits.Header.fromtextfile(header_file),
+                                fits_file)
+
+    with pyfits.open(fits_file) as hdulist:
+        header = _pixscale_header(hdulist, _data_hdu(hdulist))
+
+    return _header_pixscale(header, fits_file)
+
+
+def _pixscale_header(hdulist, hdu):
+    """Header of ``hdu`` if it holds a pixel scale, else the primary one"""
+    if any(key in hdu.header for key in PIXSCL_KEYS):
+        return hdu.header
+    return hdulist[0].header
+
+
+def _header_pixscale(header, fits_file):
+    """Pixel scale in arcseconds from an already loaded header"""
+    pixel_keys = [key for key in PIXSCL_KEYS if key in header]
 
     if not pixel_keys:
         raise IOError("Pixel scale not found in {0}.".format(fits_file))
 
     pixel_key = pixel_keys.pop()
-    pixel_scale = abs(pyfits.getval(fits_file, pixel_key))
+    pixel_scale = abs(header[pixel_key])
 
     if pixel_key in PIXSCL_KEY_DEG:
         pixel_scale *= 3600
@@ -94,6 +451,117 @@ def get_pixscale(fits_file):
     return round(pixel_scale, 6)
 
 
+PSFFile = namedtuple('PSFFile', ['data', 'pixel_scale', 'shape', 'checksum',
+                                 'dtype'])
+PSFFile.__doc__ = """\
+PSF image and metadata read from a FITS file by `read_psf`
+
+Attributes
+----------
+data: `numpy.ndarray`
+    Read-only image array, memory-mapped when the file allows it
+pixel_scale: float
+    Pixel scale in arcseconds
+shape: tuple of int
+    Shape of the image
+checksum: str
+    SHA-1 digest of the image, see `pypher.cache.array_digest`
+dtype: `numpy.dtype`
+    Data type of the image
+"""
+
+PSF_CACHE_SIZE = 16
+
+_psf_cache = OrderedDict()
+
+
+def read_psf(fits_file, ext=None, plane=None, cache=True):
+    """
+    Read a PSF image and its metadata opening the FITS file only once
+
+    The image is taken from the extension ``ext`` or by default from the
+    first HDU holding data, as with `getdata`. The pixel scale is read
+    from the header of that HDU, or from the primary header if it holds
+    no pixel scale keyword.
+
+    The data is memory-mapped, so that selecting one extension of a
+    multi-extension file or one ``plane`` of a PSF cube does not read
+    the rest of the file. Scaled images (BSCALE, BZERO or BLANK
+    keywords) cannot be memory-mapped and are read in full.
+
+    The metadata of the last `PSF_CACHE_SIZE` PSFs read (pixel scale,
+    shape, data type and checksum) is cached in the process, keyed by
+    their path, modification time, size and selection, so that reading
+    a PSF library several times only hashes each image once. The image
+    itself is not cached, so that the cache neither holds memory nor
+    keeps files open. It is emptied by `clear_psf_cache` and disabled by
+    setting `PSF_CACHE_SIZE` to 0.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to a FITS image file
+    ext: int or str, optional
+        Extension number or name of the PSF (default `None`: first HDU
+        holding data)
+    plane: int, optional
+        Index of the PSF along the first axis of a 3D cube
+        (default `None`: the whole array)
+    cache: bool, optional
+        If `False`, bypass the cache (default `True`)
+
+    Returns
+    -------
+    psf_file: `PSFFile`
+        Image, pixel scale, shape, checksum and data type
+
+    """
+    cache = cache and PSF_CACHE_SIZE > 0
+
+    stat = os.stat(fits_file)
+    key = (os.path.abspath(fits_file), stat.st_mtime_ns, stat.st_size,
+           ext, plane)
+    metadata = _psf_cache.get(key) if cache else None
+    if metadata is not None:
+        _psf_cache.move_to_end(key)
+
+    with _open_image(fits_file, ext) as hdulist:
+        hdu = _data_hdu(hdulist, ext)
+        data = hdu.data
+
+        if data is None:
+            raise IOError("No image data found in {0}.".format(fits_file))
+
+        if plane is not None:
+            if data.ndim != 3:
+                raise ValueError("Cannot select plane {0} of the {1}D image "
+                                 "in {2}.".format(plane, data.ndim,
+                                                  fits_file))
+            data = data[plane]
+
+        if metadata is None:
+            pixel_scale = _header_pixscale(_pixscale_header(hdulist, hdu),
+                                           fits_file)
+
+    data = data.view()
+    data.flags.writeable = False
+
+    if metadata is None:
+        metadata = PSFFile(None, pixel_scale, data.shape, array_digest(data),
+                           data.dtype)
+        if cache:
+            _psf_cache[key] = metadata
+            while len(_psf_cache) > PSF_CACHE_SIZE:
+                _psf_cache.popitem(last=False)
+
+    return metadata._replace(data=data)
+
+
+def clear_psf_cache():
+    """Empty the cache of `read_psf`"""
+    _psf_cache.clear()
+
+
 def clear_comments(fits_file):
     """
     Delete the COMMENTS in the FITS header
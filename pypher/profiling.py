@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+profiling.py
+------------
+Timing and memory instrumentation of the pipeline stages
+
+The stages of the pipeline (load, rotate, resample, wiener, write, ...)
+are wrapped with `profiled` or `stage`. When no hook is registered,
+which is the default, a profiled call costs a single test of an empty
+list. Once a hook is registered with `add_hook`, or a `Profiler` is
+started, every stage calls the hooks with a record of its wall time,
+CPU time, memory allocations and array sizes.
+
+The memory of a stage is measured with `tracemalloc`, which numpy
+reports its arrays to, as the peak and net bytes allocated during the
+stage. A `Profiler` starts tracing while it runs; with hooks alone,
+the memory is only measured if tracing was started by the caller.
+Stages called within other stages are marked by their ``depth``.
+
+"""
+from __future__ import absolute_import, print_function, division
+
+import sys
+import json
+import time
+import functools
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+_hooks = []
+
+# Stages being measured, innermost last
+_active = []
+
+
+def add_hook(callback):
+    """
+    Register a callback receiving the record of every stage
+
+    Parameters
+    ----------
+    callback: callable
+        Function called with a dict holding the ``stage`` name, the
+        ``function`` name, the ``depth`` of the stage (0 if not called
+        within another stage), the ``wall`` and ``cpu`` times in
+        seconds, the ``alloc_peak`` and ``alloc_net`` bytes allocated
+        during the stage at its peak and at its end (`None` if
+        `tracemalloc` is not tracing) and the ``arrays`` shapes, data
+        types and sizes
+
+    """
+    _hooks.append(callback)
+
+
+def remove_hook(callback):
+    """Unregister a callback added with `add_hook`"""
+    _hooks.remove(callback)
+
+
+def enabled():
+    """`True` if any hook is registered"""
+    return bool(_hooks)
+
+
+def max_rss():
+    """
+    High-water mark of the resident memory of the process in bytes, over
+    its whole lifetime (`None` if unknown)
+
+    """
+    if resource is None:  # pragma: no cover
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _describe(arrays):
+    """Shape, data type and size of the arrays among named values"""
+    return OrderedDict(
+        (name, {'shape': list(value.shape), 'dtype': value.dtype.str,
+                'nbytes': int(value.nbytes)})
+        for name, value in arrays.items()
+        if isinstance(value, np.ndarray))
+
+
+class _NullStage(object):
+    """Stage doing nothing, returned when no hook is registered"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **arrays):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """Stage measuring its block and calling the hooks on exit"""
+    def __init__(self, name, function=None, arrays=None):
+        self.record = OrderedDict([('stage', name), ('function', function),
+                                   ('depth', len(_active))])
+        self.arrays = OrderedDict(arrays or {})
+        self._traced = None
+        self._peak = 0
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if _active:
+                # The peak is reset below, so the enclosing stage keeps
+                # its own peak so far
+                _active[-1]._peak = max(_active[-1]._peak, peak)
+            tracemalloc.reset_peak()
+            self._traced = self._peak = current
+        _active.append(self)
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.record['wall'] = time.perf_counter() - self._wall
+        self.record['cpu'] = time.process_time() - self._cpu
+        _active.pop()
+
+        self.record['alloc_peak'] = self.record['alloc_net'] = None
+        if self._traced is not None and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self._peak = max(self._peak, peak)
+            if _active:
+                _active[-1]._peak = max(_active[-1]._peak, self._peak)
+            self.record['alloc_peak'] = self._peak - self._traced
+            self.record['alloc_net'] = current - self._traced
+
+        self.record['arrays'] = _describe(self.arrays)
+        for callback in list(_hooks):
+            callback(self.record)
+        return False
+
+    def add(self, **arrays):
+        """Record the size of arrays produced by the stage"""
+        self.arrays.update(arrays)
+
+
+def stage(name, **arrays):
+    """
+    Context manager measuring a block of code as a pipeline stage
+
+    Parameters
+    ----------
+    name: str
+        Name of the stage
+    arrays:
+        Input arrays of the stage, whose sizes are recorded
+
+    Returns
+    -------
+    stage: context manager
+        Its ``add`` method records output arrays. When no hook is
+        registered, a shared object doing nothing is returned.
+
+    Examples
+    --------
+    >>> with stage('normalize', psf=psf) as current:
+    ...     psf = psf / psf.sum()
+    ...     current.add(output=psf)
+
+    """
+    if not _hooks:
+        return _NULL_STAGE
+    return _Stage(name, arrays=arrays)
+
+
+def profiled(name):
+    """
+    Decorator measuring every call of a function as a pipeline stage
+
+    The arrays among the positional arguments and the return values
+    are recorded as ``arg0``, ``arg1``, ... and ``out0``, ``out1``, ...
+
+    Parameters
+    ----------
+    name: str
+        Name of the stage
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _hooks:
+                return func(*args, **kwargs)
+
+            arrays = OrderedDict(('arg{0}'.format(idx), value)
+                                 for idx, value in enumerate(args))
+            with _Stage(name, func.__name__, arrays) as current:
+                result = func(*args, **kwargs)
+                outputs = result if isinstance(result, tuple) else (result,)
+                current.add(**OrderedDict(('out{0}'.format(idx), value)
+                                          for idx, value
+                                          in enumerate(outputs)))
+            return result
+        return wrapper
+    return decorator
+
+
+class Profiler(object):
+    """
+    Collect the records of the pipeline stages
+
+    `tracemalloc` is started with the profiler, unless it was already
+    tracing, and stopped with it.
+
+    Examples
+    --------
+    >>> with Profiler() as profiler:
+    ...     kernel, _ = homogenization_kernel(psf_target, psf_source)
+    >>> profiler.write('report.json')
+
+    """
+    def __init__(self):
+        self.records = []
+        self._wall = None
+        self._cpu = None
+        self._elapsed = (0.0, 0.0)
+        self._tracing = False
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def start(self):
+        """Register the profiler as a hook"""
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        add_hook(self)
+
+    def stop(self):
+        """Unregister the profiler"""
+        remove_hook(self)
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        self._elapsed = (time.perf_counter() - self._wall,
+                         time.process_time() - self._cpu)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def summary(self):
+        """
+        Number of calls and total times of each stage
+
+        Only the stages not called within another stage are counted, so
+        that the time of nested stages is not counted twice.
+
+        """
+        summary = OrderedDict()
+        for record in self.records:
+            if record['depth']:
+                continue
+            total = summary.setdefault(record['stage'],
+                                       OrderedDict([('calls', 0),
+                                                    ('wall', 0.0),
+                                                    ('cpu', 0.0)]))
+            total['calls'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+        return summary
+
+    def report(self):
+        """
+        Machine-readable report of the profiled run
+
+        Returns
+        -------
+        report: dict
+            The ``wall`` and ``cpu`` times between `start` and `stop`,
+            the lifetime ``max_rss`` of the process, the ``summary`` per
+            stage and the ``stages`` records in call order, see
+            `add_hook`
+
+        """
+        return OrderedDict([('wall', self._elapsed[0]),
+                            ('cpu', self._elapsed[1]),
+                            ('max_rss', max_rss()),
+                            ('summary', self.summary()),
+                            ('stages', self.records)])
+
+    def write(self, json_file):
+        """Write the report to a JSON file"""
+        with open(json_file, 'w') as output:
+            json.dump(self.report(), output, indent=1)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015 IAS / CNRS / Univ. Paris-Sud
+# BSD License - see attached LICENSE file
+# Author: Alexandre Boucaud <alexandre.boucaud@ias.u-psud.fr>
+
+"""
+psfgrid.py
+----------
+Spatially varying homogenization kernels
+
+The kernels computed between pairs of source and target PSFs sampled
+on a grid of positions across the field are compressed into a mean
+kernel and a few eigen-kernels, whose weights are fitted with
+polynomials of the position. A kernel anywhere in the field is then
+rebuilt with a handful of array products.
+
+"""
+from __future__ import absolute_import, print_function, division
+
+import numpy as np
+import astropy.io.fits as pyfits
+
+from pypher.pypher import homogenization_kernels
+
+
+def _monomials(x, y, degree):
+    """Monomials x**i * y**j with i + j <= degree, one column each"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    return np.stack([x**(total - j) * y**j
+                     for total in range(degree + 1)
+                     for j in range(total + 1)], axis=-1)
+
+
+class KernelField(object):
+    r"""
+    Homogenization kernel varying across the field
+
+    The kernel at position (x, y) reads
+
+    .. math:: K(x, y) = \bar{K} + \sum_c a_c(x, y) E_c
+
+    with $\bar{K}$ the mean kernel, $E_c$ the eigen-kernels and
+    $a_c$ polynomials of the position.
+
+    Parameters
+    ----------
+    mean: `numpy.ndarray`
+        Mean kernel, 2D array
+    eigen_kernels: `numpy.ndarray`
+        3D array of shape (n_components, ny, nx)
+    poly_coeffs: `numpy.ndarray`
+        2D array of shape (n_terms, n_components) of the polynomial
+        coefficients of the eigen-kernel weights
+    degree: int
+        Degree of the polynomials
+    center: tuple of float
+        Position mapped to (0, 0) before evaluating the polynomials
+    scale: tuple of float
+        Scale of the positions along x and y, mapping the grid to
+        about [-1, 1]
+
+    See Also
+    --------
+    KernelField.from_psfs, KernelField.from_kernels
+
+    """
+    def __init__(self, mean, eigen_kernels, poly_coeffs, degree,
+                 center=(0.0, 0.0), scale=(1.0, 1.0)):
+        self.mean = np.asarray(mean)
+        self.eigen_kernels = np.asarray(eigen_kernels)
+        self.poly_coeffs = np.asarray(poly_coeffs)
+        self.degree = int(degree)
+        self.center = tuple(float(value) for value in center)
+        self.scale = tuple(float(value) for value in scale)
+
+    @property
+    def shape(self):
+        """Shape of the kernels"""
+        return self.mean.shape
+
+    @property
+    def n_components(self):
+        """Number of eigen-kernels"""
+        return len(self.eigen_kernels)
+
+    @classmethod
+    def from_kernels(cls, kernels, x, y, n_components=None, tol=1e-6,
+                     degree=2):
+        """
+        Compress a set of kernels sampled across the field
+
+        Parameters
+        ----------
+        kernels: `numpy.ndarray`
+            3D array of shape (N, ny, nx)
+        x, y: array_like
+            Positions of the N kernels
+        n_components: int, optional
+            Number of eigen-kernels kept (default `None`: set by ``tol``)
+        tol: float, optional
+            Largest fraction of the kernel variance around the mean left
+            out of the eigen-kernels, used when ``n_components`` is
+            `None` (default 1e-6)
+        degree: int, optional
+            Degree of the polynomials of the position (default 2)
+
+        Returns
+        -------
+        field: `KernelField`
+
+        """
+        kernels = np.asarray(kernels)
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        n_kernels = len(kernels)
+        n_terms = (degree + 1) * (degree + 2) // 2
+        if kernels.ndim != 3 or x.shape != (n_kernels,) or \
+                y.shape != (n_kernels,):
+            raise ValueError("KERNELFIELD: expected N 2D kernels and "
+                             "N positions")
+        if n_kernels < n_terms:
+            raise ValueError("KERNELFIELD: {0} positions cannot constrain "
+                             "polynomials of degree {1}".format(n_kernels,
+                                                                degree))
+
+        mean = kernels.mean(axis=0)
+        centered = (kernels - mean).reshape(n_kernels, -1)
+        left, singular, right = np.linalg.svd(centered, full_matrices=False)
+
+        if n_components is None:
+            power = singular**2
+            # Fraction of the variance left out when keeping c components
+            left_out = 1 - np.cumsum(power) / max(power.sum(), 1e-300)
+            n_components = int(np.argmax(left_out <= tol)) + 1
+        n_components = min(n_components, len(singular))
+
+        eigen_kernels = right[:n_components].reshape((n_components,) +
+                                                     mean.shape)
+        weights = left[:, :n_components] * singular[:n_components]
+
+        center = ((x.max() + x.min()) / 2, (y.max() + y.min()) / 2)
+        scale = ((x.max() - x.min()) / 2 or 1.0,
+                 (y.max() - y.min()) / 2 or 1.0)
+        field = cls(mean, eigen_kernels, np.zeros((n_terms, n_components)),
+                    degree, center, scale)
+
+        field.poly_coeffs = np.linalg.lstsq(field._design(x, y), weights,
+                                            rcond=None)[0]
+
+        return field
+
+    @classmethod
+    def from_psfs(cls, psfs_target, psfs_source, x, y, reg_fact=1e-4,
+                  clip=True, cache=None, dtype=np.float64, **kwargs):
+        """
+        Compute and compress the kernels between pairs of PSFs
+
+        The source PSFs must already be on the grid of the target PSFs,
+        see `pypher.pypher.match_psf`. The kernels are computed with
+        `pypher.pypher.homogenization_kernels` in pairwise mode.
+
+        Parameters
+        ----------
+        psfs_target: `numpy.ndarray`
+            3D array of shape (N, ny, nx)
+        psfs_source: `numpy.ndarray`
+            3D array of shape (N, ny, nx)
+        x, y: array_like
+            Positions of the N pairs of PSFs
+        reg_fact: float, optional
+            Regularisation parameter for the Wiener filter
+        clip: bool, optional
+            If `True`, enforces the non-amplification of the noise
+            (default `True`)
+        cache: `pypher.cache.OTFCache`, optional
+            Cache of the source OTFs and Wiener filters (default `None`)
+        dtype: data-type, optional
+            Real precision of the computation (default `numpy.float64`)
+        kwargs:
+            ``n_components``, ``tol`` and ``degree`` passed to
+            `KernelField.from_kernels`
+
+        Returns
+        -------
+        field: `KernelField`
+
+        """
+        kernels = homogenization_kernels(psfs_target, psfs_source,
+                                         reg_fact=reg_fact, clip=clip,
+                                         cache=cache, dtype=dtype,
+                                         pairwise=True)
+
+        return cls.from_kernels(kernels, x, y, **kwargs)
+
+    def _design(self, x, y):
+        """Monomials of the normalized positions"""
+        x = (np.asarray(x, dtype=float) - self.center[0]) / self.scale[0]
+        y = (np.asarray(y, dtype=float) - self.center[1]) / self.scale[1]
+        return _monomials(x, y, self.degree)
+
+    def coefficients(self, x, y):
+        """
+        Weights of the eigen-kernels at given positions
+
+        Parameters
+        ----------
+        x, y: float or array_like
+            Positions in the field
+
+        Returns
+        -------
+        weights: `numpy.ndarray`
+            Array of shape ``np.shape(x) + (n_components,)``
+
+        """
+        return np.dot(self._design(x, y), self.poly_coeffs)
+
+    def kernel(self, x, y):
+        """
+        Kernel at given positions
+
+        Parameters
+        ----------
+        x, y: float or array_like
+            Positions in the field
+
+        Returns
+        -------
+        kernel: `numpy.ndarray`
+            2D kernel, or array of shape ``np.shape(x) + (ny, nx)`` for
+            arrays of positions
+
+        """
+        weights = self.coefficients(x, y)
+        return self.mean + np.tensordot(weights, self.eigen_kernels,
+                                        axes=1)
+
+    def writeto(self, fits_file, overwrite=False):
+        """
+        Write the kernel field to a FITS file
+
+        The primary HDU holds the mean kernel, the ``EIGEN`` extension
+        the eigen-kernels and the ``POLY`` extension the polynomial
+        coefficients.
+
+        Parameters
+        ----------
+        fits_file: str
+            Path to the output FITS file
+        overwrite: bool, optional
+            If `True`, overwrite an existing file (default `False`)
+
+        """
+        primary = pyfits.PrimaryHDU(self.mean)
+        header = primary.header
+        header['DEGREE'] = (self.degree, 'Degree of the position polynomials')
+        header['XCENTER'] = (self.center[0], 'Center of the positions in x')
+        header['YCENTER'] = (self.center[1], 'Center of the positions in y')
+        header['XSCALE'] = (self.scale[0], 'Scale of the positions in x')
+        header['YSCALE'] = (self.scale[1], 'Scale of the positions in y')
+
+        hdulist = pyfits.HDUList([
+            primary,
+            pyfits.ImageHDU(self.eigen_kernels, name='EIGEN'),
+            pyfits.ImageHDU(self.poly_coeffs, name='POLY')])
+        hdulist.writeto(fits_file, overwrite=overwrite)
+
+    @classmethod
+    def read(cls, fits_file):
+        """
+        Read a kernel field written by `KernelField.writeto`
+
+        Parameters
+        ----------
+        fits_file: str
+            Path to the FITS file
+
+        Returns
+        -------
+        field: `KernelField`
+
+        """
+        with pyfits.open(fits_file) as hdulist:
+            header = hdulist[0].header
+            return cls(hdulist[0].data.copy(),
+                       hdulist['EIGEN'].data.copy(),
+                       hdulist['POLY'].data.copy(),
+                       header['DEGREE'],
+                       (header['XCENTER'], header['YCENTER']),
+                       (header['XSCALE'], header['YSCALE']))
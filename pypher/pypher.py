@@ -13,11 +13,21 @@ Compute the homogenization kernel between two PSFs
 
 Usage:
   pypher psf_source psf_target output
-         [-s ANGLE_SOURCE] [-t ANGLE_TARGET] [-r REG_FACT]
+         [-s ANGLE_SOURCE] [-t ANGLE_TARGET]
+         [--ext_source EXT] [--ext_target EXT]
+         [--plane_source N] [--plane_target N]
+         [-r REG_FACT [REG_FACT ...]]
+         [--resample {spline,fourier}] [--auto-reg {gcv,lcurve}]
+         [--fft-backend BACKEND] [--fft-workers N] [--float32] [--fast-fft]
+         [--energy FRACTION] [--separable TOL]
+         [--cache-dir DIR] [--cache-size MB]
+         [--compress {gzip,rice,hcompress}] [--quantize STEP] [--npy]
+         [--bank FILE] [--profile REPORT]
   pypher (-h | --help)
 
 Example:
   pypher psf_a.fits psf_b.fits kernel_a_to_b.fits -r 1.e-5
+  pypher psf_a.fits psf_b.fits kernel_cube.fits -r 1.e-6 1.e-5 1.e-4
 """
 from __future__ import absolute_import, print_function, division
 
@@ -26,11 +36,16 @@ import sys
 import logging
 import logging.handlers
 import argparse
+import warnings
 import numpy as np
 
-from scipy.ndimage import rotate, zoom
+from scipy.ndimage import rotate, zoom, affine_transform
 
 from pypher import fitsutils as fits
+from pypher import fftutils
+from pypher.bank import KernelBank
+from pypher.cache import OTFCache, cache_key
+from pypher.profiling import Profiler, profiled
 from pypher.parser import ThrowingArgumentParser, ArgumentParserError
 
 __version__ = '0.7.1'
@@ -58,16 +73,299 @@ def parse_args():
     parser.add_argument('-t', '--angle_target', type=float, default=0.0,
                         help="Rotation angle to apply to `psf_target` (deg)")
 
-    parser.add_argument('-r', '--reg_fact', type=float, default=1.e-4,
-                        help="Regularisation parameter for the Wiener filter")
+    add_selection_arguments(parser)
+
+    parser.add_argument('-r', '--reg_fact', type=float, nargs='+',
+                        default=[1.e-4],
+                        help="Regularisation parameter for the Wiener filter,"
+                             " several values produce a kernel cube")
+
+    parser.add_argument('--resample', type=str, default='spline',
+                        choices=RESAMPLE_METHODS,
+                        help="Resampling method of the source PSF")
+
+    parser.add_argument('--auto-reg', type=str, default=None,
+                        choices=REG_METHODS,
+                        help="Select the regularisation parameter with "
+                             "generalized cross-validation or the L-curve "
+                             "(overrides `reg_fact`)")
+
+    parser.add_argument('--fast-fft', action='store_true',
+                        help="Zero-pad the FFTs to 5-smooth lengths")
+
+    parser.add_argument('--energy', type=float, default=None,
+                        help="Crop the PSFs and the kernel to the support "
+                             "enclosing this fraction of their energy "
+                             "(default: no cropping)")
+
+    parser.add_argument('--separable', type=float, default=None,
+                        metavar='TOL',
+                        help="Also write the separable components of the "
+                             "kernel meeting this relative residual "
+                             "(default: none)")
+
+    add_fft_arguments(parser)
+    add_cache_arguments(parser)
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
+
+    return check_output_arguments(parser, parser.parse_args())
+
+
+def add_selection_arguments(parser):
+    """Add the PSF extension and plane options to a command line parser"""
+    for psf in ['source', 'target']:
+        parser.add_argument('--ext_{0}'.format(psf), type=_extension,
+                            default=None,
+                            help="FITS extension number or name of the {0} "
+                                 "PSF (default: first extension with "
+                                 "data)".format(psf))
+
+        parser.add_argument('--plane_{0}'.format(psf), type=int,
+                            default=None,
+                            help="Plane of the {0} PSF in a 3D cube "
+                                 "(default: none)".format(psf))
+
+
+def _extension(value):
+    """FITS extension given on the command line, as a number or a name"""
+    return int(value) if value.isdigit() else value
+
+
+def add_fft_arguments(parser, product='kernel'):
+    """Add the FFT backend options to a command line parser, ``product``
+    naming the output saved in single precision with ``--float32``"""
+    parser.add_argument('--fft-backend', type=str, default=None,
+                        choices=fftutils.BACKENDS,
+                        help="FFT backend (default: $PYPHER_FFT_BACKEND "
+                             "or numpy)")
+
+    parser.add_argument('--fft-workers', type=int, default=None,
+                        help="Number of FFT threads (default: "
+                             "$PYPHER_FFT_WORKERS or all CPUs)")
+
+    parser.add_argument('--float32', action='store_true',
+                        help="Compute and save the {0} in single "
+                             "precision".format(product))
+
+
+def add_cache_arguments(parser):
+    """Add the OTF cache options to a command line parser"""
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help="Directory of a persistent cache of the OTFs "
+                             "and Wiener filters shared between runs")
+
+    parser.add_argument('--cache-size', type=float, default=None,
+                        help="Size cap of the cache directory in MB "
+                             "(default: no cap)")
+
+
+def add_output_arguments(parser):
+    """Add the kernel file format options to a command line parser"""
+    parser.add_argument('--compress', type=str, default=None,
+                        choices=list(fits.COMPRESSION_TYPES),
+                        help="Write tile-compressed FITS kernels, lossless "
+                             "with gzip unless --quantize is given "
+                             "(default: no compression)")
+
+    parser.add_argument('--quantize', type=float, default=None,
+                        metavar='STEP',
+                        help="Quantization step of the compressed kernels "
+                             "(default: lossless)")
+
+    parser.add_argument('--npy', action='store_true',
+                        help="Write the kernels as .npy arrays, their "
+                             "header going to a .hdr text file next to "
+                             "them; cannot be combined with --compress, "
+                             "--quantize or --separable")
+
+    parser.add_argument('--bank', type=str, default=None,
+                        help="Append the kernels to a kernel bank file "
+                             "instead of writing one file per kernel, "
+                             "concurrent runs on the same bank waiting "
+                             "for each other; cannot be combined with "
+                             "--compress, --quantize, --separable or --npy")
+
+
+def check_output_arguments(parser, args):
+    """Reject the options whose output a .npy kernel or a bank cannot hold"""
+    if args.npy:
+        for option in ['compress', 'quantize', 'separable']:
+            if getattr(args, option, None) is not None:
+                parser.error("--npy cannot be combined with "
+                             "--{0}".format(option))
+    if args.bank is not None:
+        for option in ['compress', 'quantize', 'separable', 'npy']:
+            if getattr(args, option, None) not in (None, False):
+                parser.error("--bank cannot be combined with "
+                             "--{0}".format(option))
+    return args
+
+
+def add_profile_arguments(parser):
+    """Add the profiling option to a command line parser"""
+    parser.add_argument('--profile', type=str, default=None,
+                        metavar='REPORT',
+                        help="Write the time and memory used by each stage "
+                             "to a JSON report (default: no profiling)")
+
+
+def start_profiler(args):
+    """`pypher.profiling.Profiler` started if ``--profile`` is given"""
+    if args.profile is None:
+        return None
+
+    profiler = Profiler()
+    profiler.start()
+    return profiler
+
+
+def stop_profiler(profiler, args):
+    """Stop a profiler from `start_profiler` and write its report"""
+    if profiler is None:
+        return
+
+    profiler.stop()
+    profiler.write(args.profile)
+
+
+def make_cache(args):
+    """OTF cache from the parsed command line options"""
+    if args.cache_dir is None:
+        return None
+
+    max_bytes = None
+    if args.cache_size is not None:
+        max_bytes = int(args.cache_size * 2**20)
+
+    return OTFCache(cache_dir=args.cache_dir, max_bytes=max_bytes)
 
-    return parser.parse_args()
 
 ################
 # IMAGE METHODS
 ################
 
 
+def kernel_comments(args):
+    """
+    Header comments recording the input parameters of pypher
+
+    Parameters
+    ----------
+    args: `argparse.Namespace`
+        Container for the parsed values
+
+    Returns
+    -------
+    comments: str list
+        Comment lines with the name of the PSF files and the
+        regularisation parameters
+
+    """
+    reg_facts = np.atleast_1d(args.reg_fact)
+    if reg_facts.size == 1:
+        reg_comments = ['using a regularisation parameter '
+                        'R = {0:1.1e}'.format(reg_facts[0]), '']
+    else:
+        reg_comments = ['using the regularisation parameters', '']
+        reg_comments += ['plane {0}: R = {1:1.1e}'.format(idx, reg_fact)
+                         for idx, reg_fact in enumerate(reg_facts, 1)]
+        reg_comments += ['']
+
+    return [
+        '=' * 50, '',
+        'File written with PyPHER',
+        '------------------------', '',
+        'Kernel from PSF', '',
+        '=> {0}'.format(os.path.basename(args.psf_source)), '',
+        'to PSF', '',
+        '=> {0}'.format(os.path.basename(args.psf_target)), '',
+    ] + reg_comments + [
+        '=' * 50
+    ]
+
+
+@profiled('write')
+def write_kernel(fits_file, kernel, args, pixel_scale, cards=(),
+                 extensions=(), compression=None, quantize=None,
+                 overwrite=False):
+    """
+    Write a kernel and its pypher header to a FITS file in a single pass
+
+    Same output as `fitsutils.writeto` followed by `format_kernel_header`
+    without reopening the file for every header card.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to the FITS kernel image
+    kernel: `numpy.ndarray`
+        Kernel image or cube
+    args: `argparse.Namespace`
+        Container for the parsed values
+    pixel_scale: float
+        Pixel scale of the kernel
+    cards: list of tuple, optional
+        Additional (key, value, comment) header cards
+    extensions: list of HDU, optional
+        Extensions written after the kernel
+    compression: str, optional
+        Tile compression algorithm (default `None`)
+    quantize: float, optional
+        Quantization step of the compressed kernel (default `None`:
+        lossless)
+    overwrite: bool, optional
+        If `True`, overwrite an existing file (default `False`)
+
+    See Also
+    --------
+    pypher.fitsutils.write_kernel
+
+    """
+    reg_facts = np.atleast_1d(args.reg_fact)
+    fits.write_kernel(fits_file, kernel, pixel_scale,
+                      comments=kernel_comments(args),
+                      reg_facts=reg_facts if reg_facts.size > 1 else (),
+                      cards=cards, extensions=extensions,
+                      compression=compression, quantize=quantize,
+                      overwrite=overwrite)
+
+
+@profiled('write')
+def append_kernel(bank, kernel, args, pixel_scale, cards=()):
+    """
+    Append a kernel, or each plane of a kernel cube, to a kernel bank
+
+    The kernels are keyed by the names of the PSF files and their
+    regularisation parameter, and their headers hold the same comments
+    as the ones of `write_kernel`.
+
+    Parameters
+    ----------
+    bank: `pypher.bank.KernelBank`
+        Kernel bank opened in append mode
+    kernel: `numpy.ndarray`
+        Kernel image or cube
+    args: `argparse.Namespace`
+        Container for the parsed values
+    pixel_scale: float
+        Pixel scale of the kernel
+    cards: list of tuple, optional
+        Additional (key, value, comment) header cards
+
+    """
+    source = os.path.basename(args.psf_source)
+    target = os.path.basename(args.psf_target)
+    planes = np.reshape(kernel, (-1,) + kernel.shape[-2:])
+
+    for plane, reg_fact in zip(planes, np.atleast_1d(args.reg_fact)):
+        plane_args = argparse.Namespace(psf_source=args.psf_source,
+                                        psf_target=args.psf_target,
+                                        reg_fact=reg_fact)
+        bank.append(plane, source, target, reg_fact, pixel_scale,
+                    comments=kernel_comments(plane_args), cards=cards)
+
+
 def format_kernel_header(fits_file, args, pixel_scale):
     """
     Write the input parameters of pypher as comments in the header
@@ -75,7 +373,8 @@ def format_kernel_header(fits_file, args, pixel_scale):
     The kernel header therefore contains the name of the PSF files
     it has been created from.
     The pixel scale of the kernel is also written as a dedicated
-    kernel key.
+    kernel key. For a kernel cube computed with several regularisation
+    parameters, the parameter of each plane is written as well.
 
     Parameters
     ----------
@@ -89,23 +388,16 @@ def format_kernel_header(fits_file, args, pixel_scale):
     """
     fits.clear_comments(fits_file)
 
-    pypher_comments = [
-        '=' * 50, '',
-        'File written with PyPHER',
-        '------------------------', '',
-        'Kernel from PSF', '',
-        '=> {0}'.format(os.path.basename(args.psf_source)), '',
-        'to PSF', '',
-        '=> {0}'.format(os.path.basename(args.psf_target)), '',
-        'using a regularisation parameter '
-        'R = {0:1.1e}'.format(args.reg_fact), '',
-        '=' * 50
-    ]
-    fits.add_comments(fits_file, pypher_comments)
+    fits.add_comments(fits_file, kernel_comments(args))
 
     fits.write_pixelscale(fits_file, pixel_scale)
 
+    reg_facts = np.atleast_1d(args.reg_fact)
+    if reg_facts.size > 1:
+        fits.write_reg_facts(fits_file, reg_facts)
 
+
+@profiled('rotate')
 def imrotate(image, angle, interp_order=1):
     """
     Rotate an image from North to East given an angle in degrees
@@ -129,7 +421,11 @@ def imrotate(image, angle, interp_order=1):
                   order=interp_order, reshape=False, prefilter=False)
 
 
-def imresample(image, source_pscale, target_pscale, interp_order=1):
+RESAMPLE_METHODS = ['spline', 'fourier']
+
+
+def imresample(image, source_pscale, target_pscale, interp_order=1,
+               method='spline'):
     """
     Resample data array from one pixel scale to another
 
@@ -146,6 +442,12 @@ def imresample(image, source_pscale, target_pscale, interp_order=1):
         Pixel scale of output array in arcseconds
     interp_order : int, optional
         Spline interpolation order [0, 5] (default 1: linear)
+    method : str, optional
+        * 'spline'
+            spline interpolation with `scipy.ndimage.zoom` (default)
+        * 'fourier'
+            band-limited resampling by cropping or zero-padding the
+            spectrum, see `fourier_resample`
 
     Returns
     -------
@@ -153,21 +455,130 @@ def imresample(image, source_pscale, target_pscale, interp_order=1):
         Resampled data array
 
     """
+    if method not in RESAMPLE_METHODS:
+        raise ValueError("IMRESAMPLE: unknown method '{0}', choose among "
+                         "{1}".format(method, RESAMPLE_METHODS))
+
     old_size = image.shape[0]
-    new_size_raw = old_size * source_pscale / target_pscale
-    new_size = int(np.ceil(new_size_raw))
+    new_size = resample_size(old_size, source_pscale, target_pscale)
+    ratio = new_size / old_size
+
+    if method == 'fourier':
+        new_shape = np.round(np.asarray(image.shape) * ratio).astype(int)
+        return fourier_resample(image, new_shape)
 
     if new_size > 10000:
         raise MemoryError("The resampling will yield a too large image. "
                           "Please resize the input PSF image.")
 
+    return zoom(image, ratio, order=interp_order) / ratio**2
+
+
+def resample_size(old_size, source_pscale, target_pscale):
+    """
+    Size of an image axis after resampling
+
+    The size is rounded up and increased by one if needed so that the
+    parity of the axis is conserved, which preserves the centering.
+
+    Parameters
+    ----------
+    old_size : int
+        Size of the axis at the source pixel scale
+    source_pscale : float
+        Source pixel scale in arcseconds
+    target_pscale : float
+        Target pixel scale in arcseconds
+
+    Returns
+    -------
+    new_size : int
+        Size of the axis at the target pixel scale
+
+    """
+    new_size_raw = old_size * source_pscale / target_pscale
+    new_size = int(np.ceil(new_size_raw))
+
     # Chech for parity
     if (old_size - new_size) % 2 == 1:
         new_size += 1
 
-    ratio = new_size / old_size
+    return new_size
 
-    return zoom(image, ratio, order=interp_order) / ratio**2
+
+def imtransform(image, angle=0.0, source_pscale=1.0, target_pscale=1.0,
+                shape=None, interp_order=1):
+    """
+    Rotate and resample an image with a single interpolation
+
+    This is equivalent to `imrotate`, followed by `imresample` and a
+    centered `trim` or `zero_pad` to ``shape``, but the rotation and the
+    scaling are combined in a single affine transformation evaluated
+    directly on the output grid. The image is therefore interpolated
+    only once and neither the rotated nor the resampled intermediate
+    arrays are created.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Input data array
+    angle : float, optional
+        Rotation angle in degrees from North to East (default 0)
+    source_pscale : float, optional
+        Pixel scale of ``image`` in arcseconds (default 1)
+    target_pscale : float, optional
+        Pixel scale of output array in arcseconds (default 1)
+    shape : tuple of int, optional
+        Shape of the output array (default: the resampled image shape)
+    interp_order : int, optional
+        Spline interpolation order [0, 5] (default 1: linear)
+
+    Returns
+    -------
+    output : `numpy.ndarray`
+        Transformed data array
+
+    """
+    imshape = np.asarray(image.shape, dtype=int)
+
+    # Same sizes and flux scaling as `imresample`
+    ratio = resample_size(imshape[0], source_pscale,
+                          target_pscale) / imshape[0]
+    if source_pscale == target_pscale:
+        ratio = 1.0
+    newshape = np.round(imshape * ratio).astype(int)
+
+    if shape is None:
+        shape = newshape
+    shape = np.asarray(shape, dtype=int)
+
+    if angle == 0.0 and ratio == 1.0:
+        if np.all(shape <= imshape):
+            return trim(image, shape)
+        return zero_pad(image, shape, position='center')
+
+    dshape = newshape - shape
+    if np.any(dshape % 2 != 0):
+        raise ValueError("IMTRANSFORM: resampled and target shapes "
+                         "have different parity")
+
+    # Map the output grid onto the input one around their centers,
+    # with the scaling of `zoom` and the rotation of `imrotate`.
+    # The scaling is reduced by a negligible amount so that the edge
+    # pixels are not pushed out of the input by roundoff errors.
+    scale = np.diag((imshape - 1) / np.maximum(newshape - 1, 1))
+    scale *= 1 - 1e-12
+    cos, sin = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    rotation = np.array([[cos, -sin],
+                         [sin, cos]])
+
+    matrix = rotation.dot(scale)
+    offset = (imshape - 1) / 2 - matrix.dot((shape - 1) / 2)
+
+    output = affine_transform(image, matrix, offset, output_shape=tuple(shape),
+                              order=interp_order)
+
+    return output / np.prod(newshape / imshape)
 
 
 def trim(image, shape):
@@ -176,21 +587,21 @@ def trim(image, shape):
 
     Parameters
     ----------
-    image: 2D `numpy.ndarray`
-        Input image
+    image: `numpy.ndarray`
+        Input image, or stack of images along the leading axes
     shape: tuple of int
-        Desired output shape of the image
+        Desired output shape of the last two axes
 
     Returns
     -------
-    new_image: 2D `numpy.ndarray`
-        Input image trimmed
+    new_image: `numpy.ndarray`
+        Input image trimmed, as a view on the input data
 
     """
     shape = np.asarray(shape, dtype=int)
-    imshape = np.asarray(image.shape, dtype=int)
+    imshape = np.asarray(image.shape[-2:], dtype=int)
 
-    if np.alltrue(imshape == shape):
+    if np.all(imshape == shape):
         return image
 
     if np.any(shape <= 0):
@@ -204,10 +615,10 @@ def trim(image, shape):
         raise ValueError("TRIM: source and target shapes "
                          "have different parity")
 
-    idx, idy = np.indices(shape)
     offx, offy = dshape // 2
+    sizex, sizey = shape
 
-    return image[idx + offx, idy + offy]
+    return image[..., offx:offx + sizex, offy:offy + sizey]
 
 
 def zero_pad(image, shape, position='corner'):
@@ -216,10 +627,10 @@ def zero_pad(image, shape, position='corner'):
 
     Parameters
     ----------
-    image: real 2d `numpy.ndarray`
-        Input image
+    image: real `numpy.ndarray`
+        Input image, or stack of images along the leading axes
     shape: tuple of int
-        Desired output shape of the image
+        Desired output shape of the last two axes
     position : str, optional
         The position of the input image in the output one:
             * 'corner'
@@ -234,21 +645,14 @@ def zero_pad(image, shape, position='corner'):
 
     """
     shape = np.asarray(shape, dtype=int)
-    imshape = np.asarray(image.shape, dtype=int)
+    imshape = np.asarray(image.shape[-2:], dtype=int)
 
-    if np.alltrue(imshape == shape):
+    if np.all(imshape == shape):
         return image
 
-    if np.any(shape <= 0):
-        raise ValueError("ZERO_PAD: null or negative shape given")
-
-    dshape = shape - imshape
-    if np.any(dshape < 0):
-        raise ValueError("ZERO_PAD: target size smaller than source one")
-
-    pad_img = np.zeros(shape, dtype=image.dtype)
+    dshape = _check_pad_shape(imshape, shape)
 
-    idx, idy = np.indices(imshape)
+    pad_img = np.zeros(image.shape[:-2] + tuple(shape), dtype=image.dtype)
 
     if position == 'center':
         if np.any(dshape % 2 != 0):
@@ -258,29 +662,172 @@ def zero_pad(image, shape, position='corner'):
     else:
         offx, offy = (0, 0)
 
-    pad_img[idx + offx, idy + offy] = image
+    sizex, sizey = imshape
+    pad_img[..., offx:offx + sizex, offy:offy + sizey] = image
 
     return pad_img
 
 
+def _check_pad_shape(imshape, shape):
+    """Validate a zero-padding shape and return the size difference"""
+    if np.any(shape <= 0):
+        raise ValueError("ZERO_PAD: null or negative shape given")
+
+    dshape = shape - imshape
+    if np.any(dshape < 0):
+        raise ValueError("ZERO_PAD: target size smaller than source one")
+
+    return dshape
+
+
+def _kept_energy(image):
+    """
+    Fraction of the energy of each image kept when trimming m pixels
+    on each side, as an array of shape (n_images, n_rings)
+    """
+    ny, nx = image.shape[-2:]
+    energy = np.abs(image).reshape(-1, ny * nx)
+
+    # Distance of each pixel to the closest border
+    rows = np.minimum(np.arange(ny), np.arange(ny)[::-1])
+    cols = np.minimum(np.arange(nx), np.arange(nx)[::-1])
+    ring = np.minimum.outer(rows, cols).ravel()
+
+    ring_energy = np.array([np.bincount(ring, weights=plane)
+                            for plane in energy])
+
+    kept = np.cumsum(ring_energy[:, ::-1], axis=1)[:, ::-1]
+    total = kept[:, :1]
+    # Null images are left untouched
+    kept = np.where(total > 0, kept / np.where(total > 0, total, 1), 0.0)
+    kept[:, 0] = 1.0
+
+    return kept
+
+
+def energy_margin(image, fraction=0.999):
+    """
+    Width of the largest border holding at most 1 - fraction of the energy
+
+    The energy is the sum of the absolute values of the pixels. For a
+    stack, the border is common to all the images and each of them
+    keeps at least the given fraction of its energy.
+
+    Parameters
+    ----------
+    image: `numpy.ndarray`
+        Input image, or stack of images along the leading axes
+    fraction: float, optional
+        Fraction of the energy to keep (default 0.999)
+
+    Returns
+    -------
+    margin: int
+        Number of pixels that can be trimmed on each side of the last
+        two axes
+    discarded: float
+        Fraction of the energy lying in that border, the largest one
+        over a stack
+
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError("ENERGY_MARGIN: fraction must be in ]0, 1]")
+
+    kept = _kept_energy(image)
+    margin = int(np.count_nonzero(np.all(kept >= fraction, axis=0))) - 1
+
+    return margin, float(np.max(1 - kept[:, margin]))
+
+
+@profiled('crop')
+def energy_trim(image, fraction=0.999):
+    """
+    Trim an image to the centered support enclosing a fraction of its energy
+
+    The same number of pixels is removed on each side, so that the
+    parity of the shape and the center at ``size // 2`` are preserved,
+    see `trim`.
+
+    Parameters
+    ----------
+    image: `numpy.ndarray`
+        Input image, or stack of images along the leading axes
+    fraction: float, optional
+        Fraction of the energy to keep (default 0.999)
+
+    Returns
+    -------
+    new_image: `numpy.ndarray`
+        Input image trimmed, as a view on the input data
+    discarded: float
+        Fraction of the energy trimmed away, the largest one over a stack
+
+    """
+    margin, discarded = energy_margin(image, fraction)
+    shape = np.asarray(image.shape[-2:]) - 2 * margin
+
+    return trim(image, shape), discarded
+
+
+def energy_radius(shape):
+    """Half-size in pixels of an image centered at ``size // 2``"""
+    return int(min(shape[-2:]) // 2)
+
+
 ##########
 # FOURIER
 ##########
 
+# The FFTs are computed by the backend selected in `pypher.fftutils`
+
 
-def udft2(image):
-    """Unitary fft2"""
-    norm = np.sqrt(image.size)
-    return np.fft.fft2(image) / norm
+def udft2(image, real=False):
+    """
+    Unitary fft2 over the last two axes
 
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Input array
+    real : bool, optional
+        If `True`, the input is assumed real and only the Hermitian
+        half-spectrum is computed with a real-to-complex FFT
+        (default `False`)
 
-def uidft2(image):
-    """Unitary ifft2"""
-    norm = np.sqrt(image.size)
-    return np.fft.ifft2(image) * norm
+    """
+    norm = float(np.sqrt(np.prod(image.shape[-2:])))
+    if real:
+        return fftutils.rfft2(image) / norm
+    return fftutils.fft2(image) / norm
 
 
-def psf2otf(psf, shape):
+def uidft2(image, real=False, shape=None):
+    """
+    Unitary ifft2 over the last two axes
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Input array
+    real : bool, optional
+        If `True`, the input is a Hermitian half-spectrum and the real
+        output is computed with a complex-to-real FFT (default `False`)
+    shape : tuple of int, optional
+        Shape of the last two axes of the output, required with ``real``
+        since it cannot be inferred from the half-spectrum
+
+    """
+    if real:
+        if shape is None:
+            raise ValueError("UIDFT2: the output shape is required "
+                             "for a half-spectrum input")
+        norm = float(np.sqrt(np.prod(shape)))
+        return fftutils.irfft2(image, shape) * norm
+    norm = float(np.sqrt(np.prod(image.shape[-2:])))
+    return fftutils.ifft2(image) * norm
+
+
+def psf2otf(psf, shape, real=False, dtype=np.float64):
     """
     Convert point-spread function to optical transfer function.
 
@@ -298,9 +845,16 @@ def psf2otf(psf, shape):
     Parameters
     ----------
     psf : `numpy.ndarray`
-        PSF array
-    shape : int
-        Output shape of the OTF array
+        PSF array, or stack of PSFs along the leading axes
+    shape : tuple of int
+        Output shape of the last two axes of the OTF array
+    real : bool, optional
+        If `True`, only the Hermitian half of the OTF is computed,
+        *i.e.* an array of shape ``(shape[0], shape[1] // 2 + 1)``
+        (default `False`)
+    dtype : data-type, optional
+        Real precision of the computation, `numpy.float32` giving a
+        complex64 OTF (default `numpy.float64`)
 
     Returns
     -------
@@ -312,31 +866,178 @@ def psf2otf(psf, shape):
     Adapted from MATLAB psf2otf function
 
     """
-    if np.all(psf == 0):
-        return np.zeros_like(psf)
-
-    inshape = psf.shape
-    # Pad the PSF to outsize
-    psf = zero_pad(psf, shape, position='corner')
-
-    # Circularly shift OTF so that the 'center' of the PSF is
-    # [0,0] element of the array
-    for axis, axis_size in enumerate(inshape):
-        psf = np.roll(psf, -int(axis_size / 2), axis=axis)
-
-    # Compute the OTF
-    otf = np.fft.fft2(psf)
+    if not np.any(psf):
+        outshape = psf.shape[:-2] + tuple(shape)
+        if real:
+            return np.zeros(rfft_shape(outshape), dtype=dtype)
+        return np.zeros(outshape, dtype=dtype)
+
+    # Pad the PSF to outsize and circularly shift it so that the
+    # 'center' of the PSF is [0,0] element of the array, then compute
+    # the OTF (the padded buffer is released right after the FFT)
+    if real:
+        otf = fftutils.rfft2(circshift_pad(psf, shape, dtype=dtype))
+    else:
+        otf = fftutils.fft2(circshift_pad(psf, shape, dtype=dtype))
 
     # Estimate the rough number of operations involved in the FFT
     # and discard the PSF imaginary part if within roundoff error
     # roundoff error  = machine epsilon = sys.float_info.epsilon
     # or np.finfo().eps
-    n_ops = np.sum(psf.size * np.log2(psf.shape))
-    otf = np.real_if_close(otf, tol=n_ops)
+    # The tolerance is kept in double precision units so that
+    # a single precision OTF is not wrongly made real
+    shape = np.asarray(shape, dtype=int)
+    n_ops = np.sum(np.prod(shape) * np.log2(shape))
+    otf = np.real_if_close(otf, tol=n_ops * np.finfo(np.float64).eps)
 
     return otf
 
 
+def circshift_pad(psf, shape, dtype=None):
+    """
+    Zero-pad a PSF and circularly shift its center to the origin
+
+    Equivalent to `zero_pad` in the corner followed by a `numpy.roll`
+    of ``-(size // 2)`` along each axis, but the four quadrants of the
+    PSF are written directly at their wrapped position in a single
+    preallocated array, without any intermediate copy.
+
+    Parameters
+    ----------
+    psf : `numpy.ndarray`
+        PSF array, or stack of PSFs along the leading axes
+    shape : tuple of int
+        Output shape of the last two axes
+    dtype : data-type, optional
+        Data type of the output (default: that of ``psf``)
+
+    Returns
+    -------
+    buffer : `numpy.ndarray`
+        Padded and shifted PSF, ready for the FFT
+
+    """
+    shape = np.asarray(shape, dtype=int)
+    imshape = np.asarray(psf.shape[-2:], dtype=int)
+    _check_pad_shape(imshape, shape)
+
+    buffer = np.zeros(psf.shape[:-2] + tuple(shape), dtype=dtype or psf.dtype)
+
+    # (source, destination) slices of the two halves along each axis
+    halves = []
+    for size, outsize in zip(imshape, shape):
+        center = size // 2
+        halves.append([(slice(center, size), slice(0, size - center)),
+                       (slice(0, center), slice(outsize - center, outsize))])
+
+    for src_x, dst_x in halves[0]:
+        for src_y, dst_y in halves[1]:
+            buffer[..., dst_x, dst_y] = psf[..., src_x, src_y]
+
+    return buffer
+
+
+def fourier_resample(image, shape):
+    """
+    Resample an image to a new shape in Fourier space
+
+    The spectrum of the image, centered as in `psf2otf`, is cropped
+    (down-sampling) or zero-padded (up-sampling) to ``shape`` and
+    transformed back, the Nyquist frequencies of even sizes being
+    folded or split to keep the output real. The flux is conserved and
+    the central pixel ``size // 2`` of each axis stays at the center.
+
+    Parameters
+    ----------
+    image : `numpy.ndarray`
+        Input data array
+    shape : tuple of int
+        Output shape, the new pixel scale being
+        ``pixel_scale * image.shape / shape``
+
+    Returns
+    -------
+    output : `numpy.ndarray`
+        Resampled data array
+
+    """
+    shape = tuple(int(size) for size in shape)
+    if np.any(np.asarray(shape) <= 0):
+        raise ValueError("FOURIER_RESAMPLE: null or negative shape given")
+
+    spectrum = fftutils.fft2(circshift_pad(image, image.shape))
+    for axis, size in zip((-2, -1), shape):
+        spectrum = _spectrum_resize(spectrum, size, axis)
+
+    output = np.real(fftutils.ifft2(spectrum))
+
+    # Bring the origin back to the center
+    return np.fft.fftshift(output, axes=(-2, -1))
+
+
+def _spectrum_resize(spectrum, size, axis):
+    """Crop or zero-pad a full spectrum to ``size`` along ``axis``"""
+    old_size = spectrum.shape[axis]
+    if size == old_size:
+        return spectrum
+
+    spectrum = np.moveaxis(spectrum, axis, 0)
+    output = np.zeros((size,) + spectrum.shape[1:], dtype=spectrum.dtype)
+
+    # Frequencies common to both sizes
+    common = min(size, old_size)
+    n_pos = (common + 1) // 2
+    n_neg = common // 2
+    output[:n_pos] = spectrum[:n_pos]
+    output[size - n_neg:] = spectrum[old_size - n_neg:]
+
+    if common % 2 == 0:
+        if size < old_size:
+            # Fold the discarded positive Nyquist onto the kept one
+            output[size - n_neg] += spectrum[n_pos]
+        else:
+            # Split the Nyquist frequency between both signs
+            output[size - n_neg] /= 2
+            output[n_neg] = output[size - n_neg]
+
+    return np.moveaxis(output, 0, axis)
+
+
+def rfft_shape(shape):
+    """Shape of the Hermitian half-spectrum of a real array of given shape"""
+    shape = tuple(int(size) for size in shape)
+    return shape[:-1] + (shape[-1] // 2 + 1,)
+
+
+def fast_length(size):
+    """
+    Smallest 5-smooth integer larger or equal to ``size``
+
+    FFTs are fastest on lengths whose prime factors are only 2, 3 and 5,
+    and can be an order of magnitude slower on prime lengths.
+
+    Parameters
+    ----------
+    size: int
+        Minimal length
+
+    Returns
+    -------
+    length: int
+        Fast FFT length
+
+    """
+    length = max(int(size), 1)
+    while True:
+        rest = length
+        for factor in (2, 3, 5):
+            while rest % factor == 0:
+                rest //= factor
+        if rest == 1:
+            return length
+        length += 1
+
+
 ################
 # DECONVOLUTION
 ################
@@ -346,7 +1047,8 @@ LAPLACIAN = np.array([[ 0, -1,  0],
                       [ 0, -1,  0]])
 
 
-def deconv_wiener(psf, reg_fact):
+def deconv_wiener(psf, reg_fact, real=False, cache=None, dtype=np.float64,
+                  shape=None):
     r"""
     Create a Wiener filter using a PSF image
 
@@ -359,27 +1061,232 @@ def deconv_wiener(psf, reg_fact):
     Parameters
     ----------
     psf: `numpy.ndarray`
-        PSF array
-    reg_fact: float
+        PSF array, or stack of PSFs along the leading axes
+    reg_fact: float or array_like
         Regularisation parameter for the Wiener filter
+    real: bool, optional
+        If `True`, only the Hermitian half of the filter is computed
+        (default `False`)
+    cache: `pypher.cache.OTFCache`, optional
+        Cache of the OTFs and Wiener filters, keyed by the PSF content
+        and the parameters (default `None`: no caching)
+    dtype: data-type, optional
+        Real precision of the computation, `numpy.float32` giving a
+        complex64 filter (default `numpy.float64`)
+    shape: tuple of int, optional
+        Shape of the Fourier grid, larger or equal to that of the PSF
+        (default: the PSF shape)
 
     Returns
     -------
     wiener: complex `numpy.ndarray`
-        Fourier space Wiener filter
+        Fourier space Wiener filter. For an array of regularisation
+        parameters, the filters are stacked along the leading axes.
+
+    """
+    psf = np.asarray(psf, dtype=dtype)
+    reg_fact = np.asarray(reg_fact, dtype=float)
+
+    if shape is None:
+        shape = psf.shape[-2:]
+    shape = tuple(int(size) for size in shape)
+
+    def compute():
+        # Optical transfer functions
+        trans_func = _otf(psf, shape, real, cache)
+        reg_power = _reg_power(shape, real, cache, dtype)
+        return _wiener_filter(trans_func, reg_power, reg_fact)
+
+    return _cached(cache, compute, 'wiener', psf, reg_fact, real, shape)
+
+
+def _cached(cache, compute, *key_parts):
+    """Result of ``compute`` fetched from ``cache`` if given"""
+    if cache is None:
+        return compute()
+    return cache.fetch(cache_key(*key_parts), compute)
+
+
+def _otf(psf, shape, real=False, cache=None):
+    """OTF of a PSF, fetched from ``cache`` if given"""
+    return _cached(cache,
+                   lambda: psf2otf(psf, shape, real=real, dtype=psf.dtype),
+                   'otf', psf, shape, real)
+
+
+def _reg_power(shape, real=False, cache=None, dtype=np.float64):
+    """Squared modulus of the Laplacian OTF"""
+    laplacian = LAPLACIAN.astype(dtype)
+    return _cached(cache,
+                   lambda: np.abs(psf2otf(laplacian, shape, real=real,
+                                          dtype=dtype))**2,
+                   'laplacian', laplacian, shape, real)
+
+
+def _wiener_filter(trans_func, reg_power, reg_fact):
+    """Wiener filter from an OTF and the squared modulus of the
+    regularisation operator OTF"""
+    # Cast to the filter precision to keep single precision filters
+    reg_fact = np.asarray(reg_fact, dtype=reg_power.dtype)
+    if reg_fact.ndim:
+        # One filter per regularisation value along the leading axes
+        reg_fact = reg_fact.reshape(reg_fact.shape + (1,) * trans_func.ndim)
+
+    return np.conj(trans_func) / (np.abs(trans_func)**2 +
+                                  reg_fact * reg_power)
+
+
+REG_METHODS = ['gcv', 'lcurve']
+
+REG_GRID = np.logspace(-8, 0, 81)
+
+# Number of spectrum elements evaluated at once by the criteria
+_CHUNK_ELEMENTS = 2**24
+
+
+def _hermitian_weights(shape):
+    """Multiplicity of the half-spectrum columns in the full spectrum"""
+    weights = np.ones(rfft_shape(shape)[-1])
+    weights[1:(shape[-1] - 1) // 2 + 1] = 2
+    return weights
+
+
+def reg_criterion(psf_target, psf_source, reg_facts=REG_GRID, method='gcv'):
+    r"""
+    Regularisation selection criterion over a grid of parameters
+
+    With $H$ the source OTF, $D$ the Laplacian OTF and $Y$ the target
+    transform, the Wiener filter factors read
+    $f_\lambda = |H|^2 / (|H|^2 + \lambda |D|^2)$ so that both criteria
+    have a closed form in Fourier space and only require array
+    reductions of $|H|^2$, $|D|^2$ and $|Y|^2$ for every $\lambda$.
+
+    * 'gcv' - generalized cross-validation
+        $\|(1 - f_\lambda) Y\|^2 / (\sum (1 - f_\lambda))^2$,
+        to be minimized
+    * 'lcurve' - curvature of the L-curve
+        $(\log \|(1 - f_\lambda) Y\|, \log \|D K_\lambda\|)$,
+        to be maximized
+
+    Parameters
+    ----------
+    psf_target: `numpy.ndarray`
+        2D array
+    psf_source: `numpy.ndarray`
+        2D array
+    reg_facts: array_like, optional
+        Increasing grid of regularisation parameters
+        (default `REG_GRID`, 81 values from 1e-8 to 1)
+    method: str, optional
+        'gcv' (default) or 'lcurve'
+
+    Returns
+    -------
+    criterion: `numpy.ndarray`
+        Criterion value for each regularisation parameter
+
+    """
+    if method not in REG_METHODS:
+        raise ValueError("REG_CRITERION: unknown method '{0}', choose among "
+                         "{1}".format(method, REG_METHODS))
+
+    shape = psf_source.shape
+    reg_facts = np.asarray(reg_facts, dtype=float)
+
+    # Half-spectra flattened and weighted for the full-spectrum sums
+    weights = np.broadcast_to(_hermitian_weights(shape),
+                              rfft_shape(shape)).ravel()
+    trans_power = np.abs(psf2otf(psf_source, shape, real=True)).ravel()**2
+    reg_power = np.abs(psf2otf(LAPLACIAN, shape, real=True)).ravel()**2
+    data_power = np.abs(udft2(psf_target, real=True)).ravel()**2
+
+    residual = np.empty_like(reg_facts)
+    dof = np.empty_like(reg_facts)
+    seminorm = np.empty_like(reg_facts)
+
+    step = max(1, _CHUNK_ELEMENTS // weights.size)
+    for start in range(0, reg_facts.size, step):
+        chunk = slice(start, start + step)
+        reg_term = reg_facts[chunk, None] * reg_power
+        denom = trans_power + reg_term
+        # 1 - f = reg_term / denom
+        complement = np.divide(reg_term, denom,
+                               out=np.zeros_like(denom), where=denom > 0)
+        residual[chunk] = np.dot(complement**2, weights * data_power)
+        dof[chunk] = np.dot(complement, weights)
+        if method == 'lcurve':
+            solution = np.divide(trans_power, denom**2,
+                                 out=np.zeros_like(denom), where=denom > 0)
+            seminorm[chunk] = np.dot(solution,
+                                     weights * reg_power * data_power)
+
+    if method == 'gcv':
+        return residual / dof**2
+
+    # Curvature of the L-curve in log-log scale
+    log_reg = np.log(reg_facts)
+    rho = 0.5 * np.log(residual)
+    eta = 0.5 * np.log(seminorm)
+    drho = np.gradient(rho, log_reg)
+    deta = np.gradient(eta, log_reg)
+    ddrho = np.gradient(drho, log_reg)
+    ddeta = np.gradient(deta, log_reg)
+
+    return ((drho * ddeta - ddrho * deta) /
+            (drho**2 + deta**2)**1.5)
+
+
+@profiled('regularisation')
+def select_reg_fact(psf_target, psf_source, method='gcv', reg_facts=REG_GRID):
+    """
+    Automatic selection of the regularisation parameter
+
+    The parameter is picked on a logarithmic grid, either at the minimum
+    of the generalized cross-validation function or at the corner of the
+    L-curve (see `reg_criterion`). A warning is issued when the optimum
+    falls on the first or last value of the grid, the true optimum
+    being then possibly outside of it: the grid should be widened. This
+    happens with noiseless PSFs, which favour the smallest parameter.
+
+    Parameters
+    ----------
+    psf_target: `numpy.ndarray`
+        2D array
+    psf_source: `numpy.ndarray`
+        2D array
+    method: str, optional
+        'gcv' (default) or 'lcurve'
+    reg_facts: array_like, optional
+        Increasing grid of regularisation parameters
+        (default `REG_GRID`, 81 values from 1e-8 to 1)
+
+    Returns
+    -------
+    reg_fact: float
+        Selected regularisation parameter
 
     """
-    # Optical transfer functions
-    trans_func = psf2otf(psf, psf.shape)
-    reg_op = psf2otf(LAPLACIAN, psf.shape)
+    reg_facts = np.asarray(reg_facts, dtype=float)
+    criterion = reg_criterion(psf_target, psf_source, reg_facts, method)
 
-    wiener = np.conj(trans_func) / (np.abs(trans_func)**2 +
-                                    reg_fact * np.abs(reg_op)**2)
+    if method == 'gcv':
+        best = np.nanargmin(criterion)
+    else:
+        best = np.nanargmax(criterion)
+
+    if best in (0, reg_facts.size - 1):
+        warnings.warn("SELECT_REG_FACT: the {0} optimum r = {1:.2e} is at "
+                      "the {2} end of the grid, widen the grid to check "
+                      "it".format(method, reg_facts[best],
+                                  'lower' if best == 0 else 'upper'))
 
-    return wiener
+    return float(reg_facts[best])
 
 
-def homogenization_kernel(psf_target, psf_source, reg_fact=1e-4, clip=True):
+@profiled('wiener')
+def homogenization_kernel(psf_target, psf_source, reg_fact=1e-4, clip=True,
+                          real=False, cache=None, dtype=np.float64,
+                          fast=False):
     r"""
     Compute the homogenization kernel to match two PSFs
 
@@ -391,34 +1298,345 @@ def homogenization_kernel(psf_target, psf_source, reg_fact=1e-4, clip=True):
     Parameters
     ----------
     psf_target: `numpy.ndarray`
-        2D array
+        2D array, or stack of 2D arrays of shape (n, ny, nx)
     psf_source: `numpy.ndarray`
-        2D array
-    reg_fact: float, optional
-        Regularisation parameter for the Wiener filter
+        2D array, or stack of 2D arrays of shape (n, ny, nx)
+    reg_fact: float or array_like, optional
+        Regularisation parameter for the Wiener filter. Given a 1D array,
+        the OTFs are computed once and a cube of kernels with one plane
+        per value is returned.
     clip: bool, optional
         If `True`, enforces the non-amplification of the noise
         (default `True`)
+    real: bool, optional
+        If `True`, the computation is done on Hermitian half-spectra with
+        real-to-complex FFTs, which roughly halves the FFT time and the
+        memory of the complex arrays (default `False`)
+    cache: `pypher.cache.OTFCache`, optional
+        Cache of the source OTF and Wiener filter (default `None`)
+    dtype: data-type, optional
+        Real precision of the computation (default `numpy.float64`).
+        With `numpy.float32`, every intermediate array is kept in
+        float32 / complex64, which halves the memory and, with the
+        'scipy' or 'pyfftw' backends, the FFT time. The kernel then
+        departs from the double precision one by less than 1e-7 of its
+        peak value for ``reg_fact >= 1e-4`` and about 1e-6 for
+        ``reg_fact = 1e-6``, the error growing with the filter gain.
+    fast: bool, optional
+        If `True`, the PSFs are zero-padded to the next 5-smooth lengths
+        (see `fast_length`) for the FFTs, and the kernel is cropped back
+        to the shape of ``psf_target`` with the same centering. Much
+        faster for prime or twice prime sizes, the kernel only differing
+        by the periodic boundary of the Fourier grid (default `False`).
 
     Returns
     -------
     kernel_image: `numpy.ndarray`
-        2D deconvolved image
+        2D deconvolved image (3D for an array of ``reg_fact``)
     kernel_fourier: `numpy.ndarray`
-        2D discrete Fourier transform of deconvolved image
+        2D discrete Fourier transform of deconvolved image, only the
+        Hermitian half of it if ``real`` is `True` (3D for an array
+        of ``reg_fact``). With ``fast``, it is defined on the padded grid.
+
+    Notes
+    -----
+    Stacks of PSFs are broadcast against each other along the leading
+    axes, so that n pairs of PSFs, or one source PSF and n target PSFs,
+    are homogenized in a single vectorized call returning n kernels.
+    With an array of ``reg_fact``, the regularisation axis comes first.
 
     """
-    wiener = deconv_wiener(psf_source, reg_fact)
+    psf_target = np.asarray(psf_target, dtype=dtype)
+    shape = psf_target.shape[-2:]
+
+    fft_shape = shape
+    if fast:
+        fft_shape = tuple(fast_length(size) for size in shape)
+        # The kernel comes out in the frame of the target PSF, so
+        # padding the latter in the corner keeps the centering
+        psf_target = zero_pad(psf_target, fft_shape)
+
+    wiener = deconv_wiener(psf_source, reg_fact, real=real, cache=cache,
+                           dtype=dtype, shape=fft_shape)
+
+    # The regularisation axes of the filter must stay ahead of the PSF
+    # stack axes, including those only brought by the target PSFs
+    reg_ndim = np.ndim(reg_fact)
+    missing = psf_target.ndim - (wiener.ndim - reg_ndim)
+    if reg_ndim and missing > 0:
+        wiener = wiener.reshape(wiener.shape[:reg_ndim] + (1,) * missing +
+                                wiener.shape[reg_ndim:])
+
+    kernel_fourier = wiener * udft2(psf_target, real=real)
+    if real:
+        kernel_image = uidft2(kernel_fourier, real=True, shape=fft_shape)
+    else:
+        kernel_image = np.real(uidft2(kernel_fourier))
 
-    kernel_fourier = wiener * udft2(psf_target)
-    kernel_image = np.real(uidft2(kernel_fourier))
+    if fast:
+        kernel_image = np.ascontiguousarray(kernel_image[..., :shape[0],
+                                                         :shape[1]])
 
     if clip:
-        kernel_image.clip(-1, 1)
+        kernel_image.clip(-1, 1, out=kernel_image)
 
     return kernel_image, kernel_fourier
 
 
+@profiled('wiener')
+def homogenization_kernels(psfs_target, psfs_source, reg_fact=1e-4,
+                           clip=True, cache=None, dtype=np.float64,
+                           pairwise=False):
+    r"""
+    Compute the homogenization kernels between two sets of PSFs
+
+    Batch version of `homogenization_kernel` for N source PSFs and
+    M target PSFs sharing the same shape. The Wiener filter of each
+    source PSF and the Fourier transform of each target PSF are
+    computed only once, and the N x M kernels are formed by
+    broadcasting products, which brings the cost down from about
+    3 N M to N + M forward and N M inverse FFTs.
+
+    Parameters
+    ----------
+    psfs_target: sequence of `numpy.ndarray`
+        M 2D arrays, or a 3D array of shape (M, ny, nx)
+    psfs_source: sequence of `numpy.ndarray`
+        N 2D arrays, or a 3D array of shape (N, ny, nx)
+    reg_fact: float, optional
+        Regularisation parameter for the Wiener filter, common to every
+        pair of PSFs. Sweeps over several values are done by calling
+        `homogenization_kernel` with an array of ``reg_fact``.
+    clip: bool, optional
+        If `True`, enforces the non-amplification of the noise
+        (default `True`)
+    cache: `pypher.cache.OTFCache`, optional
+        Cache of the source OTFs and Wiener filters (default `None`)
+    dtype: data-type, optional
+        Real precision of the computation and of the output, see
+        `homogenization_kernel` (default `numpy.float64`)
+    pairwise: bool, optional
+        If `True`, only the kernels between ``psfs_source[i]`` and
+        ``psfs_target[i]`` are computed, for N = M pairs of PSFs
+        (default `False`)
+
+    Returns
+    -------
+    kernels: `numpy.ndarray`
+        4D array of shape (N, M, ny, nx) where ``kernels[i, j]`` is the
+        kernel from ``psfs_source[i]`` to ``psfs_target[j]``, or 3D array
+        of shape (N, ny, nx) if ``pairwise`` is `True`
+
+    Notes
+    -----
+    Only the image domain kernels are returned, the N x M Fourier
+    kernels being dropped to keep the memory footprint to that of the
+    output cube.
+
+    """
+    psfs_target = np.asarray(psfs_target, dtype=dtype)
+    psfs_source = np.asarray(psfs_source, dtype=dtype)
+
+    if psfs_target.ndim != 3 or psfs_source.ndim != 3:
+        raise ValueError("HOMOGENIZATION_KERNELS: inputs must be "
+                         "sequences of 2D PSFs")
+
+    shape = psfs_target.shape[-2:]
+    if psfs_source.shape[-2:] != shape:
+        raise ValueError("HOMOGENIZATION_KERNELS: source and target PSFs "
+                         "have different shapes")
+
+    if pairwise and len(psfs_source) != len(psfs_target):
+        raise ValueError("HOMOGENIZATION_KERNELS: pairwise mode requires "
+                         "as many source as target PSFs")
+
+    reg_fact = np.asarray(reg_fact, dtype=float)
+    if reg_fact.ndim:
+        # An array would be broadcast against the PSF axes of the batch
+        raise ValueError("HOMOGENIZATION_KERNELS: reg_fact must be a "
+                         "scalar")
+
+    # Computed once for the whole batch
+    reg_power = _reg_power(shape, True, cache, dtype)
+    target_fourier = udft2(psfs_target, real=True)
+
+    if pairwise:
+        kernels = np.empty(psfs_target.shape, dtype=dtype)
+    else:
+        kernels = np.empty((len(psfs_source),) + psfs_target.shape,
+                           dtype=dtype)
+    for idx, psf_source in enumerate(psfs_source):
+        wiener = _cached(
+            cache,
+            lambda: _wiener_filter(_otf(psf_source, shape, True, cache),
+                                   reg_power, reg_fact),
+            'wiener', psf_source, reg_fact, True)
+        spectrum = target_fourier[idx] if pairwise else target_fourier
+        kernels[idx] = uidft2(wiener * spectrum, real=True, shape=shape)
+
+    if clip:
+        kernels.clip(-1, 1, out=kernels)
+
+    return kernels
+
+
+@profiled('separable')
+def separable_kernel(kernel, tol=1e-3, max_rank=None):
+    r"""
+    Decompose a kernel into a sum of separable components
+
+    The singular value decomposition of the kernel
+
+    .. math:: K = \sum_c s_c \, u_c v_c^T
+
+    is truncated to the smallest rank r whose relative residual
+    $\|K - K_r\|_F / \|K\|_F$ is below ``tol``, so that the kernel
+    is applied with r pairs of 1D convolutions along y and x,
+    see `pypher.apply.convolve_separable`.
+
+    Parameters
+    ----------
+    kernel: `numpy.ndarray`
+        2D kernel, or stack of kernels along the leading axes
+    tol: float, optional
+        Largest relative residual of the decomposition (default 1e-3)
+    max_rank: int, optional
+        Largest rank kept, whatever the residual (default `None`)
+
+    Returns
+    -------
+    vertical: `numpy.ndarray`
+        1D filters along the y axis, of shape (..., r, ny)
+    horizontal: `numpy.ndarray`
+        1D filters along the x axis, of shape (..., r, nx)
+    residual: float or `numpy.ndarray`
+        Relative residual of the rank r decomposition of each kernel
+
+    Notes
+    -----
+    A stack of kernels is decomposed with a common rank, the smallest
+    one meeting ``tol`` for every kernel.
+
+    """
+    kernel = np.asarray(kernel)
+    left, singular, right = np.linalg.svd(kernel, full_matrices=False)
+
+    # Power left out of the components 0..r-1, for r = 0..n
+    power = singular**2
+    left_out = np.cumsum(power[..., ::-1], axis=-1)[..., ::-1]
+    left_out = np.concatenate([left_out, np.zeros_like(power[..., :1])],
+                              axis=-1)
+    norm = np.where(left_out[..., :1] > 0, left_out[..., :1], 1)
+    residuals = np.sqrt(left_out / norm)
+
+    residuals = residuals.reshape(-1, residuals.shape[-1])
+    rank = max(int(np.argmax(np.all(residuals <= tol, axis=0))), 1)
+    if max_rank is not None:
+        rank = max(min(rank, max_rank), 1)
+
+    weights = np.sqrt(singular[..., :rank])
+    vertical = np.swapaxes(left[..., :rank], -1, -2) * weights[..., None]
+    horizontal = right[..., :rank, :] * weights[..., None]
+
+    residual = residuals[:, rank].reshape(kernel.shape[:-2])
+    if residual.ndim == 0:
+        residual = float(residual)
+
+    return vertical, horizontal, residual
+
+
+###########
+# PIPELINE
+###########
+
+
+@profiled('load')
+def load_psf(fits_file, ext=None, plane=None, dtype=None):
+    """
+    Load a PSF image and its pixel scale from a FITS file
+
+    The file is memory-mapped so that only the selected PSF is read,
+    see `fitsutils.read_psf`. The PSF is copied once into a working
+    array in which NaN values are set to 0.
+
+    Parameters
+    ----------
+    fits_file: str
+        Path to the FITS PSF image
+    ext: int or str, optional
+        Extension of the PSF (default: first HDU holding data)
+    plane: int, optional
+        Index of the PSF in a 3D cube
+    dtype: data-type, optional
+        Data type of the output array (default: that of the file, in
+        native byte order)
+
+    Returns
+    -------
+    psf: `numpy.ndarray`
+        PSF array
+    pixel_scale: float
+        Pixel scale of the PSF in arcseconds
+
+    """
+    psf_file = fits.read_psf(fits_file, ext=ext, plane=plane)
+
+    if dtype is None:
+        dtype = psf_file.data.dtype.newbyteorder('=')
+    psf = np.array(psf_file.data, dtype=dtype)
+    np.nan_to_num(psf, copy=False)
+
+    return psf, psf_file.pixel_scale
+
+
+@profiled('resample')
+def match_psf(psf, source_pscale, target_pscale, shape, angle=0.0,
+              method='spline'):
+    """
+    Bring a PSF to a given pixel scale, orientation and shape
+
+    With the default 'spline' method, the PSF is rotated and resampled
+    (if necessary) with a single interpolation onto the target grid,
+    see `imtransform`. With the 'fourier' method, the PSF is rotated
+    first, resampled in Fourier space and then trimmed or zero-padded
+    around its center.
+
+    Parameters
+    ----------
+    psf : `numpy.ndarray`
+        Input PSF array
+    source_pscale : float
+        Pixel scale of ``psf`` in arcseconds
+    target_pscale : float
+        Pixel scale of the output array in arcseconds
+    shape : tuple of int
+        Shape of the output array
+    angle : float, optional
+        Rotation angle in degrees (default 0)
+    method : str, optional
+        Resampling method, 'spline' (default) or 'fourier'
+
+    Returns
+    -------
+    output : `numpy.ndarray`
+        PSF array on the target grid
+
+    """
+    if method == 'spline':
+        return imtransform(psf, angle, source_pscale, target_pscale, shape)
+
+    if angle != 0.0:
+        psf = imrotate(psf, angle)
+
+    if source_pscale != target_pscale:
+        psf = imresample(psf, source_pscale, target_pscale, method=method)
+
+    if np.all(np.asarray(psf.shape) >= shape):
+        return trim(psf, shape)
+
+    return zero_pad(psf, shape, position='center')
+
+
 ########
 # DEBUG
 ########
@@ -467,78 +1685,123 @@ def main():  # pragma: no cover
         sys.exit()
 
     kernel_basename, _ = os.path.splitext(args.output)
-    kernel_fits = kernel_basename + '.fits'
+    kernel_fits = kernel_basename + ('.npy' if args.npy else '.fits')
 
     logname = '%s.log' % kernel_basename
     if os.path.exists(logname):
         os.remove(logname)
     log = setup_logger(logname)
 
-    # Load images (NaNs are set to 0)
-    psf_source = fits.getdata(args.psf_source)
-    psf_target = fits.getdata(args.psf_target)
+    backend = fftutils.set_backend(args.fft_backend, args.fft_workers)
+    log.info('FFT backend: %s', backend)
 
-    log.info('Source PSF loaded: %s', args.psf_source)
-    log.info('Target PSF loaded: %s', args.psf_target)
+    profiler = start_profiler(args)
 
-    # Set NaNs to 0.0
-    psf_source = np.nan_to_num(psf_source)
-    psf_target = np.nan_to_num(psf_target)
+    dtype = np.float32 if args.float32 else np.float64
 
-    # Retrieve the pixel scale of each image
-    pixscale_source = fits.get_pixscale(args.psf_source)
-    pixscale_target = fits.get_pixscale(args.psf_target)
+    # Load images (NaNs are set to 0) and their pixel scale
+    psf_source, pixscale_source = load_psf(args.psf_source,
+                                           ext=args.ext_source,
+                                           plane=args.plane_source,
+                                           dtype=dtype)
+    psf_target, pixscale_target = load_psf(args.psf_target,
+                                           ext=args.ext_target,
+                                           plane=args.plane_target,
+                                           dtype=dtype)
+
+    log.info('Source PSF loaded: %s', args.psf_source)
+    log.info('Target PSF loaded: %s', args.psf_target)
 
     log.info('Source PSF pixel scale: %.2f arcsec', pixscale_source)
     log.info('Target PSF pixel scale: %.2f arcsec', pixscale_target)
 
-    # Rotate images (if necessary)
-    if args.angle_source != 0.0:
-        psf_source = imrotate(psf_source, args.angle_source)
+    # Rotate the target image (if necessary)
     if args.angle_target != 0.0:
         psf_target = imrotate(psf_target, args.angle_target)
 
-    log.info('Source PSF rotated by %.2f degrees', args.angle_source)
     log.info('Target PSF rotated by %.2f degrees', args.angle_target)
 
     # Normalize the PSFs
     psf_source /= psf_source.sum()
     psf_target /= psf_target.sum()
 
-    # Resample high resolution image to the low one
-    if pixscale_source != pixscale_target:
-        try:
-            psf_source = imresample(psf_source,
-                                    pixscale_source,
-                                    pixscale_target)
-        except MemoryError:
-            log.error('- COMPUTATION ABORTED -')
-            log.error('The size of the resampled PSF would have '
-                      'exceeded 10K x 10K')
-            log.error('Please resize your image and try again')
-
-            print('Issue during the resampling step - see pypher.log')
-            sys.exit()
+    # Rotate and resample the high resolution image to the grid
+    # of the low resolution one with a single interpolation
+    psf_source = match_psf(psf_source, pixscale_source, pixscale_target,
+                           psf_target.shape, angle=args.angle_source,
+                           method=args.resample)
 
+    log.info('Source PSF rotated by %.2f degrees', args.angle_source)
+    if pixscale_source != pixscale_target:
         log.info('Source PSF resampled to the target pixel scale')
 
-    # check the new size of the source vs. the target
-    if psf_source.shape > psf_target.shape:
-        psf_source = trim(psf_source, psf_target.shape)
+    if args.auto_reg is not None:
+        args.reg_fact = [select_reg_fact(psf_target, psf_source,
+                                         method=args.auto_reg)]
+        log.info('Regularisation parameter selected with %s: r = %.2e',
+                 args.auto_reg, args.reg_fact[0])
+
+    # Several regularisation parameters yield a kernel cube
+    if len(args.reg_fact) == 1:
+        args.reg_fact = args.reg_fact[0]
     else:
-        psf_source = zero_pad(psf_source, psf_target.shape, position='center')
+        args.reg_fact = np.array(args.reg_fact)
+
+    cards = []
+    if args.energy is not None:
+        # Both PSFs share the target grid, so they are cropped together
+        psfs, discarded = energy_trim(np.stack([psf_target, psf_source]),
+                                      args.energy)
+        psf_target, psf_source = psfs
+        cards += [('PSFRAD', energy_radius(psfs.shape),
+                   'Radius of the cropped PSFs (pixels)'),
+                  ('PSFLOSS', discarded, 'PSF energy fraction cropped')]
+        log.info('PSFs cropped to %dx%d pixels, discarding %.2e of their '
+                 'energy', psfs.shape[-2], psfs.shape[-1], discarded)
 
     kernel, _ = homogenization_kernel(psf_target, psf_source,
-                                      reg_fact=args.reg_fact)
+                                      reg_fact=args.reg_fact, real=True,
+                                      cache=make_cache(args), dtype=dtype,
+                                      fast=args.fast_fft)
+
+    for reg_fact in np.atleast_1d(args.reg_fact):
+        log.info('Kernel computed using Wiener filtering and a '
+                 'regularisation parameter r = %.2e', reg_fact)
+
+    if args.energy is not None:
+        kernel, discarded = energy_trim(kernel, args.energy)
+        cards += [('KERRAD', energy_radius(kernel.shape),
+                   'Radius of the cropped kernel (pixels)'),
+                  ('KERLOSS', discarded, 'Kernel energy fraction cropped')]
+        log.info('Kernel cropped to %dx%d pixels, discarding %.2e of its '
+                 'energy', kernel.shape[-2], kernel.shape[-1], discarded)
+
+    extensions = []
+    if args.separable is not None:
+        vertical, horizontal, residual = separable_kernel(kernel,
+                                                          args.separable)
+        extensions = fits.separable_hdus(vertical, horizontal, residual)
+        log.info('Kernel decomposed into %d separable components, '
+                 'relative residual %.2e', vertical.shape[-2],
+                 np.max(residual))
+
+    if args.bank is not None:
+        with KernelBank(args.bank, 'a') as bank:
+            append_kernel(bank, kernel, args, pixscale_target, cards=cards)
+        kernel_fits = args.bank
+    else:
+        # Write kernel and header to FITS file at once
+        write_kernel(kernel_fits, kernel, args, pixscale_target,
+                     cards=cards, extensions=extensions,
+                     compression=args.compress, quantize=args.quantize)
 
-    log.info('Kernel computed using Wiener filtering and a regularisation '
-             'parameter r = %.2e', args.reg_fact)
+    log.info('Kernel saved in %s', kernel_fits)
 
-    # Write kernel to FITS file
-    fits.writeto(kernel_fits, data=kernel)
-    format_kernel_header(kernel_fits, args, pixscale_target)
+    stop_profiler(profiler, args)
+    if profiler is not None:
+        log.info('Profiling report saved in %s', args.profile)
 
-    log.info('Kernel saved in %s', kernel_fits)
+    fftutils.save_wisdom()
 
     print("pypher: Output kernel saved to %s" % kernel_fits)
 
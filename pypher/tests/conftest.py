@@ -78,3 +78,16 @@ def imagedirac(request):
     array = np.zeros((size, size))
     array[size // 2, size // 2] = 1
     return array
+
+
+def gaussian(size, sigma):
+    grid = np.arange(size) - size // 2
+    xx, yy = np.meshgrid(grid, grid)
+    array = np.exp(-(xx**2 + yy**2) / (2 * sigma**2))
+    return array / array.sum()
+
+
+@pytest.fixture(scope='function', params=[15, 32])
+def gaussians(request):
+    size = request.param
+    return np.array([gaussian(size, sigma) for sigma in [1.0, 1.5, 2.0]])
@@ -6,18 +6,48 @@
 
 from __future__ import division, absolute_import
 
+import os
+import sys
+import argparse
+import warnings
+import tracemalloc
+import multiprocessing
+import json
+
 import pytest
 import numpy as np
 import astropy.io.fits as fits
 
 from numpy.testing import assert_equal, assert_allclose
 
-from pypher.pypher import (parse_args, format_kernel_header,
-                           imrotate, imresample, trim, zero_pad,
-                           psf2otf, homogenization_kernel)
-from pypher.fitsutils import has_pixelscale, get_pixscale, add_comments
-from pypher.parser import ArgumentParserError
+from pypher.pypher import (parse_args, format_kernel_header, write_kernel,
+                           append_kernel, check_output_arguments,
+                           load_psf, imrotate, imresample, trim, zero_pad,
+                           energy_margin, energy_trim,
+                           circshift_pad, imtransform, fourier_resample,
+                           psf2otf, fast_length, homogenization_kernel,
+                           homogenization_kernels, reg_criterion,
+                           select_reg_fact, deconv_wiener, separable_kernel,
+                           LAPLACIAN, REG_GRID)
+from pypher.fitsutils import (has_pixelscale, get_pixscale, add_comments,
+                              read_psf, clear_psf_cache, write_pixelscale,
+                              separable_hdus, read_separable, read_kernel,
+                              npy_header_file)
+from pypher.fitsutils import write_kernel as fits_write_kernel
+from pypher.parser import ArgumentParserError, ThrowingArgumentParser
+from pypher import fftutils, fitsutils
+from pypher import profiling
+from pypher.cache import OTFCache, cache_key, array_digest
+from pypher.psfgrid import KernelField
+from pypher.bank import KernelBank
+from pypher import bank as bank_module
+from pypher.apply import (convolve_tiled, convolve_stamps,
+                          convolve_separable, apply_kernel)
 from pypher.addpixscl import parse_args as parse_args_addpixscl
+from pypher.addpixscl import add_pixscale
+from pypher.batch import parse_args as parse_args_batch
+from pypher.apply import parse_args as parse_args_apply
+from pypher.tests.conftest import gaussian
 
 ERRSHAPE = 'incorrect shape'
 ERROUT = 'incorrect output'
@@ -36,6 +66,14 @@ class TestParser(object):
         with pytest.raises(ArgumentParserError):
             parse_args_addpixscl()
 
+    def test_parse_args_batch(self):
+        with pytest.raises(ArgumentParserError):
+            parse_args_batch()
+
+    def test_parse_args_apply(self):
+        with pytest.raises(ArgumentParserError):
+            parse_args_apply()
+
 
 class TestFits(object):
     def test_nopixelscale(self, fitscleandir):
@@ -49,6 +87,134 @@ class TestFits(object):
         assert round(fits.getval('image.fits', 'CD2_1') * 3600, 1) == 0.0
         assert round(fits.getval('image.fits', 'CD2_2') * 3600, 1) == PIXSCALE
 
+    def test_format_header_reg_cube(self, mock_parser):
+        reg_facts = [1e-5, 1e-4, 1e-3]
+        format_kernel_header('image.fits', mock_parser._replace(
+            reg_fact=np.array(reg_facts)), PIXSCALE)
+        for idx, reg_fact in enumerate(reg_facts, 1):
+            assert fits.getval('image.fits', 'REGF%d' % idx) == reg_fact
+
+    @pytest.mark.parametrize('reg_fact', [1e-4, np.array([1e-5, 1e-4])])
+    def test_write_kernel(self, mock_parser, tmpdir, reg_fact):
+        args = mock_parser._replace(reg_fact=reg_fact)
+        kernel = np.ones((2, 5, 5)) if np.ndim(reg_fact) else np.ones((5, 5))
+        reference = str(tmpdir.join('reference.fits'))
+        single = str(tmpdir.join('single.fits'))
+
+        fits.writeto(reference, kernel)
+        format_kernel_header(reference, args, PIXSCALE)
+        write_kernel(single, kernel, args, PIXSCALE)
+
+        with open(reference, 'rb') as ref, open(single, 'rb') as out:
+            assert ref.read() == out.read()
+
+    @pytest.mark.parametrize('options', [
+        dict(dtype=np.float32),
+        dict(compression='gzip'),
+        dict(compression='rice', quantize=1e-8),
+        dict(quantize=1e-6, dtype=np.float32),
+        dict(compression='hcompress', quantize=1e-8)])
+    def test_write_kernel_formats(self, tmpdir, options):
+        kernel = gaussian(31, 3.0)
+        kernel_file = str(tmpdir.join('kernel.fits'))
+        fits_write_kernel(kernel_file, kernel, PIXSCALE, comments=['pypher'],
+                          **options)
+
+        data = read_kernel(kernel_file)
+        step = options.get('quantize')
+        if step is None:
+            assert_allclose(data, kernel, rtol=1e-7 if 'dtype' in options
+                            else 0, atol=0)
+        else:
+            assert np.abs(data - kernel).max() <= step / 2 * (1 + 1e-6)
+        assert get_pixscale(kernel_file) == PIXSCALE
+        assert read_psf(kernel_file, cache=False).pixel_scale == PIXSCALE
+
+    def test_write_kernel_npy(self, tmpdir):
+        kernel = gaussian(15, 2.0)
+        kernel_file = str(tmpdir.join('kernel.npy'))
+        fits_write_kernel(kernel_file, kernel, PIXSCALE, comments=['pypher'],
+                          reg_facts=[1e-4], cards=[('KERRAD', 7, 'Radius')])
+        assert_equal(read_kernel(kernel_file), kernel)
+        assert get_pixscale(kernel_file) == PIXSCALE
+        header = fits.Header.fromtextfile(npy_header_file(kernel_file))
+        assert header['COMMENT'][0] == 'pypher'
+        assert header['REGF1'] == 1e-4 and header['KERRAD'] == 7
+        with pytest.raises(IOError):
+            fits_write_kernel(kernel_file, kernel, PIXSCALE)
+
+        # Content a .npy file cannot hold is rejected
+        vertical, horizontal, residual = separable_kernel(kernel)
+        for options in [dict(compression='gzip'), dict(quantize=1e-8),
+                        dict(extensions=separable_hdus(vertical, horizontal,
+                                                       residual))]:
+            with pytest.raises(ValueError):
+                fits_write_kernel(kernel_file, kernel, PIXSCALE,
+                                  overwrite=True, **options)
+
+    @pytest.mark.parametrize('option', ['compress', 'quantize', 'separable'])
+    def test_check_output_arguments(self, option):
+        parser = ThrowingArgumentParser()
+        options = dict(npy=False, compress=None, quantize=None,
+                       separable=None, bank=None)
+        options[option] = 1e-3
+        args = argparse.Namespace(**options)
+        assert check_output_arguments(parser, args) is args
+
+        args.npy = True
+        with pytest.raises(ArgumentParserError):
+            check_output_arguments(parser, args)
+
+        args.npy = False
+        args.bank = 'bank.fits'
+        with pytest.raises(ArgumentParserError):
+            check_output_arguments(parser, args)
+
+    def test_check_output_arguments_bank(self):
+        parser = ThrowingArgumentParser()
+        args = argparse.Namespace(npy=False, compress=None, quantize=None,
+                                  separable=None, bank='bank.fits')
+        assert check_output_arguments(parser, args) is args
+
+        args.npy = True
+        with pytest.raises(ArgumentParserError):
+            check_output_arguments(parser, args)
+
+    @pytest.mark.parametrize('option', [['--compress', 'gzip'],
+                                        ['--quantize', '1e-3'],
+                                        ['--separable', '1e-3'], ['--npy']])
+    def test_parse_args_bank(self, monkeypatch, option):
+        monkeypatch.setattr(sys, 'argv', ['pypher', 'a.fits', 'b.fits',
+                                          'k.fits', '--bank', 'bank.fits'] +
+                            option)
+        with pytest.raises(ArgumentParserError):
+            parse_args()
+
+        if option[0] == '--separable':
+            return
+        monkeypatch.setattr(sys, 'argv', ['pypher-batch', '-s', 'a.fits',
+                                          '-t', 'b.fits',
+                                          '--bank', 'bank.fits'] + option)
+        with pytest.raises(ArgumentParserError):
+            parse_args_batch()
+
+        monkeypatch.setattr(sys, 'argv', ['pypher-batch', '-s', 'a.fits',
+                                          '-t', 'b.fits',
+                                          '--bank', 'bank.fits'])
+        assert parse_args_batch().bank == 'bank.fits'
+
+    def test_write_kernel_lossy_float(self, tmpdir):
+        with pytest.raises(ValueError):
+            fits_write_kernel(str(tmpdir.join('kernel.fits')), np.ones((3, 3)),
+                              PIXSCALE, compression='rice')
+
+    def test_write_kernel_cards(self, mock_parser, tmpdir):
+        output = str(tmpdir.join('kernel.fits'))
+        write_kernel(output, np.ones((5, 5)), mock_parser, PIXSCALE,
+                     cards=[('KERRAD', 2, 'Radius'), ('KERLOSS', 1e-4, 'Loss')])
+        assert fits.getval(output, 'KERRAD') == 2
+        assert fits.getval(output, 'KERLOSS') == 1e-4
+
     def test_has_pixelscale(self):
         assert has_pixelscale('image.fits')
 
@@ -56,6 +222,105 @@ class TestFits(object):
         pscale = get_pixscale('image.fits')
         assert round(pscale, 1) == PIXSCALE
 
+    def test_read_psf(self):
+        psf_file = read_psf('image.fits', cache=False)
+        assert_equal(psf_file.data, fits.getdata('image.fits'))
+        assert psf_file.pixel_scale == get_pixscale('image.fits')
+        assert psf_file.shape == (5, 5)
+        assert psf_file.checksum == array_digest(fits.getdata('image.fits'))
+        assert not psf_file.data.flags.writeable
+
+    def test_read_psf_cache(self, tmpdir, monkeypatch):
+        fits_file = str(tmpdir.join('psf.fits'))
+        hdu = fits.PrimaryHDU(np.ones((3, 3)))
+        hdu.header['PIXSCALE'] = PIXSCALE
+        hdu.writeto(fits_file)
+
+        clear_psf_cache()
+        psf_file = read_psf(fits_file)
+        # Only the metadata is cached, the image is read again
+        cached, = fitsutils._psf_cache.values()
+        assert cached.data is None
+        assert cached._replace(data=psf_file.data) == psf_file
+
+        def no_digest(array):
+            raise AssertionError("image hashed again")
+        monkeypatch.setattr(fitsutils, 'array_digest', no_digest)
+        again = read_psf(fits_file)
+        assert again.checksum == psf_file.checksum
+        assert again.dtype == psf_file.dtype
+        assert_equal(again.data, psf_file.data)
+        monkeypatch.undo()
+
+        # A modified file is read again, once the images are released
+        del psf_file, again
+        hdu.data *= 2
+        hdu.writeto(fits_file, overwrite=True)
+        os.utime(fits_file, ns=(0, 10**9))
+        assert_equal(read_psf(fits_file).data, 2 * np.ones((3, 3)))
+
+    def test_read_psf_cache_disabled(self, tmpdir, monkeypatch):
+        fits_file = str(tmpdir.join('psf.fits'))
+        hdu = fits.PrimaryHDU(np.ones((3, 3)))
+        hdu.header['PIXSCALE'] = PIXSCALE
+        hdu.writeto(fits_file)
+
+        clear_psf_cache()
+        monkeypatch.setattr(fitsutils, 'PSF_CACHE_SIZE', 0)
+        assert read_psf(fits_file).pixel_scale == PIXSCALE
+        assert not fitsutils._psf_cache
+
+    def test_load_psf_plane(self, tmpdir):
+        fits_file = str(tmpdir.join('library.fits'))
+        cube = np.arange(3 * 4 * 4, dtype='>f4').reshape(3, 4, 4)
+        cube[1, 0, 0] = np.nan
+        primary = fits.PrimaryHDU()
+        primary.header['PIXSCALE'] = PIXSCALE
+        fits.HDUList([primary, fits.ImageHDU(cube, name='PSFS')]).writeto(
+            fits_file)
+
+        psf, pixel_scale = load_psf(fits_file, ext='PSFS', plane=1)
+        expected = cube[1].copy()
+        expected[0, 0] = 0
+        assert_equal(psf, expected)
+        assert pixel_scale == PIXSCALE
+        assert psf.dtype == np.float32 and psf.dtype.isnative
+
+    @pytest.mark.parametrize('plane', [None, 1])
+    def test_load_psf_scaled(self, tmpdir, plane):
+        fits_file = str(tmpdir.join('scaled.fits'))
+        cube = np.arange(2 * 4 * 4, dtype=float).reshape(2, 4, 4) / 4
+        hdu = fits.PrimaryHDU(cube.copy())
+        hdu.scale('int16', bscale=0.25, bzero=10)
+        hdu.header['PIXSCALE'] = PIXSCALE
+        hdu.writeto(fits_file)
+
+        psf, pixel_scale = load_psf(fits_file, plane=plane)
+        expected = cube if plane is None else cube[plane]
+        assert_allclose(psf, expected, atol=ABSTOL)
+        assert pixel_scale == PIXSCALE
+        assert read_psf(fits_file, plane=plane, cache=False).shape == \
+            expected.shape
+
+    def test_read_psf_plane_2d(self):
+        with pytest.raises(ValueError):
+            read_psf('image.fits', plane=0)
+
+    def test_add_pixscale(self, tmpdir):
+        fits_files = [str(tmpdir.join('stamp%d.fits' % idx))
+                      for idx in range(4)]
+        for fits_file in fits_files:
+            fits.writeto(fits_file, np.ones((3, 3)))
+        write_pixelscale(fits_files[0], 2 * PIXSCALE)
+
+        written = add_pixscale(fits_files, PIXSCALE, jobs=2)
+
+        assert written == [False, True, True, True]
+        assert get_pixscale(fits_files[0]) == 2 * PIXSCALE
+        for fits_file in fits_files[1:]:
+            assert get_pixscale(fits_file) == PIXSCALE
+            assert_equal(fits.getdata(fits_file), np.ones((3, 3)))
+
     def test_add_single_comment(self):
         add_comments('image.fits', "single comment")
         comments = str(fits.getval('image.fits', 'COMMENT')).split('\n')
@@ -87,10 +352,47 @@ class TestImageManipulation(object):
                          target_pscale=1)
         assert res.shape[0] == size * factor + 1
 
+    @pytest.mark.parametrize('size', [42, 49])
+    def test_resample_fourier_shape(self, size):
+        image = np.ones((size, size))
+        res = imresample(image, 2, 1, method='fourier')
+        assert_equal(res.shape, imresample(image, 2, 1).shape, ERRSHAPE)
+
+    def test_resample_unknown_method(self):
+        with pytest.raises(ValueError):
+            imresample(np.ones((5, 5)), 2, 1, method='lanczos')
+
     def test_resample_memoryerror(self):
         with pytest.raises(MemoryError):
             imresample(np.zeros((200, 200)), 100, 1)
 
+    def test_transform_rotate(self, imagerot):
+        assert_allclose(imtransform(imagerot, 30), imrotate(imagerot, 30),
+                        atol=ABSTOL, rtol=RELTOL)
+
+    @pytest.mark.parametrize('delta', [-2, 0, 10])
+    def test_transform_resample(self, imagerot, delta):
+        image = imagerot + 1
+        resampled = imresample(image, source_pscale=2, target_pscale=1)
+        size = resampled.shape[0] + delta
+        if delta < 0:
+            expected = trim(resampled, (size, size))
+        else:
+            expected = zero_pad(resampled, (size, size), position='center')
+
+        assert_allclose(imtransform(image, 0, 2, 1, (size, size)),
+                        expected, atol=ABSTOL, rtol=RELTOL)
+
+        with pytest.raises(ValueError):
+            imtransform(image, 0, 2, 1, (size + 1, size + 1))
+
+    def test_transform_flux(self):
+        image = np.zeros((41, 41))
+        image[18:23, 18:23] = 1 / 25
+        transformed = imtransform(image, 27, source_pscale=0.1,
+                                  target_pscale=0.15, shape=(29, 29))
+        assert_allclose(transformed.sum(), 1, rtol=1e-2)
+
     def test_trim(self, tones):
         arr, size = tones
         size_e = size - 1
@@ -115,6 +417,10 @@ class TestImageManipulation(object):
             trim(arr, shape_ee)
             trim(arr, shape_eo)
 
+    def test_trim_view(self, tones):
+        arr, size = tones
+        assert np.shares_memory(trim(arr, (size - 2, size - 2)), arr)
+
     def test_zero_pad(self, tones):
         arr, size = tones
         size_e = size + 1
@@ -143,8 +449,58 @@ class TestImageManipulation(object):
                 zero_pad(arr, shape_ee, 'center')
                 zero_pad(arr, shape_eo, 'center')
 
+    @pytest.mark.parametrize('size', [64, 65])
+    def test_energy_trim(self, size):
+        psf = gaussian(size, 2.0)
+        cropped, discarded = energy_trim(psf, 0.999)
+
+        assert cropped.shape[0] < size, ERRSHAPE
+        assert (size - cropped.shape[0]) % 2 == 0, ERRSHAPE
+        assert cropped[cropped.shape[0] // 2, cropped.shape[1] // 2] == \
+            psf.max(), ERROUT
+        assert_allclose(discarded, 1 - cropped.sum(), atol=1e-12)
+        assert discarded <= 1e-3, ERRVAL
+        # One more ring would break the energy bound
+        margin, _ = energy_margin(psf, 0.999)
+        assert 1 - trim(psf, (cropped.shape[0] - 2,) * 2).sum() > 1e-3, ERRVAL
+        assert margin == (size - cropped.shape[0]) // 2, ERRVAL
+
+    def test_energy_trim_stack(self, gaussians):
+        cropped, _ = energy_trim(gaussians, 0.99)
+        assert_equal(cropped, trim(gaussians, cropped.shape[-2:]), ERROUT)
+        # The support of the stack is at least that of its widest image
+        widest, _ = energy_trim(gaussians[-1], 0.99)
+        assert cropped.shape[-1] >= widest.shape[-1], ERRSHAPE
+
+    def test_energy_trim_edge_cases(self, tones):
+        arr, size = tones
+        assert energy_trim(np.zeros((size, size)), 0.9)[0].shape == \
+            (size, size), ERRSHAPE
+        assert energy_trim(arr, 1.0)[0].shape == (size, size), ERRSHAPE
+        with pytest.raises(ValueError):
+            energy_margin(arr, 0.0)
+
 
 class TestFourier(object):
+    @pytest.mark.parametrize('new_size', [16, 17, 64, 67])
+    def test_fourier_resample(self, new_size):
+        psf = gaussian(33, 3.)
+        res = fourier_resample(psf, (new_size, new_size))
+        expected = gaussian(new_size, 3. * new_size / 33)
+        assert_allclose(res.sum(), 1, rtol=RELTOL)
+        assert_allclose(res, expected, atol=1e-4 * expected.max())
+        assert res.dtype == np.float64
+
+        res32 = fourier_resample(psf.astype(np.float32), (new_size, new_size))
+        assert res32.dtype == np.float32
+        assert_allclose(res32, res, atol=1e-6 * expected.max())
+
+    def test_fourier_resample_roundtrip(self, imagedirac):
+        size = imagedirac.shape[0]
+        up = fourier_resample(imagedirac, (2 * size + 1, 2 * size + 1))
+        assert_allclose(fourier_resample(up, imagedirac.shape), imagedirac,
+                        atol=ABSTOL)
+
     def test_dirac_otf(self, imagedirac):
         shape = imagedirac.shape
         assert_equal(psf2otf(imagedirac, shape), np.ones(shape))
@@ -162,3 +518,723 @@ class TestFourier(object):
 
         assert k.dtype == float
         assert kf.dtype == complex
+
+    @pytest.mark.parametrize('real', [False, True])
+    def test_homogenization_clip(self, imagedirac, real):
+        # A target three times brighter than the source gives a kernel
+        # peak of about 3, which clip=True must bound to 1
+        target = 3 * imagedirac
+        unclipped, _ = homogenization_kernel(target, imagedirac, clip=False,
+                                             real=real)
+        clipped, _ = homogenization_kernel(target, imagedirac, clip=True,
+                                           real=real)
+
+        assert unclipped.max() > 2.9, ERRVAL
+        assert clipped.max() <= 1 and clipped.min() >= -1, ERRVAL
+        assert_equal(clipped, unclipped.clip(-1, 1), ERROUT)
+        assert_allclose(homogenization_kernels([target], [imagedirac])[0, 0],
+                        clipped, atol=ABSTOL)
+
+    @pytest.mark.parametrize('padding', [(0, 0), (1, 6), (17, 2)])
+    def test_circshift_pad(self, imagerot, padding):
+        psf = imagerot[:, :-1] + np.arange(imagerot.shape[1] - 1)
+        outshape = tuple(np.add(psf.shape, padding))
+        expected = zero_pad(psf, outshape, position='corner')
+        for axis, axis_size in enumerate(psf.shape):
+            expected = np.roll(expected, -(axis_size // 2), axis=axis)
+        assert_equal(circshift_pad(psf, outshape), expected)
+
+    def test_circshift_pad_smaller(self, imagerot):
+        with pytest.raises(ValueError):
+            circshift_pad(imagerot, (imagerot.shape[0] - 1,
+                                     imagerot.shape[1]))
+
+    def test_dirac_otf_real(self, imagedirac):
+        shape = imagedirac.shape
+        otf = psf2otf(imagedirac, shape, real=True)
+        assert_equal(otf, np.ones((shape[0], shape[1] // 2 + 1)))
+
+    def test_homogenization_real(self, gaussians):
+        target, source = gaussians[2], gaussians[0]
+        k, kf = homogenization_kernel(target, source, reg_fact=1e-5)
+        k_r, kf_r = homogenization_kernel(target, source, reg_fact=1e-5,
+                                          real=True)
+
+        assert_equal(kf_r.shape, (k.shape[0], k.shape[1] // 2 + 1), ERRSHAPE)
+        assert_allclose(kf_r, kf[:, :kf_r.shape[1]], atol=ABSTOL, rtol=RELTOL)
+        assert_allclose(k_r, k, atol=ABSTOL, rtol=RELTOL)
+        assert k_r.dtype == float
+
+    def test_fast_length(self):
+        assert [fast_length(size) for size in [1, 7, 16, 101, 251, 1009]] \
+            == [1, 8, 16, 108, 256, 1024]
+
+    @pytest.mark.parametrize('real', [False, True])
+    def test_homogenization_fast(self, imagedirac, real):
+        size = imagedirac.shape[0]
+        target = gaussian(size, size / 10)
+        target /= target.sum()
+        k, _ = homogenization_kernel(target, imagedirac, reg_fact=1e-10,
+                                     real=real)
+        k_fast, _ = homogenization_kernel(target, imagedirac, reg_fact=1e-10,
+                                          real=real, fast=True)
+
+        assert_equal(k_fast.shape, target.shape, ERRSHAPE)
+        assert_allclose(k_fast, target, atol=ABSTOL)
+        assert_allclose(k_fast, k, atol=ABSTOL)
+
+    @pytest.mark.parametrize('real', [False, True])
+    def test_homogenization_float32(self, gaussians, real):
+        target, source = gaussians[2], gaussians[0]
+        k, _ = homogenization_kernel(target, source, reg_fact=1e-4,
+                                     real=real)
+        k_32, kf_32 = homogenization_kernel(target, source, reg_fact=1e-4,
+                                            real=real, dtype=np.float32)
+
+        assert k_32.dtype == np.float32
+        assert kf_32.dtype == np.complex64
+        assert_allclose(k_32, k, atol=1e-6 * np.abs(k).max())
+
+    def test_otf_float32(self, imagedirac):
+        shape = imagedirac.shape
+        otf = psf2otf(imagedirac, shape, real=True, dtype=np.float32)
+        assert otf.dtype == np.float32
+        assert_equal(otf, np.ones((shape[0], shape[1] // 2 + 1)))
+
+
+class TestStack(object):
+    def test_trim_zero_pad_stack(self, gaussians):
+        small = tuple(size - 4 for size in gaussians.shape[1:])
+        large = tuple(size + 6 for size in gaussians.shape[1:])
+        trimmed = trim(gaussians, small)
+        padded = zero_pad(gaussians, large, position='center')
+        for idx, psf in enumerate(gaussians):
+            assert_equal(trimmed[idx], trim(psf, small))
+            assert_equal(padded[idx], zero_pad(psf, large, position='center'))
+
+    @pytest.mark.parametrize('real', [False, True])
+    def test_psf2otf_stack(self, gaussians, real):
+        otfs = psf2otf(gaussians, (40, 36), real=real)
+        for idx, psf in enumerate(gaussians):
+            assert_allclose(otfs[idx], psf2otf(psf, (40, 36), real=real),
+                            atol=ABSTOL)
+
+    @pytest.mark.parametrize('reg_fact', [1e-4, np.array([1e-5, 1e-3])])
+    def test_homogenization_stack(self, gaussians, reg_fact):
+        targets = gaussians[::-1] + gaussians[2]
+        kernels, _ = homogenization_kernel(targets, gaussians, reg_fact,
+                                           real=True)
+        for idx in range(len(gaussians)):
+            kernel, _ = homogenization_kernel(targets[idx], gaussians[idx],
+                                              reg_fact, real=True)
+            assert_allclose(kernels[..., idx, :, :], kernel, atol=ABSTOL)
+
+    @pytest.mark.parametrize('n_reg', [2, 3])
+    @pytest.mark.parametrize('stacked', ['target', 'source'])
+    def test_homogenization_stack_reg_sweep(self, gaussians, n_reg, stacked):
+        reg_facts = np.logspace(-5, -3, n_reg)
+        single = gaussians[2] if stacked == 'target' else gaussians[0]
+        psf_target, psf_source = ((gaussians, single) if stacked == 'target'
+                                  else (single, gaussians))
+        kernels, _ = homogenization_kernel(psf_target, psf_source, reg_facts,
+                                           real=True)
+
+        assert kernels.shape == (n_reg,) + gaussians.shape, ERRSHAPE
+        for idx in range(len(gaussians)):
+            for jdx, reg_fact in enumerate(reg_facts):
+                kernel, _ = homogenization_kernel(
+                    psf_target if stacked == 'source' else psf_target[idx],
+                    psf_source if stacked == 'target' else psf_source[idx],
+                    reg_fact, real=True)
+                assert_allclose(kernels[jdx, idx], kernel, atol=ABSTOL)
+
+
+class TestSeparable(object):
+    def test_separable_gaussian(self):
+        vertical, horizontal, residual = separable_kernel(gaussian(15, 2.0))
+        assert vertical.shape == (1, 15) and horizontal.shape == (1, 15)
+        assert_allclose(vertical[0, :, None] * horizontal[0],
+                        gaussian(15, 2.0), atol=1e-15)
+        assert residual < 1e-12, ERRVAL
+
+    @pytest.mark.parametrize('tol', [0.5, 1e-2, 0.0])
+    def test_separable_rank(self, tol):
+        kernels = np.random.RandomState(4).normal(size=(3, 9, 7))
+        vertical, horizontal, residual = separable_kernel(kernels, tol=tol)
+        rebuilt = np.einsum('...ci,...cj->...ij', vertical, horizontal)
+        errors = [np.linalg.norm(kernel - approx) / np.linalg.norm(kernel)
+                  for kernel, approx in zip(kernels, rebuilt)]
+
+        assert_allclose(errors, residual, atol=1e-12)
+        assert np.all(residual <= tol + 1e-12), ERRVAL
+        # The rank is the smallest one meeting the tolerance
+        rank = vertical.shape[-2]
+        _, _, coarser = separable_kernel(kernels, tol=1.0,
+                                         max_rank=rank - 1)
+        assert rank == 1 or np.any(coarser > tol), ERRVAL
+
+
+class TestRegularisation(object):
+    def test_reg_sweep(self, gaussians):
+        target, source = gaussians[2], gaussians[0]
+        reg_facts = np.logspace(-6, -2, 5)
+        kernels, kernels_fourier = homogenization_kernel(target, source,
+                                                         reg_fact=reg_facts,
+                                                         real=True)
+        assert_equal(kernels.shape, (5,) + target.shape, ERRSHAPE)
+        for kernel, reg_fact in zip(kernels, reg_facts):
+            kernel_ref, _ = homogenization_kernel(target, source,
+                                                  reg_fact=reg_fact)
+            assert_allclose(kernel, kernel_ref, atol=ABSTOL, rtol=RELTOL)
+
+    def test_gcv_closed_form(self, gaussians):
+        target, source = gaussians[2], gaussians[0]
+        reg_fact = 1e-3
+        gcv = reg_criterion(target, source, [reg_fact], method='gcv')
+
+        shape = source.shape
+        trans_power = np.abs(psf2otf(source, shape))**2
+        reg_term = reg_fact * np.abs(psf2otf(LAPLACIAN, shape))**2
+        complement = reg_term / (trans_power + reg_term)
+        data = np.fft.fft2(target) / np.sqrt(target.size)
+        gcv_ref = (np.sum(np.abs(complement * data)**2) /
+                   np.sum(complement)**2)
+
+        assert_allclose(gcv[0], gcv_ref, rtol=RELTOL)
+
+    @pytest.mark.parametrize('method', ['gcv', 'lcurve'])
+    def test_select_reg_fact(self, gaussians, method):
+        target, source = gaussians[2], gaussians[0]
+        noise = np.random.RandomState(0).standard_normal(target.shape)
+        with warnings.catch_warnings():
+            # Interior optima, for which no warning is issued
+            warnings.simplefilter('error')
+            reg_low = select_reg_fact(target + 1e-6 * noise, source, method)
+            reg_high = select_reg_fact(target + 1e-4 * noise, source,
+                                       method)
+        assert reg_low < reg_high
+
+    def test_select_reg_fact_grid_end(self, gaussians):
+        # Without noise, the smallest parameter of the grid is selected
+        target, source = gaussians[2], gaussians[0]
+        with pytest.warns(UserWarning, match='lower end of the grid'):
+            reg_fact = select_reg_fact(target, source, 'gcv')
+        assert reg_fact == REG_GRID[0]
+
+    def test_unknown_reg_method(self, gaussians):
+        with pytest.raises(ValueError):
+            reg_criterion(gaussians[1], gaussians[0], method='aic')
+
+
+class TestBatch(object):
+    def test_batch_shape(self, gaussians):
+        kernels = homogenization_kernels(gaussians, gaussians[:2])
+        assert_equal(kernels.shape, (2, 3) + gaussians.shape[1:], ERRSHAPE)
+
+    def test_batch_kernels(self, gaussians):
+        kernels = homogenization_kernels(gaussians[1:], gaussians[:2],
+                                         reg_fact=1e-5)
+        for idx, source in enumerate(gaussians[:2]):
+            for jdx, target in enumerate(gaussians[1:]):
+                kernel, _ = homogenization_kernel(target, source,
+                                                  reg_fact=1e-5)
+                assert_allclose(kernels[idx, jdx], kernel,
+                                atol=ABSTOL, rtol=RELTOL)
+
+    def test_batch_float32(self, gaussians):
+        kernels = homogenization_kernels(gaussians[1:], gaussians[:1],
+                                         dtype=np.float32)
+        assert kernels.dtype == np.float32
+
+    def test_batch_wrong_shape(self, gaussians):
+        with pytest.raises(ValueError):
+            homogenization_kernels(gaussians, gaussians[:, 1:, 1:])
+
+    def test_batch_reg_array(self, gaussians):
+        # Same length as the source stack, which must not be paired with it
+        with pytest.raises(ValueError):
+            homogenization_kernels(gaussians, gaussians[:2],
+                                   reg_fact=[1e-5, 1e-4])
+
+
+class TestFFTBackend(object):
+    def teardown_method(self, method):
+        fftutils.set_backend('numpy')
+
+    def test_unknown_backend(self):
+        with pytest.raises(ValueError):
+            fftutils.set_backend('fftpack')
+
+    def test_scipy_backend(self, gaussians):
+        target, source = gaussians[2], gaussians[0]
+        fftutils.set_backend('numpy')
+        k_ref, _ = homogenization_kernel(target, source, real=True)
+
+        assert fftutils.set_backend('scipy', workers=2) == 'scipy'
+        k, _ = homogenization_kernel(target, source, real=True)
+        assert_allclose(k, k_ref, atol=ABSTOL, rtol=RELTOL)
+
+    def test_env_backend(self, monkeypatch):
+        monkeypatch.setenv('PYPHER_FFT_BACKEND', 'scipy')
+        assert fftutils.set_backend() == 'scipy'
+
+    def test_backend_fallback(self):
+        try:
+            import pyfftw  # noqa: F401
+        except ImportError:
+            with pytest.warns(UserWarning):
+                assert fftutils.set_backend('pyfftw') == 'numpy'
+        else:
+            assert fftutils.set_backend('pyfftw') == 'pyfftw'
+
+
+class TestCache(object):
+    def test_cache_key(self, gaussians):
+        assert cache_key('otf', gaussians[0], 1e-4) == \
+            cache_key('otf', gaussians[0].copy(), np.float64(1e-4))
+        assert cache_key('otf', gaussians[0], 1e-4) != \
+            cache_key('otf', gaussians[1], 1e-4)
+        assert cache_key('otf', gaussians[0], 1e-4) != \
+            cache_key('otf', gaussians[0], 1e-5)
+
+    def test_memory_cache(self, gaussians):
+        cache = OTFCache()
+        wiener = deconv_wiener(gaussians[0], 1e-4, real=True, cache=cache)
+        assert cache.misses == 3
+        wiener_again = deconv_wiener(gaussians[0], 1e-4, real=True,
+                                     cache=cache)
+        assert cache.hits == 1
+        assert wiener_again is wiener
+        assert_allclose(wiener, deconv_wiener(gaussians[0], 1e-4, real=True))
+        assert not wiener.flags.writeable
+
+    def test_memory_lru(self):
+        cache = OTFCache(maxsize=2)
+        for key in 'abc':
+            cache.put(key, np.zeros(3))
+        assert len(cache) == 2
+        assert 'a' not in cache
+        assert 'c' in cache
+
+    def test_disk_cache(self, gaussians, tmpdir):
+        cache_dir = str(tmpdir.join('cache'))
+        kernel, _ = homogenization_kernel(gaussians[2], gaussians[0],
+                                          cache=OTFCache(cache_dir=cache_dir))
+
+        cache = OTFCache(cache_dir=cache_dir)
+        kernel_cached, _ = homogenization_kernel(gaussians[2], gaussians[0],
+                                                 cache=cache)
+        assert cache.hits == 1
+        assert cache.misses == 0
+        assert_equal(kernel_cached, kernel)
+
+    def test_disk_size_cap(self, tmpdir):
+        cache = OTFCache(maxsize=1, cache_dir=str(tmpdir),
+                         max_bytes=2000)
+        for key in 'abc':
+            cache.put(key, np.zeros(100))
+        assert len(tmpdir.listdir()) == 2
+        assert cache.get('c') is not None
+
+
+def field_psfs(x, y, size=25):
+    """Target PSFs widening across the field and a fixed source PSF"""
+    targets = np.array([gaussian(size, 2.5 + 0.5 * xx + 0.3 * yy)
+                        for xx, yy in zip(x, y)])
+    sources = np.array([gaussian(size, 1.5)] * len(targets))
+    targets /= targets.sum(axis=(1, 2))[:, None, None]
+    sources /= sources.sum(axis=(1, 2))[:, None, None]
+    return targets, sources
+
+
+class TestKernelField(object):
+    def setup_method(self, method):
+        grid = np.linspace(0, 1, 6)
+        self.x, self.y = [axis.ravel() for axis in np.meshgrid(grid, grid)]
+        self.targets, self.sources = field_psfs(self.x, self.y)
+
+    def test_pairwise(self):
+        kernels = homogenization_kernels(self.targets[:3], self.sources[:3],
+                                         pairwise=True)
+        assert_equal(kernels.shape, self.targets[:3].shape, ERRSHAPE)
+        for idx in range(3):
+            kernel, _ = homogenization_kernel(self.targets[idx],
+                                              self.sources[idx])
+            assert_allclose(kernels[idx], kernel, atol=ABSTOL)
+
+    def test_field_interpolation(self):
+        field = KernelField.from_psfs(self.targets, self.sources,
+                                      self.x, self.y, degree=4)
+        assert field.n_components < 5
+
+        targets, sources = field_psfs([0.33, 0.9], [0.77, 0.1])
+        kernels = field.kernel([0.33, 0.9], [0.77, 0.1])
+        for idx in range(2):
+            kernel, _ = homogenization_kernel(targets[idx], sources[idx])
+            assert_allclose(kernels[idx], kernel, atol=1e-4 * kernel.max())
+
+    def test_field_io(self, tmpdir):
+        fits_file = str(tmpdir.join('field.fits'))
+        field = KernelField.from_psfs(self.targets, self.sources,
+                                      self.x, self.y, n_components=2)
+        field.writeto(fits_file)
+        field_read = KernelField.read(fits_file)
+        assert field_read.n_components == 2
+        assert_allclose(field_read.kernel(0.5, 0.2), field.kernel(0.5, 0.2))
+
+    def test_field_too_few_positions(self):
+        with pytest.raises(ValueError):
+            KernelField.from_kernels(self.targets[:5], self.x[:5],
+                                     self.y[:5], degree=2)
+
+
+def _fill_bank(bank_file, name):
+    """Append kernels one at a time, as separate pypher runs would"""
+    for idx in range(5):
+        with KernelBank(bank_file, 'a') as bank:
+            bank.append(np.full((4, 4), idx), 'psf_{0}.fits'.format(name),
+                        'psf_t.fits', 10.0**-idx, PIXSCALE)
+
+
+class TestBank(object):
+    def test_bank_roundtrip(self, tmpdir):
+        bank_file = str(tmpdir.join('bank.fits'))
+        rng = np.random.RandomState(5)
+        kernels = {}
+        with KernelBank(bank_file, 'a') as bank:
+            for idx, dtype in enumerate([np.float64, np.float32]):
+                key = ('psf_{0}.fits'.format(idx), 'psf_t.fits', 1e-4)
+                kernels[key] = rng.normal(size=(7, 6 + idx)).astype(dtype)
+                bank.append(kernels[key], *key, pixel_scale=PIXSCALE,
+                            comments=['kernel {0}'.format(idx)])
+
+        # Appending to an existing bank keeps the previous kernels
+        with KernelBank(bank_file, 'a') as bank:
+            key = ('psf_0.fits', 'psf_t.fits', 1e-5)
+            kernels[key] = rng.normal(size=(5, 5))
+            bank.append(kernels[key], *key, pixel_scale=PIXSCALE)
+
+        with KernelBank(bank_file) as bank:
+            assert len(bank) == 3
+            for key, kernel in kernels.items():
+                assert key in bank
+                assert bank[key].dtype == kernel.dtype
+                assert_equal(bank[key], kernel, ERROUT)
+            header = bank.header(('psf_1.fits', 'psf_t.fits', 1e-4))
+            assert header['COMMENT'][0] == 'kernel 1'
+            assert header['REGFACT'] == 1e-4
+            assert round(header['CD1_1'] * 3600, 6) == PIXSCALE
+
+            with pytest.raises(IOError):
+                bank.append(np.ones((3, 3)), 'a', 'b', 1.0, PIXSCALE)
+
+        # The bank is a valid FITS file
+        with fits.open(bank_file) as hdulist:
+            hdulist.verify('exception')
+            assert hdulist[-1].name == 'INDEX'
+            assert hdulist[0].header['IDXOFF'] == \
+                hdulist.fileinfo(len(hdulist) - 1)['hdrLoc']
+
+    def test_bank_single_index(self, tmpdir):
+        bank_file = str(tmpdir.join('bank.fits'))
+        for idx in range(4):
+            with KernelBank(bank_file, 'a') as bank:
+                bank.append(np.full((3, 3), idx), 'psf_{0}.fits'.format(idx),
+                            'psf_t.fits', 1e-4, PIXSCALE)
+
+        with fits.open(bank_file) as hdulist:
+            hdulist.verify('exception')
+            assert len(hdulist) == 1 + 4 + 1
+            assert [hdu.name for hdu in hdulist].count('INDEX') == 1
+            assert hdulist[-1].header['NAXIS2'] == 4
+            assert hdulist.fileinfo(len(hdulist) - 1)['datSpan'] + \
+                hdulist.fileinfo(len(hdulist) - 1)['datLoc'] == \
+                os.path.getsize(bank_file)
+
+        with KernelBank(bank_file) as bank:
+            for idx in range(4):
+                key = ('psf_{0}.fits'.format(idx), 'psf_t.fits', 1e-4)
+                assert_equal(bank[key], np.full((3, 3), idx), ERROUT)
+
+    def test_append_kernel_cube(self, mock_parser, tmpdir):
+        reg_facts = np.array([1e-5, 1e-4])
+        args = mock_parser._replace(reg_fact=reg_facts)
+        cube = np.random.RandomState(6).normal(size=(2, 5, 5))
+        bank_file = str(tmpdir.join('bank.fits'))
+
+        with KernelBank(bank_file, 'a') as bank:
+            append_kernel(bank, cube, args, PIXSCALE)
+
+        bank = KernelBank(bank_file)
+        for plane, reg_fact in zip(cube, reg_facts):
+            key = ('psf_source.fits', 'psf_target.fits', reg_fact)
+            assert_equal(bank[key], plane, ERROUT)
+            assert 'R = {0:1.1e}'.format(reg_fact) in \
+                str(bank.header(key)['COMMENT'])
+        bank.close()
+
+    def test_bank_unicode_names(self, tmpdir):
+        bank_file = str(tmpdir.join('bank.fits'))
+        key = ('psf_\u00e9t\u00e9.fits', 'psf_t.fits', 1e-4)
+        with KernelBank(bank_file, 'a') as bank:
+            bank.append(np.ones((3, 3)), *key, pixel_scale=PIXSCALE)
+
+        with KernelBank(bank_file) as bank:
+            assert bank.keys() == [key]
+
+    @pytest.mark.skipif(bank_module.fcntl is None,
+                        reason="no advisory file locks")
+    def test_bank_concurrent_writers(self, tmpdir):
+        bank_file = str(tmpdir.join('bank.fits'))
+        processes = [multiprocessing.Process(target=_fill_bank,
+                                             args=(bank_file, name))
+                     for name in ['a', 'b', 'c']]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0
+
+        with KernelBank(bank_file) as bank:
+            assert len(bank) == 3 * 5
+            for name in ['a', 'b', 'c']:
+                for idx in range(5):
+                    key = ('psf_{0}.fits'.format(name), 'psf_t.fits',
+                           10.0**-idx)
+                    assert_equal(bank[key], np.full((4, 4), idx), ERROUT)
+
+    def test_not_a_bank(self, tmpdir):
+        fits_file = str(tmpdir.join('kernel.fits'))
+        fits.writeto(fits_file, np.ones((3, 3)))
+        with pytest.raises(IOError):
+            KernelBank(fits_file)
+
+
+class TestApply(object):
+    def reference(self, image, kernel):
+        """Direct 'same' convolution with the psf2otf kernel center"""
+        full = np.zeros((image.shape[0] + kernel.shape[0] - 1,
+                         image.shape[1] + kernel.shape[1] - 1))
+        for (row, col), value in np.ndenumerate(kernel):
+            full[row:row + image.shape[0], col:col + image.shape[1]] += \
+                value * image
+        start = [size // 2 for size in kernel.shape]
+        return full[start[0]:start[0] + image.shape[0],
+                    start[1]:start[1] + image.shape[1]]
+
+    @pytest.mark.parametrize('kernel_shape', [(7, 7), (6, 9)])
+    @pytest.mark.parametrize('tile_size', [8, 13, 100])
+    def test_convolve_tiled(self, kernel_shape, tile_size):
+        rng = np.random.RandomState(0)
+        image = rng.normal(size=(40, 27))
+        kernel = rng.normal(size=kernel_shape)
+        assert_allclose(convolve_tiled(image, kernel, tile_size=tile_size),
+                        self.reference(image, kernel), atol=1e-10)
+
+    @pytest.mark.parametrize('max_bytes', [1, 2**28])
+    def test_convolve_stamps(self, tmpdir, max_bytes):
+        rng = np.random.RandomState(2)
+        stamps = np.lib.format.open_memmap(str(tmpdir.join('stamps.npy')),
+                                           mode='w+', dtype=np.float32,
+                                           shape=(5, 12, 15))
+        stamps[:] = rng.normal(size=stamps.shape)
+        kernel = rng.normal(size=(5, 4))
+
+        output = convolve_stamps(stamps, kernel, max_bytes=max_bytes)
+
+        assert output.dtype == np.float32
+        for stamp, convolved in zip(stamps, output):
+            assert_allclose(convolved, self.reference(stamp, kernel),
+                            atol=1e-5)
+
+    def test_convolve_separable(self, tmpdir, mock_parser):
+        rng = np.random.RandomState(3)
+        image = rng.normal(size=(30, 23))
+        kernel = gaussian(9, 1.5) + 0.1 * np.outer(np.hanning(9),
+                                                   rng.normal(size=9))
+        vertical, horizontal, residual = separable_kernel(kernel, tol=1e-8)
+        assert vertical.shape[0] == 2, ERRSHAPE
+        assert residual <= 1e-8, ERRVAL
+
+        kernel_file = str(tmpdir.join('kernel.fits'))
+        write_kernel(kernel_file, kernel, mock_parser, PIXSCALE,
+                     extensions=separable_hdus(vertical, horizontal,
+                                               residual))
+        vertical, horizontal, _ = read_separable(kernel_file)
+        assert_allclose(convolve_separable(image, vertical, horizontal),
+                        self.reference(image, kernel), atol=1e-10)
+
+    def test_convolve_stamps_2d(self):
+        with pytest.raises(ValueError):
+            convolve_stamps(np.ones((4, 4)), np.ones((3, 3)))
+
+    @pytest.mark.parametrize('jobs', [1, 2])
+    def test_apply_kernel(self, tmpdir, jobs):
+        rng = np.random.RandomState(1)
+        image = rng.normal(size=(50, 31)).astype(np.float32)
+        kernel = gaussian(9, 1.5)
+        image_file = str(tmpdir.join('image.fits'))
+        kernel_file = str(tmpdir.join('kernel.fits'))
+        output_file = str(tmpdir.join('output.fits'))
+        hdu = fits.PrimaryHDU(image)
+        hdu.header['BUNIT'] = 'MJy/sr'
+        hdu.writeto(image_file)
+        fits.writeto(kernel_file, kernel)
+
+        apply_kernel(image_file, kernel_file, output_file, tile_size=16,
+                     jobs=jobs)
+
+        output = fits.getdata(output_file)
+        assert fits.getval(output_file, 'BITPIX') == -32
+        assert fits.getval(output_file, 'BUNIT') == 'MJy/sr'
+        assert_allclose(output, self.reference(image, kernel), atol=1e-5)
+
+    @pytest.mark.parametrize('jobs', [1, 2])
+    def test_apply_kernel_scaled(self, tmpdir, jobs):
+        rng = np.random.RandomState(2)
+        image = np.round(rng.normal(size=(40, 27)) * 100) / 4
+        kernel = gaussian(7, 1.0)
+        image_file = str(tmpdir.join('image.fits'))
+        kernel_file = str(tmpdir.join('kernel.fits'))
+        output_file = str(tmpdir.join('output.fits'))
+        hdu = fits.PrimaryHDU(image.copy())
+        hdu.scale('int16', bscale=0.25, bzero=100)
+        hdu.writeto(image_file)
+        fits.writeto(kernel_file, kernel)
+
+        apply_kernel(image_file, kernel_file, output_file, tile_size=16,
+                     jobs=jobs)
+
+        assert fits.getval(output_file, 'BITPIX') == -32
+        assert 'BZERO' not in fits.getheader(output_file)
+        assert_allclose(fits.getdata(output_file),
+                        self.reference(image, kernel), atol=1e-4)
+
+    def test_apply_kernel_blank(self, tmpdir):
+        image = np.arange(20 * 20, dtype=float).reshape(20, 20) / 8
+        image_file = str(tmpdir.join('image.fits'))
+        kernel_file = str(tmpdir.join('kernel.fits'))
+        output_file = str(tmpdir.join('output.fits'))
+        hdu = fits.PrimaryHDU(image.copy())
+        hdu.scale('int16', bscale=0.125, bzero=0)
+        hdu.header['BLANK'] = -32768
+        hdu.writeto(image_file, checksum=True)
+        fits.writeto(kernel_file, gaussian(5, 1.0))
+
+        apply_kernel(image_file, kernel_file, output_file)
+
+        header = fits.getheader(output_file)
+        for key in ['BZERO', 'BSCALE', 'BLANK', 'CHECKSUM', 'DATASUM']:
+            assert key not in header
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            output = fits.getdata(output_file)
+        assert_allclose(output, self.reference(image, gaussian(5, 1.0)),
+                        atol=1e-4)
+
+    def test_apply_kernel_float32(self, tmpdir):
+        image = np.random.RandomState(3).normal(size=(20, 20))
+        image_file = str(tmpdir.join('image.fits'))
+        kernel_file = str(tmpdir.join('kernel.fits'))
+        output_file = str(tmpdir.join('output.fits'))
+        fits.writeto(image_file, image)
+        fits.writeto(kernel_file, gaussian(5, 1.0))
+
+        apply_kernel(image_file, kernel_file, output_file, dtype=np.float32)
+        assert fits.getval(output_file, 'BITPIX') == -32
+
+        apply_kernel(image_file, kernel_file, output_file, overwrite=True)
+        assert fits.getval(output_file, 'BITPIX') == -64
+
+    def test_apply_kernel_not_2d(self, tmpdir):
+        image_file = str(tmpdir.join('cube.fits'))
+        kernel_file = str(tmpdir.join('kernel.fits'))
+        fits.writeto(image_file, np.ones((2, 8, 8)))
+        fits.writeto(kernel_file, gaussian(5, 1.0))
+
+        with pytest.raises(ValueError):
+            apply_kernel(image_file, kernel_file,
+                         str(tmpdir.join('output.fits')))
+
+
+class TestProfiling(object):
+    def test_disabled(self):
+        assert not profiling.enabled()
+        assert profiling.stage('normalize') is profiling.stage('crop')
+
+        psf = gaussian(15, 2.0)
+        with profiling.stage('normalize', psf=psf) as current:
+            current.add(output=psf)
+        assert imrotate.__wrapped__.__name__ == 'imrotate'
+        assert_equal(imrotate(psf, 30.0), imrotate.__wrapped__(psf, 30.0),
+                     ERROUT)
+
+    def test_hook(self):
+        records = []
+        psf = gaussian(15, 2.0)
+        profiling.add_hook(records.append)
+        try:
+            kernel, _ = homogenization_kernel(gaussian(15, 3.0), psf)
+            with profiling.stage('normalize', psf=psf) as current:
+                current.add(output=psf / psf.sum())
+        finally:
+            profiling.remove_hook(records.append)
+        assert not profiling.enabled()
+
+        assert [record['stage'] for record in records] == ['wiener',
+                                                           'normalize']
+        wiener, normalize = records
+        assert wiener['function'] == 'homogenization_kernel'
+        assert wiener['wall'] >= 0 and wiener['cpu'] >= 0
+        assert wiener['arrays']['arg1']['shape'] == [15, 15]
+        assert wiener['arrays']['out0']['nbytes'] == kernel.nbytes
+        assert normalize['function'] is None
+        assert list(normalize['arrays']) == ['psf', 'output']
+        # Memory is only measured when tracemalloc is tracing
+        assert wiener['alloc_peak'] is None and wiener['depth'] == 0
+
+    def test_profiler(self, tmpdir):
+        psf = gaussian(15, 2.0)
+        with profiling.Profiler() as profiler:
+            for angle in [10.0, 20.0]:
+                imrotate(psf, angle)
+            homogenization_kernel(gaussian(15, 3.0), psf)
+        imrotate(psf, 30.0)
+
+        summary = profiler.summary()
+        assert list(summary) == ['rotate', 'wiener']
+        assert summary['rotate']['calls'] == 2
+
+        report_file = str(tmpdir.join('report.json'))
+        profiler.write(report_file)
+        with open(report_file) as report:
+            report = json.load(report)
+        assert len(report['stages']) == 3
+        assert report['wall'] >= summary['wiener']['wall']
+        assert report['summary']['wiener']['calls'] == 1
+        if report['max_rss'] is not None:
+            assert report['max_rss'] > 0
+        assert not tracemalloc.is_tracing()
+
+    def test_profiler_memory(self):
+        with profiling.Profiler() as profiler:
+            with profiling.stage('outer'):
+                kept = np.ones(2**17)
+                with profiling.stage('inner'):
+                    freed = np.ones(2**20)
+                    del freed
+                kept += 1
+
+        inner, outer = profiler.records
+        assert inner['depth'] == 1 and outer['depth'] == 0
+        # The 8 MB array of the inner stage is freed before it ends
+        assert inner['alloc_peak'] >= 2**23
+        assert abs(inner['alloc_net']) < 2**20
+        # The outer stage keeps its 1 MB array and sees the inner peak
+        assert outer['alloc_peak'] >= 2**23 + 2**20
+        assert 2**20 <= outer['alloc_net'] < 2**21
+
+        # Nested stages are not counted twice
+        summary = profiler.summary()
+        assert list(summary) == ['outer']
+        assert summary['outer']['wall'] == outer['wall']
@@ -46,12 +46,14 @@ setup(
     version=find_version('pypher/pypher.py'),
     long_description=open('README.rst').read(),
     zip_safe=False,
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
     entry_points={
         'console_scripts': [
             'pypher = pypher.pypher:main',
             'addpixscl = pypher.addpixscl:main',
+            'pypher-batch = pypher.batch:main',
+            'pypher-apply = pypher.apply:main',
         ],
     },
     install_requires=[